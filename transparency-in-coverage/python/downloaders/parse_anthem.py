@@ -1,36 +1,45 @@
 import glob
+import gzip
 import json
 import sqlite3
 import asyncio
 import aiohttp
 from tqdm import tqdm
 
-con = sqlite3.connect("anthem_data.db")
-cur = con.cursor()
-cur.execute("CREATE TABLE IF NOT EXISTS in_network_files(url PRIMARY KEY UNIQUE, size)")
+SPLIT_DIR = './2022-09-01_anthem_index_json'
 
-files = glob.glob('./2022-09-01_anthem_index_json/*')
 
-urls = set()
+def load_in_network_urls(split_dir):
+    """
+    Collects the in-network file URLs from the reporting_structure shards
+    in `split_dir`. Only `reporting_structure_*.jsonl` shards are read, so
+    the root.json written next to them by splitter.py is skipped
+    """
+    files = sorted(glob.glob(f'{split_dir}/reporting_structure_*.jsonl*'))
+
+    urls = set()
+
+    for file in tqdm(files):
+        opener = gzip.open if file.endswith('.gz') else open
+        with opener(file, 'rt') as f:
+            for line in f:
+                try:
+                    data = json.loads(line)
+                except json.decoder.JSONDecodeError:
+                    continue
+                for in_network_file in data.get('in_network_files', []):
+                    urls.add(in_network_file['location'])
+
+    return urls
 
-print("Loading JSONL files...")
-for file in tqdm(files):
-	with open(file) as f:
-		for line in f:
-			try: 
-				data = json.loads(line)
-			except json.decoder.JSONDecodeError:
-				pass
-			in_network_files = data['in_network_files']
-			for in_network_file in in_network_files:
-				urls.add(in_network_file['location'])
 
-async def fetch_url_sizes(table, urls):
+async def fetch_url_sizes(con, table, urls):
     """
     Simple async function for getting all the file sizes in a list of urls
     and writing those to a SQLite table
     """
-    
+    cur = con.cursor()
+
     session = aiohttp.ClientSession()
     fs = [session.head(url) for url in urls]
 
@@ -40,11 +49,20 @@ async def fetch_url_sizes(table, urls):
         size = int(resp.headers.get("content-length", -1))
         cur.execute(f"""INSERT OR IGNORE INTO {table} VALUES ("{url}", {size})""")
         con.commit()
-        
+
     await session.close()
 
-print(f"Fetching {len(urls)} URLs and their sizes...")
-asyncio.run(fetch_url_sizes("in_network_files", urls))
-total = cur.execute("SELECT SUM(size) FROM in_network_files").fetchone()[0]
 
-print(f"Total filesize in GB: {total//1_000_000_000}")
+if __name__ == '__main__':
+    con = sqlite3.connect("anthem_data.db")
+    cur = con.cursor()
+    cur.execute("CREATE TABLE IF NOT EXISTS in_network_files(url PRIMARY KEY UNIQUE, size)")
+
+    print("Loading JSONL files...")
+    urls = load_in_network_urls(SPLIT_DIR)
+
+    print(f"Fetching {len(urls)} URLs and their sizes...")
+    asyncio.run(fetch_url_sizes(con, "in_network_files", urls))
+    total = cur.execute("SELECT SUM(size) FROM in_network_files").fetchone()[0]
+
+    print(f"Total filesize in GB: {total//1_000_000_000}")
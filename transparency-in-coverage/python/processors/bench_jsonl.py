@@ -0,0 +1,74 @@
+"""
+Times building filtered in_network items event by event with ijson
+(`MRFObjectBuilder.in_network_items`) against parsing pre-split JSONL
+lines whole (`filter_in_network_item`). Writing is left out so that only
+parsing and filtering are measured.
+
+    python bench_jsonl.py -f test/test_file_1.json -f test/test_file_3.json.gz
+"""
+import time
+import logging
+import argparse
+import tempfile
+
+from mrfutils import MRFOpen, MRFObjectBuilder, filter_in_network_item, filter_provider_reference
+from splitter import split_mrf, iter_jsonl, shard_paths, orjson
+
+
+def event_items(loc, npi_set, code_set):
+    with MRFOpen(loc) as f:
+        m = MRFObjectBuilder(f)
+        m.ffwd(('', 'map_key', 'provider_references'))
+        p_ref_map = m.build_provider_references(npi_set)
+        m.ffwd(('', 'map_key', 'in_network'))
+        return list(m.in_network_items(npi_set, code_set, p_ref_map))
+
+
+def jsonl_items(split_dir, npi_set, code_set):
+    p_ref_map = {}
+    for path in shard_paths(split_dir, 'provider_references'):
+        for pref in iter_jsonl(path):
+            if (pref := filter_provider_reference(pref, npi_set)):
+                p_ref_map[pref['provider_group_id']] = pref['provider_groups']
+
+    items = []
+    for path in shard_paths(split_dir, 'in_network'):
+        for item in iter_jsonl(path):
+            if (item := filter_in_network_item(item, npi_set, code_set, p_ref_map)):
+                items.append(item)
+    return items
+
+
+def timed(fn, *args):
+    s = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - s
+
+
+def bench(loc, npi_set = None, code_set = None):
+    with tempfile.TemporaryDirectory() as split_dir:
+        _, split_time = timed(split_mrf, loc, split_dir)
+
+        event_result, event_time = timed(event_items, loc, npi_set, code_set)
+        jsonl_result, jsonl_time = timed(jsonl_items, split_dir, npi_set, code_set)
+
+    assert event_result == jsonl_result, 'JSONL path built different items'
+
+    n = len(event_result)
+    print(f'{loc}')
+    print(f'  items:        {n}')
+    print(f'  split (once): {split_time:.3f} s')
+    print(f'  event path:   {event_time:.3f} s ({n / event_time:.0f} items/s)')
+    print(f'  jsonl path:   {jsonl_time:.3f} s ({n / jsonl_time:.0f} items/s, orjson={orjson is not None})')
+    print(f'  speedup:      {event_time / jsonl_time:.1f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--file', action = 'append')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    for loc in args.file:
+        bench(loc)
@@ -0,0 +1,93 @@
+"""
+Compares text, binary and memory-mapped reads of a local uncompressed
+MRF. Run it against a multi-GB file, since small files will be served
+from the page cache and mostly measure Python overhead.
+
+    python bench_readers.py -f big_in_network.json
+    python bench_readers.py -f big_in_network.json --parse
+
+Drop the page cache between runs (`echo 3 > /proc/sys/vm/drop_caches`)
+to compare cold reads.
+"""
+import os
+import time
+import ijson
+import argparse
+
+from readers import MmapReader
+
+CHUNK_SIZE = 64 * 1024
+
+
+def open_text(path):
+    return open(path, 'r')
+
+
+def open_binary(path):
+    return open(path, 'rb')
+
+
+def open_mmap(path):
+    return MmapReader(path)
+
+
+READERS = {
+    'text':   open_text,
+    'binary': open_binary,
+    'mmap':   open_mmap,
+}
+
+
+def drain(f):
+    n = 0
+    while (chunk := f.read(CHUNK_SIZE)):
+        n += len(chunk)
+    return n
+
+
+def drain_into(f):
+    # Reuses one buffer, which is where the mmap reader avoids copies
+    buf = bytearray(CHUNK_SIZE)
+    n = 0
+    while (m := f.readinto(buf)):
+        n += m
+    return n
+
+
+def parse(f):
+    n = 0
+    for _ in ijson.parse(f, use_float = True):
+        n += 1
+    return n
+
+
+def bench(path, parse_events = False):
+    size_mb = os.path.getsize(path) / 1_000_000
+    results = []
+
+    for name, opener in READERS.items():
+        modes = [('read', drain)]
+        if name != 'text':
+            modes.append(('readinto', drain_into))
+        if parse_events:
+            modes.append(('ijson', parse))
+
+        for mode, fn in modes:
+            with opener(path) as f:
+                s = time.perf_counter()
+                fn(f)
+                td = time.perf_counter() - s
+
+            results.append((name, mode, round(size_mb / td, 1), round(td, 3)))
+            print(f'{name:<8}{mode:<10}{size_mb / td:>10.1f} MB/s{td:>10.3f} s')
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--file')
+    parser.add_argument('--parse', action = 'store_true', help = 'also time ijson.parse over each reader')
+    args = parser.parse_args()
+
+    bench(args.file, parse_events = args.parse)
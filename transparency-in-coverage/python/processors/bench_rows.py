@@ -0,0 +1,99 @@
+"""
+Times flattening in_network items into a `Row(filename, dict)` per row
+(`in_network_item_to_rows`) against appending tuples to a RowBatch, and
+counts the memory allocated and GC collections triggered per million
+rows. Items are read once and flattened `-r` times over.
+
+    python bench_rows.py -f test/test_file_1.json -r 20
+"""
+import gc
+import time
+import logging
+import argparse
+import tracemalloc
+
+from mrfutils import MRFOpen, MRFObjectBuilder, in_network_item_to_rows
+from rowbatch import RowBatch
+
+
+def load_items(loc):
+    with MRFOpen(loc) as f:
+        m = MRFObjectBuilder(f)
+        m.ffwd(('', 'map_key', 'provider_references'))
+        p_ref_map = m.build_provider_references(None)
+        m.ffwd(('', 'map_key', 'in_network'))
+        return list(m.in_network_items(None, None, p_ref_map))
+
+
+def dict_rows(items, repeat, batch_size):
+    n = 0
+    for _ in range(repeat):
+        rows = []
+        for item in items:
+            rows.extend(in_network_item_to_rows(item, 'root'))
+            if len(rows) >= batch_size:
+                n += len(rows)
+                rows = []
+        n += len(rows)
+    return n
+
+
+def batch_rows(items, repeat, batch_size):
+    n = 0
+    for _ in range(repeat):
+        batch = RowBatch()
+        for item in items:
+            batch.add_item(item, 'root')
+            if len(batch) >= batch_size:
+                n += len(batch)
+                batch = RowBatch()
+        n += len(batch)
+    return n
+
+
+def measure(fn, *args):
+    gc.collect()
+    collections = sum(s['collections'] for s in gc.get_stats())
+
+    s = time.perf_counter()
+    n = fn(*args)
+    elapsed = time.perf_counter() - s
+
+    collections = sum(s['collections'] for s in gc.get_stats()) - collections
+
+    # Separate run, tracemalloc slows allocation down a lot
+    tracemalloc.start()
+    fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return n, elapsed, collections, peak
+
+
+def bench(loc, repeat, batch_size):
+    items = load_items(loc)
+
+    print(f'{loc} x {repeat}, batches of {batch_size} rows')
+
+    for name, fn in (('dict rows', dict_rows), ('row batch', batch_rows)):
+        n, elapsed, collections, peak = measure(fn, items, repeat, batch_size)
+        per_million = 1_000_000 / n
+
+        print(f'  {name}:')
+        print(f'    rows:              {n}')
+        print(f'    s / M rows:        {elapsed * per_million:.2f}')
+        print(f'    gc runs / M rows:  {collections * per_million:.0f}')
+        print(f'    peak traced MB:    {peak / 1e6:.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--file', action = 'append')
+    parser.add_argument('-r', '--repeat', type = int, default = 20)
+    parser.add_argument('-b', '--batch-size', type = int, default = 10_000)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    for loc in args.file:
+        bench(loc, args.repeat, args.batch_size)
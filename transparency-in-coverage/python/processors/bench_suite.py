@@ -0,0 +1,181 @@
+"""
+Benchmarks `core.run` and `dialysis_example/core.stream_json_to_csv` on
+synthetic MRFs of different shapes (see synthetic.py). Every run happens
+in a fresh process so that peak RSS is its own. Files are served from a
+local HTTP server, which also stands in for remote provider references;
+`core.run` reads them from disk, `stream_json_to_csv` (which only takes
+URLs) over HTTP.
+
+    python bench_suite.py --scale 1 --json results.jsonl
+    python bench_suite.py -s baseline -s gzip -t run
+
+MB/s is uncompressed MB per second and items/s counts every in_network
+item in the file, kept or not.
+"""
+import os
+import json
+import time
+import logging
+import argparse
+import resource
+import tempfile
+import multiprocessing
+
+from synthetic import generate_mrf, serve_directory, synthetic_code, synthetic_npi
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+BASE_ITEMS = 2_000
+NPI_POOL = 10_000
+
+SHAPES = {
+    'baseline':          {},
+    'inline_groups':     {'reference_ratio': 0},
+    'all_references':    {'reference_ratio': 1},
+    'wide_items':        {'items_factor': 0.05, 'rates_per_item': 200},
+    'big_groups':        {'npis_per_group': 50},
+    'in_network_first':  {'references_first': False},
+    'rates_first':       {'rates_first': True},
+    'remote_references': {'n_remote_references': 20},
+    'gzip':              {'compression': 'gzip'},
+    'zstd':              {'compression': 'zstd'},
+}
+
+SUFFIXES = {None: '.json', 'gzip': '.json.gz', 'zstd': '.json.zst'}
+
+
+def filters(n_items):
+    """
+    Half of the NPIs and every other billing code
+    """
+    npi_set = {synthetic_npi(i) for i in range(NPI_POOL // 2)}
+    code_set = {synthetic_code(i) for i in range(0, n_items, 2)}
+    return npi_set, code_set
+
+
+def _child(target, loc, out_dir, n_items):
+    logging.disable(logging.CRITICAL)
+    npi_set, code_set = filters(n_items)
+
+    if target == 'run':
+        from core import run as fn
+        args = (loc, npi_set, code_set, out_dir)
+    else:
+        from dialysis_example.core import stream_json_to_csv as fn
+        args = (loc, out_dir, code_set, npi_set)
+
+    error = None
+    s = time.perf_counter()
+    try:
+        fn(*args)
+    except Exception as e:
+        # Some shapes aren't supported by every target; report, don't stop
+        error = f'{type(e).__name__}: {e}'
+
+    elapsed = time.perf_counter() - s
+    # ru_maxrss is in KB on Linux
+    return elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, error
+
+
+def measure(target, loc, out_dir, n_items):
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(1) as pool:
+        return pool.apply(_child, (target, loc, out_dir, n_items))
+
+
+def bench_shape(name, work_dir, base_url, scale, targets):
+    params = dict(SHAPES[name])
+    n_items = max(1, int(BASE_ITEMS * scale * params.pop('items_factor', 1)))
+    compression = params.get('compression')
+
+    shape_dir = os.path.join(work_dir, name)
+    os.makedirs(shape_dir)
+    filename = f'{name}{SUFFIXES[compression]}'
+    path = os.path.join(shape_dir, filename)
+
+    targets = [
+        t for t in targets
+        if t == 'run' or compression in (None, 'gzip')
+    ]
+
+    try:
+        info = generate_mrf(
+            path,
+            n_items = n_items,
+            npi_pool = NPI_POOL,
+            remote_base_url = f'{base_url}/{name}',
+            **params,
+        )
+    except ImportError as e:
+        # eg. zstd without the zstandard package; report, don't stop
+        error = f'{type(e).__name__}: {e}'
+        return [{'shape': name, 'target': target, 'error': error} for target in targets]
+
+    results = []
+
+    for target in targets:
+        loc = path if target == 'run' else f'{base_url}/{name}/{filename}'
+        out_dir = os.path.join(shape_dir, f'out_{target}')
+        os.makedirs(out_dir)
+        elapsed, peak_rss, error = measure(target, loc, out_dir, n_items)
+
+        results.append({
+            'shape':      name,
+            'target':     target,
+            'size_mb':    round(info['size'] / 1e6, 2),
+            'json_mb':    round(info['uncompressed_size'] / 1e6, 2),
+            'n_items':    n_items,
+            'n_rates':    info['n_rates'],
+            'secs':       round(elapsed, 3),
+            'mb_per_s':   round(info['uncompressed_size'] / 1e6 / elapsed, 2),
+            'items_per_s': round(n_items / elapsed, 1),
+            'peak_rss_mb': round(peak_rss / 1e6, 1),
+            'error':      error,
+        })
+
+    return results
+
+
+def print_results(results):
+    columns = ('shape', 'target', 'json_mb', 'secs', 'mb_per_s', 'items_per_s', 'peak_rss_mb')
+    print(''.join(f'{c:>20}' for c in columns))
+    for r in results:
+        if r['error']:
+            print(f"{r['shape']:>20}{r['target']:>20}  failed: {r['error']}")
+        else:
+            print(''.join(f'{r[c]:>20}' for c in columns))
+
+
+def main(shapes, scale = 1, targets = ('run', 'stream_json_to_csv'), json_path = None):
+    results = []
+
+    with tempfile.TemporaryDirectory() as work_dir, serve_directory(work_dir) as base_url:
+        for name in shapes:
+            shape_results = bench_shape(name, work_dir, base_url, scale, targets)
+            results.extend(shape_results)
+
+            if json_path:
+                with open(json_path, 'a') as f:
+                    for r in shape_results:
+                        f.write(json.dumps(r) + '\n')
+
+    print_results(results)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--shape', action = 'append', choices = list(SHAPES))
+    parser.add_argument('-t', '--target', action = 'append', choices = ('run', 'stream_json_to_csv'))
+    parser.add_argument('--scale', type = float, default = 1, help = f'multiple of {BASE_ITEMS} items')
+    parser.add_argument('--json', help = 'append results to this JSON-lines file')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    main(
+        args.shape or list(SHAPES),
+        scale = args.scale,
+        targets = args.target or ('run', 'stream_json_to_csv'),
+        json_path = args.json,
+    )
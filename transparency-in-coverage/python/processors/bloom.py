@@ -0,0 +1,275 @@
+"""
+Bloom filters of the NPIs and billing codes each MRF mentions, kept in
+the downloader catalogs, so that a new list of NPIs can rule files out
+without reading them.
+
+    python bloom.py ../downloaders/uhc_data.db -n npis.csv -c codes.csv
+
+A FileSummary taps the parser events of a run (`core.run(...,
+catalog_path = ...)`) or a probe (probe.py) and collects every NPI in
+provider_references and inline provider_groups, and every
+(billing_code_type, billing_code), before any filtering. Its filters
+go in an `in_network_blooms` table next to the catalog's
+`in_network_files`, one row per URL.
+
+A filter only rules a file out if it's complete: the whole file was
+read and, for NPIs, it has no remote provider references (which aren't
+summarized). `candidate_urls` keeps every other file.
+"""
+import math
+import time
+import struct
+import sqlite3
+import hashlib
+import logging
+import argparse
+
+from codes import CodeSet, import_code_spec
+from mrfutils import import_set, try_int
+
+log = logging.getLogger(__name__)
+
+ERROR_RATE = 0.01
+
+NPI_PREFIXES = (
+    'provider_references.item.provider_groups.item.npi.item',
+    'in_network.item.negotiated_rates.item.provider_groups.item.npi.item',
+)
+
+COLUMNS = (
+    'url',
+    'updated_at',
+    'source',
+    'npis_complete',
+    'codes_complete',
+    'npis',
+    'codes',
+    'npi_bloom',
+    'code_bloom',
+)
+
+_HEADER = struct.Struct('>QB')
+
+
+def npi_key(npi):
+    return str(npi)
+
+
+def code_key(billing_code_type, billing_code):
+    return f'{billing_code_type}:{billing_code}'
+
+
+def key_hashes(key):
+    """
+    The two hashes that a key's bit positions are made from, in any
+    size of filter
+    """
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size = 16).digest()
+    return int.from_bytes(digest[:8], 'big'), int.from_bytes(digest[8:], 'big') | 1
+
+
+class BloomFilter:
+    """
+    Set membership with false positives but no false negatives, in
+    `n_bits` bits with `n_hashes` positions per key
+    """
+
+    def __init__(self, n_bits, n_hashes, bits = None):
+        self.n_bits = n_bits
+        self.n_hashes = n_hashes
+        self.bits = bytearray(bits) if bits is not None else bytearray(n_bits // 8)
+
+    @classmethod
+    def for_keys(cls, keys, error_rate = ERROR_RATE):
+        """
+        A filter sized for `keys` (a collection) with them added
+        """
+        n = max(len(keys), 1)
+        n_bits = math.ceil(-n * math.log(error_rate) / math.log(2) ** 2)
+        n_bits = max(64, (n_bits + 7) // 8 * 8)
+        n_hashes = max(1, round(n_bits / n * math.log(2)))
+
+        bloom = cls(n_bits, n_hashes)
+        for key in keys:
+            bloom.add(key)
+        return bloom
+
+    def _positions(self, hashes):
+        h1, h2 = hashes
+        return ((h1 + i * h2) % self.n_bits for i in range(self.n_hashes))
+
+    def add(self, key):
+        for p in self._positions(key_hashes(key)):
+            self.bits[p >> 3] |= 1 << (p & 7)
+
+    def has_hashes(self, hashes):
+        bits = self.bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self._positions(hashes))
+
+    def __contains__(self, key):
+        return self.has_hashes(key_hashes(key))
+
+    def has_any(self, hashes):
+        """
+        True if any of the keys whose `key_hashes` are given may be in
+        the filter. Hashing a query once serves every filter.
+        """
+        return any(self.has_hashes(h) for h in hashes)
+
+    def to_bytes(self):
+        return _HEADER.pack(self.n_bits, self.n_hashes) + bytes(self.bits)
+
+    @classmethod
+    def from_bytes(cls, data):
+        n_bits, n_hashes = _HEADER.unpack_from(data)
+        return cls(n_bits, n_hashes, data[_HEADER.size:])
+
+
+class FileSummary:
+    """
+    The NPIs and billing codes seen in the parser events passed through
+    `tap`. `complete` is set by whoever reads the file, once all of it
+    has been.
+    """
+
+    def __init__(self):
+        self.npis = set()
+        self.codes = set()
+        self.remote_references = 0
+        self.complete = False
+
+    def tap(self, parser):
+        code_type = code = None
+
+        for row in parser:
+            prefix, event, value = row
+
+            if prefix in NPI_PREFIXES:
+                self.npis.add(try_int(value))
+
+            elif prefix == 'in_network.item.billing_code_type':
+                code_type = value
+
+            elif prefix == 'in_network.item.billing_code':
+                code = str(value)
+
+            elif (prefix, event) == ('in_network.item', 'start_map'):
+                code_type = code = None
+
+            elif prefix == 'provider_references.item.location':
+                self.remote_references += 1
+
+            if code_type is not None and code is not None:
+                self.codes.add((code_type, code))
+                code_type = code = None
+
+            yield row
+
+    def filters(self, error_rate = ERROR_RATE):
+        """
+        (NPI filter, billing code filter)
+        """
+        return (
+            BloomFilter.for_keys({npi_key(npi) for npi in self.npis}, error_rate),
+            BloomFilter.for_keys({code_key(*c) for c in self.codes}, error_rate),
+        )
+
+    def save(self, db_path, url, source = 'run'):
+        """
+        Stores the filters for `url` in the catalog at `db_path`, unless
+        it already has complete ones and these aren't
+        """
+        npi_bloom, code_bloom = self.filters()
+
+        con = sqlite3.connect(db_path, timeout = 60)
+        create_bloom_table(con)
+
+        existing = con.execute(
+            'SELECT codes_complete FROM in_network_blooms WHERE url = ?', (url,)
+        ).fetchone()
+
+        if existing and existing[0] and not self.complete:
+            log.info(f'Keeping the complete summary of {url}')
+        else:
+            con.execute(
+                f"INSERT OR REPLACE INTO in_network_blooms VALUES ({', '.join('?' * len(COLUMNS))})",
+                (
+                    url,
+                    time.time(),
+                    source,
+                    self.complete and not self.remote_references,
+                    self.complete,
+                    len(self.npis),
+                    len(self.codes),
+                    npi_bloom.to_bytes(),
+                    code_bloom.to_bytes(),
+                ),
+            )
+            con.commit()
+
+        con.close()
+
+
+def create_bloom_table(con):
+    con.execute(f"CREATE TABLE IF NOT EXISTS in_network_blooms({', '.join(COLUMNS)}, PRIMARY KEY (url))")
+
+
+def candidate_urls(db_path, npi_set = None, code_set = None):
+    """
+    URLs of the catalog's in_network_files that may mention any NPI in
+    `npi_set` and any code in `code_set`. Files without a complete
+    summary can't be ruled out and are always kept. Code ranges and
+    prefixes can't be looked up in a filter, so a `code_set` with any
+    is ignored.
+    """
+    npi_hashes = [key_hashes(npi_key(npi)) for npi in npi_set] if npi_set else None
+    code_hashes = None
+
+    if code_set:
+        code_set = CodeSet.compile(code_set)
+        if code_set.numeric or code_set.lexical:
+            log.warning('Code ranges and prefixes rule no files out')
+        else:
+            code_hashes = [key_hashes(code_key(*c)) for c in code_set.exact]
+
+    con = sqlite3.connect(db_path)
+    create_bloom_table(con)
+    rows = con.execute(
+        'SELECT url, npis_complete, codes_complete, npi_bloom, code_bloom '
+        'FROM in_network_files LEFT JOIN in_network_blooms USING (url)'
+    ).fetchall()
+    con.close()
+
+    urls = []
+    for url, npis_complete, codes_complete, npi_bloom, code_bloom in rows:
+        if npi_hashes is not None and npis_complete:
+            if not BloomFilter.from_bytes(npi_bloom).has_any(npi_hashes):
+                continue
+
+        if code_hashes is not None and codes_complete:
+            if not BloomFilter.from_bytes(code_bloom).has_any(code_hashes):
+                continue
+
+        urls.append(url)
+
+    log.info(f'{len(urls)} of {len(rows)} files may match')
+    return urls
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'List the catalog files that may mention some NPIs or codes')
+    parser.add_argument('catalog', help = 'SQLite file written by a downloader')
+    parser.add_argument('-n', '--npis', help = 'CSV of NPIs')
+    parser.add_argument('-c', '--codes', help = 'CSV of billing_code_type, billing_code')
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.INFO)
+
+    urls = candidate_urls(
+        args.catalog,
+        npi_set = import_set(args.npis) if args.npis else None,
+        code_set = import_code_spec(args.codes) if args.codes else None,
+    )
+
+    for url in urls:
+        print(url)
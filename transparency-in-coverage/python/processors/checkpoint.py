@@ -0,0 +1,142 @@
+"""
+Checkpoints for resuming a long `core.run` after a crash.
+
+Every `interval` seconds, after a batch has been written, the number of
+in_network items completed and the length of every output CSV are saved
+to `{out_dir}/.checkpoints/{key}.json`. On restart with `resume = True`,
+the CSVs are cut back to those lengths (dropping anything written after
+the checkpoint) and the run carries on after the completed items.
+
+Local uncompressed files are seeked in: the checkpoint also records
+the byte offset where the last completed item ended (`offset`), and the
+parser restarts there, after the root and provider references have been
+read again. Python's zlib can't restart inflating in the middle of a
+gzip member, and other compressed or remote files can't be seeked in
+either, so for those `offset` is None and the resumed run decompresses
+and parses up to the checkpoint, skipping the completed items without
+building them.
+"""
+import os
+import json
+import time
+import logging
+
+from mrfutils import hashdict
+from schema import SCHEMA
+
+log = logging.getLogger(__name__)
+
+
+def output_sizes(out_dir):
+    sizes = {}
+    for table in SCHEMA:
+        path = os.path.join(out_dir, f'{table}.csv')
+        sizes[table] = os.path.getsize(path) if os.path.exists(path) else None
+    return sizes
+
+
+def truncate_outputs(out_dir, sizes):
+    for table, size in sizes.items():
+        path = os.path.join(out_dir, f'{table}.csv')
+        if not os.path.exists(path):
+            continue
+        if size is None:
+            os.remove(path)
+        elif os.path.getsize(path) > size:
+            with open(path, 'r+b') as f:
+                f.truncate(size)
+
+
+class Checkpoint:
+
+    def __init__(self, out_dir, loc, interval = 60):
+        self.out_dir = out_dir
+        self.loc = loc
+        self.interval = interval
+        self.dir = os.path.join(out_dir, '.checkpoints')
+        self.path = os.path.join(self.dir, f"{hashdict({'loc': loc})}.json")
+        self.last_save = time.monotonic()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            return json.load(f)
+
+    def save(self, **state):
+        os.makedirs(self.dir, exist_ok = True)
+
+        # Rows have to be on disk before the checkpoint that counts them
+        for table, size in state['sizes'].items():
+            if size is not None:
+                with open(os.path.join(self.out_dir, f'{table}.csv'), 'rb') as f:
+                    os.fsync(f.fileno())
+
+        tmp = f'{self.path}.part'
+        with open(tmp, 'w') as f:
+            json.dump({'loc': self.loc, 'time': time.time(), **state}, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp, self.path)
+        self.last_save = time.monotonic()
+
+    def due(self):
+        return time.monotonic() - self.last_save >= self.interval
+
+
+class CheckpointSink:
+    """
+    Wraps a CSVSink and saves a checkpoint after a write once `interval`
+    seconds have passed and the source is between in_network items. Extra
+    pipeline stages mustn't hold batches back, or the checkpoint would
+    count items whose rows haven't been written.
+    """
+
+    def __init__(self, sink, source, checkpoint):
+        self.sink = sink
+        self.source = source
+        self.checkpoint = checkpoint
+
+    def restore(self, state):
+        """
+        Cuts the outputs back to `state` and sets the source and writer up
+        to carry on from there
+        """
+        truncate_outputs(self.sink.out_dir, state['sizes'])
+        self.source.skip_items = state['items_done']
+        self.source.resume_offset = state.get('offset')
+        self.sink.restored = state
+
+    def save(self, done = False):
+        writer = self.sink.writer
+        self.checkpoint.save(
+            items_done = self.source.items_done,
+            offset = self.source.item_offset(),
+            bytes_read = self.source.bytes_read(),
+            root_hash_key = self.source.root_hash_key,
+            root_data_written = bool(writer and writer.root_data_written),
+            written_references = list(writer.written_references) if writer else [],
+            sizes = output_sizes(self.sink.out_dir),
+            done = done,
+        )
+
+    def write(self, batch):
+        restored = self.sink.restored
+        if (
+            restored
+            and self.sink.writer is None
+            and restored['root_hash_key'] not in (None, self.source.root_hash_key)
+        ):
+            raise ValueError(
+                f'{self.source.loc} has changed since its checkpoint; delete {self.checkpoint.path} to start over'
+            )
+
+        self.sink.write(batch)
+
+        if self.checkpoint.due() and self.source.at_item_boundary:
+            self.save()
+            log.info(f'Checkpoint: {self.source.items_done} items of {self.source.loc}')
+
+    def close(self):
+        self.sink.close()
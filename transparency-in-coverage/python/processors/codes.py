@@ -0,0 +1,181 @@
+import re
+import csv
+from bisect import bisect_right
+
+# Upper bound for prefix intervals: every string that starts with `p`
+# sorts below `p + MAX_CHAR`
+MAX_CHAR = '\U0010ffff'
+
+# A range spec is two plain codes of the same length joined by one
+# hyphen. Anything else with a hyphen in it (NDC 12345-6789-01, say) is
+# an exact code
+RANGE_SPEC = re.compile(r'^(\w+)\s*-\s*(\w+)$')
+
+
+class IntervalIndex:
+    """
+    Sorted, merged list of closed intervals [lo, hi] with O(log n)
+    membership checks. Bounds only need to be comparable with each
+    other and with the keys being looked up.
+    """
+
+    def __init__(self):
+        self._pending = []
+        self.starts = []
+        self.ends = []
+
+    def add(self, lo, hi):
+        if hi < lo:
+            lo, hi = hi, lo
+        self._pending.append((lo, hi))
+
+    def _compile(self):
+        intervals = sorted(self._pending + list(zip(self.starts, self.ends)))
+        self._pending = []
+
+        starts, ends = [], []
+        for lo, hi in intervals:
+            if ends and lo <= ends[-1]:
+                ends[-1] = max(ends[-1], hi)
+            else:
+                starts.append(lo)
+                ends.append(hi)
+
+        self.starts, self.ends = starts, ends
+
+    def __contains__(self, key):
+        if self._pending:
+            self._compile()
+
+        i = bisect_right(self.starts, key) - 1
+        return i >= 0 and key <= self.ends[i]
+
+    def __len__(self):
+        if self._pending:
+            self._compile()
+        return len(self.starts)
+
+
+class CodeSet:
+    """
+    Set of (billing_code_type, billing_code) pairs that can also hold
+    ranges and prefixes of codes. Drop-in replacement for the set of
+    tuples passed around as `code_set`:
+
+        codes = CodeSet([('MS-DRG', '0001')])
+        codes.add_range('CPT', '90935', '90940')
+        codes.add_prefix('MS-DRG', '45')
+        ('CPT', '90937') in codes  # True
+
+    Ranges whose bounds are both numeric compare codes as integers, so
+    DRG '0945' and '945' fall in the same range. Other ranges and
+    prefixes compare codes as strings.
+    """
+
+    def __init__(self, codes = ()):
+        self.exact = set()
+        self.types = set()
+        self.numeric = {}
+        self.lexical = {}
+
+        for code_type, code in codes:
+            self.add(code_type, code)
+
+    @classmethod
+    def compile(cls, codes):
+        """
+        Returns `codes` unchanged if it's already a CodeSet, otherwise a
+        CodeSet of its (billing_code_type, billing_code) pairs
+        """
+        if isinstance(codes, cls):
+            return codes
+        return cls(codes)
+
+    @classmethod
+    def from_spec(cls, specs):
+        """
+        Builds a CodeSet from filter specs, either 'TYPE:CODES' strings or
+        (billing_code_type, codes) pairs, where CODES is one of
+
+            27447         an exact code
+            90935-90940   an inclusive range, when both ends have the
+                          same length
+            45*           a prefix
+            *             every code of the type
+
+        eg. CodeSet.from_spec(['CPT:90935-90940', 'MS-DRG:45*'])
+        """
+        codes = cls()
+
+        for spec in specs:
+            if isinstance(spec, str):
+                spec = spec.split(':', 1)
+            code_type, code_spec = spec
+            codes.add_spec(code_type.strip(), str(code_spec).strip())
+
+        return codes
+
+    def add_spec(self, code_type, code_spec):
+        if code_spec.endswith('*'):
+            self.add_prefix(code_type, code_spec[:-1])
+
+        elif (m := RANGE_SPEC.match(code_spec)) and len(m[1]) == len(m[2]):
+            self.add_range(code_type, m[1], m[2])
+
+        else:
+            self.add(code_type, code_spec)
+
+    def add(self, code_type, code):
+        self.exact.add((code_type, str(code)))
+        self.types.add(code_type)
+
+    def add_range(self, code_type, lo, hi):
+        lo, hi = str(lo), str(hi)
+        self.types.add(code_type)
+
+        if lo.isdigit() and hi.isdigit():
+            self.numeric.setdefault(code_type, IntervalIndex()).add(int(lo), int(hi))
+        else:
+            self.lexical.setdefault(code_type, IntervalIndex()).add(lo, hi)
+
+    def add_prefix(self, code_type, prefix):
+        prefix = str(prefix)
+        self.types.add(code_type)
+        self.lexical.setdefault(code_type, IntervalIndex()).add(prefix, prefix + MAX_CHAR)
+
+    def has_type(self, code_type):
+        """
+        False if no code of this type can be in the set, which lets an
+        item be skipped before its billing_code has been read
+        """
+        return code_type in self.types
+
+    def __contains__(self, billing_code_tup):
+        code_type, code = billing_code_tup
+        code = str(code)
+
+        if (code_type, code) in self.exact:
+            return True
+
+        if (idx := self.lexical.get(code_type)) and code in idx:
+            return True
+
+        if (idx := self.numeric.get(code_type)) and code.isdigit() and int(code) in idx:
+            return True
+
+        return False
+
+    def __bool__(self):
+        return bool(self.types)
+
+
+def import_code_spec(filename):
+    """
+    Reads a CSV with billing_code_type and billing_code columns, where
+    billing_code may be any spec accepted by `CodeSet.from_spec`
+    """
+    with open(filename, 'r') as f:
+        reader = csv.DictReader(f)
+        return CodeSet.from_spec(
+            (row['billing_code_type'], row['billing_code']) for row in reader
+        )
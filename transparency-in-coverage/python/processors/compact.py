@@ -0,0 +1,206 @@
+"""
+Compacts many small flattened outputs into one large, sorted,
+deduplicated CSV per table.
+
+    python compact.py -o compacted out_dir other_out_dir -j 4
+
+Inputs are directories of `{table}.csv` files, or ShardSets (directories
+with a manifest.jsonl, see shards.py), whose published shards are read
+in turn. Each table is compacted with an external merge sort:
+
+  1. rows are read `run_rows` at a time, sorted in memory and written to
+     a temporary run file
+  2. the runs are merged `fan_in` at a time (in several passes if there
+     are more) into `{dest_dir}/{table}.csv`
+
+Rows sort on their columns in order, so on their hash keys first, and a
+row equal to the one before it is dropped. Memory stays around
+`run_rows` rows per table however big the inputs are. Tables are
+independent and can be compacted in parallel with `jobs`.
+"""
+import os
+import csv
+import heapq
+import shutil
+import logging
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from schema import SCHEMA
+from shards import ShardSet
+
+log = logging.getLogger(__name__)
+
+TABLES = tuple(SCHEMA)
+
+RUN_ROWS = 200_000
+FAN_IN = 64
+
+
+def input_dirs(inputs):
+    """
+    Expands ShardSets into their published shard directories
+    """
+    dirs = []
+    for path in inputs:
+        shards = ShardSet(path)
+        if os.path.exists(shards.manifest_path):
+            dirs.extend(os.path.join(shards.shards_dir, e['key']) for e in shards.manifest())
+        else:
+            dirs.append(path)
+    return dirs
+
+
+def _read_rows(paths, table):
+    """
+    Yields the header, then the rows of every file
+    """
+    header = None
+
+    for path in paths:
+        with open(path, newline = '') as f:
+            reader = csv.reader(f)
+            first = next(reader, None)
+            if first is None:
+                continue
+
+            if header is None:
+                header = first
+                yield header
+            elif first != header:
+                raise ValueError(f'{path} has a different {table} header')
+
+            yield from reader
+
+
+def _write_run(rows, run_dir, n):
+    path = os.path.join(run_dir, f'run_{n}.csv')
+    with open(path, 'w', newline = '') as f:
+        csv.writer(f).writerows(rows)
+    return path
+
+
+def _iter_run(path):
+    with open(path, newline = '') as f:
+        yield from csv.reader(f)
+
+
+def _unique(rows):
+    last = None
+    for row in rows:
+        if row != last:
+            yield row
+            last = row
+
+
+def _merge_runs(paths, out_path, header = None):
+    """
+    Merges sorted runs into `out_path`, dropping duplicates. Returns the
+    number of rows written.
+    """
+    n = 0
+    with open(out_path, 'w', newline = '') as f:
+        writer = csv.writer(f)
+        if header:
+            writer.writerow(header)
+
+        for row in _unique(heapq.merge(*(_iter_run(p) for p in paths))):
+            writer.writerow(row)
+            n += 1
+    return n
+
+
+def compact_table(table, dirs, dest_dir, run_rows = RUN_ROWS, fan_in = FAN_IN):
+    """
+    Compacts `{dir}/{table}.csv` from every dir in `dirs` into
+    `{dest_dir}/{table}.csv`. Returns the row counts in and out, or None
+    if no input has the table.
+    """
+    paths = [p for d in dirs if os.path.exists(p := os.path.join(d, f'{table}.csv'))]
+    if not paths:
+        return None
+
+    run_dir = tempfile.mkdtemp(prefix = f'.compact_{table}_', dir = dest_dir)
+
+    try:
+        rows = _read_rows(paths, table)
+        header = next(rows, None)
+        if header is None:
+            return None
+
+        runs = []
+        rows_in = 0
+        chunk = []
+
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= run_rows:
+                chunk.sort()
+                runs.append(_write_run(_unique(chunk), run_dir, len(runs)))
+                rows_in += len(chunk)
+                chunk = []
+
+        chunk.sort()
+        runs.append(_write_run(_unique(chunk), run_dir, len(runs)))
+        rows_in += len(chunk)
+
+        # Merge passes until the rest fit in one
+        n = len(runs)
+        while len(runs) > fan_in:
+            merged = []
+            for i in range(0, len(runs), fan_in):
+                path = os.path.join(run_dir, f'run_{n}.csv')
+                n += 1
+                _merge_runs(runs[i:i + fan_in], path)
+                for p in runs[i:i + fan_in]:
+                    os.remove(p)
+                merged.append(path)
+            runs = merged
+
+        dest = os.path.join(dest_dir, f'{table}.csv')
+        rows_out = _merge_runs(runs, f'{dest}.part', header)
+        os.replace(f'{dest}.part', dest)
+    finally:
+        shutil.rmtree(run_dir, ignore_errors = True)
+
+    log.info(f'{table}: {rows_in} rows in, {rows_out} out')
+    return {'rows_in': rows_in, 'rows_out': rows_out}
+
+
+def compact(inputs, dest_dir, tables = TABLES, jobs = 1, run_rows = RUN_ROWS, fan_in = FAN_IN):
+    """
+    Compacts every table of `inputs` into `dest_dir`, `jobs` tables at a
+    time. Returns {table: {'rows_in', 'rows_out'}}.
+    """
+    dirs = input_dirs(inputs)
+    os.makedirs(dest_dir, exist_ok = True)
+    args = [(table, dirs, dest_dir, run_rows, fan_in) for table in tables]
+
+    if jobs > 1:
+        with ProcessPoolExecutor(jobs) as pool:
+            results = list(pool.map(compact_table, *zip(*args)))
+    else:
+        results = [compact_table(*a) for a in args]
+
+    return {table: r for table, r in zip(tables, results) if r is not None}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Merge, sort and deduplicate flattened outputs')
+    parser.add_argument('inputs', nargs = '+', help = 'output directories or ShardSets')
+    parser.add_argument('-o', '--out', required = True)
+    parser.add_argument('-t', '--table', action = 'append', choices = TABLES)
+    parser.add_argument('-j', '--jobs', type = int, default = 1)
+    parser.add_argument('--run-rows', type = int, default = RUN_ROWS, help = 'rows sorted in memory at a time')
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.INFO)
+
+    compact(
+        args.inputs,
+        args.out,
+        tables = args.table or TABLES,
+        jobs = args.jobs,
+        run_rows = args.run_rows,
+    )
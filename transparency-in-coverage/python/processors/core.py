@@ -1,30 +1,293 @@
-from mrfutils import MRFOpen, MRFObjectBuilder, MRFWriter
+import logging
+from functools import partial
 
-def run(loc, npi_set, code_set, out_dir):
+from pipeline import MRFSource, JSONLSource, CSVSink, StatsSink, run_pipeline
+from memory import MemoryBudget, MemoryBudgetExceeded
+from checkpoint import Checkpoint, CheckpointSink
+from shards import ShardSet, ShardLocked
+from dedup import KeyStore
+from stats import STREAM_GROUP_BY
+from bloom import FileSummary
 
-    with MRFOpen(loc) as f:
+log = logging.getLogger(__name__)
 
-        m = MRFObjectBuilder(f)
 
-        root_data, cur_row = m.build_root()
-        writer = MRFWriter(root_data)
+def run(
+    loc,
+    npi_set,
+    code_set,
+    out_dir,
+    pipelined = False,
+    price_filter = None,
+    defer_references = False,
+    stream_rates = False,
+    metrics_path = None,
+    profile_path = None,
+    memory_limit = None,
+    checkpoint_interval = None,
+    resume = False,
+    shard = False,
+    dedup_path = None,
+    stats_path = None,
+    stats_group_by = STREAM_GROUP_BY,
+    catalog_path = None,
+    limiter = None,
+    source_loc = None,
+):
+    """
+    Streams, filters and flattens the MRF at `loc` into CSVs in `out_dir`.
 
-        if cur_row == ('', 'map_key', 'provider_references'):
-            p_ref_map = m.build_provider_references(npi_set)
+    `stream_rates = True` writes rows as each negotiated rate closes
+    instead of building whole in_network items, which keeps memory flat
+    for items with millions of rates.
 
-            m.ffwd(('', 'map_key', 'in_network'))
-            for item in m.in_network_items(npi_set, code_set, p_ref_map):
-                writer.write_in_network_item(item, root_data, out_dir)
-            return
+    `metrics_path` and `profile_path` are passed to `run_pipeline`.
 
-        elif cur_row == ('', 'map_key', 'in_network'):
-            m.ffwd(('', 'map_key', 'provider_references'))
-            p_ref_map = m.build_provider_references(npi_set)
+    `memory_limit` (bytes of RSS) turns on a `memory.MemoryBudget`:
+    provider references spill to disk and rows are streamed per rate
+    once 80% of it is used, and the run stops with MemoryBudgetExceeded
+    (after logging a report) if it's reached anyway. Rows already
+    written stay in `out_dir`.
 
-    with MRFOpen(loc) as f:
+    `checkpoint_interval` (seconds) saves a checkpoint that often, and
+    `resume = True` carries on from the last one for `loc` in `out_dir`,
+    first cutting the CSVs back to where they were when it was saved
+    (see checkpoint.py). Files already finished are skipped.
 
-        m = MRFObjectBuilder(f)
+    `shard = True` writes the CSVs to a private directory and publishes
+    them to `{out_dir}/shards` once the file is done (see shards.py), so
+    that several processes can share `out_dir`. Files already published
+    are skipped, and a failed run leaves nothing behind unless it can be
+    resumed. `ShardSet(out_dir).merge()` puts the tables back together.
 
-        m.ffwd(('', 'map_key', 'in_network'))
-        for item in m.in_network_items(npi_set, code_set, p_ref_map):
-            writer.write_in_network_item(item, root_data, out_dir)
\ No newline at end of file
+    `dedup_path` is a `dedup.KeyStore` file shared across runs: items
+    and referenced provider groups written by an earlier run are left
+    out, with link rows in their place (see dedup.py).
+
+    `stats_path` writes no rows at all: they go straight into
+    `stats.RateStats` per `stats_group_by`, and only the summaries are
+    written, to that CSV. They're the same as `stats.aggregate_outputs`
+    would give for the rows, so `out_dir` isn't used.
+
+    `catalog_path` is a downloader's SQLite catalog: once the file has
+    been read, Bloom filters of every NPI and billing code in it are
+    stored there next to `loc` (see bloom.py).
+
+    `limiter` is a `readers.RateLimiter` that caps how fast a remote
+    `loc` is downloaded, eg. one shared by the workers of a crawl (see
+    schedule.py).
+
+    `source_loc` is read instead of `loc`, eg. a local copy of it, while
+    `loc` still names the file: its shard, checkpoint, KeyStore run and
+    catalog entry are all keyed on `loc`.
+    """
+    if stats_path and (shard or checkpoint_interval or resume or dedup_path):
+        raise ValueError('stats_path writes no rows to shard, checkpoint or deduplicate')
+
+    key_store = KeyStore(dedup_path, loc) if dedup_path else None
+
+    write = partial(
+        _write,
+        loc,
+        npi_set,
+        code_set,
+        pipelined = pipelined,
+        price_filter = price_filter,
+        defer_references = defer_references,
+        stream_rates = stream_rates,
+        metrics_path = metrics_path,
+        profile_path = profile_path,
+        memory_limit = memory_limit,
+        checkpoint_interval = checkpoint_interval,
+        resume = resume,
+        key_store = key_store,
+        stats_path = stats_path,
+        stats_group_by = stats_group_by,
+        catalog_path = catalog_path,
+        limiter = limiter,
+        source_loc = source_loc,
+    )
+
+    try:
+        if shard:
+            written = run_shard(
+                loc,
+                out_dir,
+                write,
+                resume = resume,
+                keep_failed = bool(checkpoint_interval or resume),
+            )
+        else:
+            written = write(out_dir)
+
+        # Only now can other runs rely on this one's rows
+        if key_store and written:
+            key_store.finish()
+        elif key_store and written is False:
+            key_store.forget()
+    finally:
+        if key_store:
+            key_store.close()
+
+
+def _write(
+    loc,
+    npi_set,
+    code_set,
+    out_dir,
+    pipelined,
+    price_filter,
+    defer_references,
+    stream_rates,
+    metrics_path,
+    profile_path,
+    memory_limit,
+    checkpoint_interval,
+    resume,
+    key_store,
+    stats_path,
+    stats_group_by,
+    catalog_path,
+    limiter,
+    source_loc,
+):
+    """
+    The body of `run`, writing to `out_dir`. Returns True once the file
+    is done.
+    """
+    source = MRFSource(
+        source_loc or loc,
+        npi_set = npi_set,
+        code_set = code_set,
+        price_filter = price_filter,
+        defer_references = defer_references,
+        stream_rates = stream_rates,
+        pipelined = pipelined,
+        budget = MemoryBudget(memory_limit) if memory_limit else None,
+        track_position = bool(checkpoint_interval or resume),
+        key_store = key_store,
+        summary = FileSummary() if catalog_path else None,
+        limiter = limiter,
+    )
+
+    if stats_path:
+        sink = StatsSink(source, stats_group_by)
+    else:
+        sink = CSVSink(out_dir, source)
+
+    if source.track_position:
+        checkpoint = Checkpoint(out_dir, loc, checkpoint_interval or 60)
+        sink = CheckpointSink(sink, source, checkpoint)
+        state = checkpoint.load() if resume else None
+
+        if state and state['done']:
+            log.info(f'Already done: {loc}')
+            return True
+
+        if state:
+            log.info(f"Resuming {loc} after {state['items_done']} items")
+            sink.restore(state)
+        else:
+            # Saved straight away, so that a crash before the first
+            # periodic checkpoint is rolled back too
+            sink.save()
+
+    if key_store:
+        # Rows written by an earlier attempt may have been cut back or
+        # thrown away, so its keys can't be trusted
+        key_store.forget()
+
+    if source.budget:
+        source.budget.start()
+
+    try:
+        run_pipeline(
+            source,
+            sink,
+            metrics_path = metrics_path,
+            profile_path = profile_path,
+        )
+
+        if source.track_position:
+            sink.save(done = True)
+
+        if stats_path:
+            n = sink.write_summaries(stats_path)
+            log.info(f'Wrote {n} summaries of {loc} to {stats_path}')
+
+        if catalog_path:
+            source.summary.save(catalog_path, loc)
+
+        return True
+    except MemoryBudgetExceeded as e:
+        log.critical(f'Stopped {loc}: {e.report}')
+        raise
+    finally:
+        if source.budget:
+            source.budget.stop()
+        if stats_path:
+            sink.aggregator.close()
+
+
+def run_shard(loc, out_dir, write, resume = False, keep_failed = False):
+    """
+    Calls `write(shard_dir)` with a private directory for `loc` and
+    publishes it to the ShardSet in `out_dir` if it returns. A failed
+    shard is deleted, unless `keep_failed` (it has a checkpoint to
+    resume from). Nothing is written if `loc` is already published or
+    another process is writing it.
+
+    Returns what `Shard.publish` does, or None if nothing was written.
+    """
+    shards = ShardSet(out_dir)
+
+    if shards.is_published(loc):
+        log.info(f'Already published: {loc}')
+        return
+
+    try:
+        with shards.open(loc) as shard:
+            if not resume:
+                shard.clear()
+
+            try:
+                write(shard.dir)
+            except BaseException:
+                if not keep_failed:
+                    shard.discard()
+                raise
+
+            return shard.publish()
+    except ShardLocked as e:
+        log.warning(e)
+
+
+def run_jsonl(
+    split_dir,
+    npi_set,
+    code_set,
+    out_dir,
+    price_filter = None,
+    defer_references = False,
+):
+    """
+    Same as `run`, but for a file that has already been split into JSONL
+    shards by splitter.py. Each line is parsed whole (with orjson, if it's
+    installed) instead of event by event.
+    """
+    source = JSONLSource(
+        split_dir,
+        npi_set = npi_set,
+        code_set = code_set,
+        price_filter = price_filter,
+        defer_references = defer_references,
+    )
+
+    run_pipeline(source, CSVSink(out_dir, source))
+
+
+def flatten_json(loc, out_dir, code_set = None, npi_set = None, memory_limit = None, stats_path = None):
+    """
+    Shorthand for `run` with the default options
+    """
+    run(loc, npi_set, code_set, out_dir, memory_limit = memory_limit, stats_path = stats_path)
@@ -0,0 +1,103 @@
+"""
+Cross-file deduplication with a persistent store of content keys.
+
+Plans from one insurer repeat the same in_network items and provider
+groups across hundreds of files, and every file's rows carry its own
+root_hash_key. With a KeyStore (`core.run(..., dedup_path = ...)`):
+
+  - an in_network item's in_network_hash_key is the `content_key` of the
+    whole item, root excluded. Its rows are written by the first file
+    that has it; every file, that one included, adds an
+    `in_network_links` row (root_hash_key, in_network_hash_key).
+  - a referenced provider group (with `defer_references`) is written by
+    the first file that has it; every file adds a `provider_group_links`
+    row pointing its (root_hash_key, provider_group_id) at the one that
+    was written.
+
+Keys claimed by a run only count for other runs once that run has
+finished (and, with `shard = True`, been published), so a failed run
+never hides rows that were never kept. Runs that overlap may both write
+the same content, which `compact.py` deduplicates.
+
+Items streamed per rate (`stream_rates`, or past a memory budget's soft
+limit) aren't whole when their rows are written, so they aren't
+deduplicated, but still get link rows.
+"""
+import json
+import sqlite3
+import hashlib
+
+
+def content_key(obj):
+    """
+    Hash of a JSON-able object, independent of key order
+    """
+    dumped = json.dumps(obj, sort_keys = True, separators = (',', ':'))
+    return hashlib.sha256(dumped.encode('utf-8')).hexdigest()[:16]
+
+
+class KeyStore:
+    """
+    Content keys seen so far, in a SQLite file that any number of runs
+    and processes can share. Each key is claimed by an `owner` (the file
+    being processed) and holds a small JSON value, eg. where the content
+    was written.
+
+    Every statement commits on its own, so no run holds the write lock
+    while it parses.
+    """
+
+    def __init__(self, path, owner):
+        self.path = path
+        self.owner = owner
+        self.conn = sqlite3.connect(path, timeout = 60, isolation_level = None)
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS keys '
+            '(key TEXT PRIMARY KEY, value TEXT, owner TEXT, done INTEGER) WITHOUT ROWID'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS keys_owner ON keys (owner, done)')
+        self.claimed = 0
+        self.hits = 0
+
+    def claim(self, key, value = True):
+        """
+        Returns the value stored with `key` if a finished run, or this
+        one, already has it. Otherwise claims `key` for this run with
+        `value` (which can't be None) and returns None: the caller writes
+        the content.
+        """
+        cursor = self.conn.execute(
+            'INSERT OR IGNORE INTO keys VALUES (?, ?, ?, 0)',
+            (key, json.dumps(value), self.owner),
+        )
+        if cursor.rowcount:
+            self.claimed += 1
+            return None
+
+        stored, owner, done = self.conn.execute(
+            'SELECT value, owner, done FROM keys WHERE key = ?', (key,)
+        ).fetchone()
+
+        # Still being written by another run, which may yet fail
+        if not done and owner != self.owner:
+            return None
+
+        self.hits += 1
+        return json.loads(stored)
+
+    def finish(self):
+        """
+        Makes this run's keys count for every run
+        """
+        self.conn.execute('UPDATE keys SET done = 1 WHERE owner = ? AND done = 0', (self.owner,))
+
+    def forget(self):
+        """
+        Drops keys left unfinished by an earlier attempt at this owner
+        """
+        self.conn.execute('DELETE FROM keys WHERE owner = ? AND done = 0', (self.owner,))
+
+    def close(self):
+        self.conn.close()
@@ -4,7 +4,7 @@ import logging
 import ijson
 import gzip
 from urllib.parse import urlparse
-from helpers import (
+from .helpers import (
     hashdict,
     build_root,
     build_provrefs,
@@ -13,6 +13,7 @@ from helpers import (
     innetwork_to_rows,
     rows_to_file,
     provrefs_to_idx,
+    CodeSet,
 )
 
 
@@ -69,6 +70,8 @@ def stream_json_to_csv(input_url, output_dir, code_list=None, npi_list=None):
     This streams through JSON, flattens it, and writes it to
     file
     """
+    if code_list:
+        code_list = CodeSet.compile(code_list)
 
     with requests.get(input_url, stream=True) as r:
 
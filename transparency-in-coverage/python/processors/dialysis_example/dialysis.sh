@@ -1,6 +1,12 @@
 #!/bin/bash
 
-for URL in $(cat urls.txt)
+# dialysis_example is a package of processors/, so run it from there
+cd "$(dirname "$0")/.."
+
+for URL in $(cat dialysis_example/urls.txt)
 do
-	screen -dm python3 process_dialysis.py -o dialysis --npi dialysis_npis.csv -u $URL
+	screen -dm python3 -m dialysis_example.process_dialysis -o dialysis --npi dialysis_example/dialysis_npis.csv -u $URL
 done
+
+# Once every screen session has finished:
+#   python3 shards.py dialysis
@@ -7,7 +7,9 @@ import ijson
 import requests
 import logging
 from urllib.parse import urlparse
-from schema import SCHEMA
+from codes import CodeSet
+
+from .schema import SCHEMA
 
 
 LOG = logging.getLogger(__name__)
@@ -24,12 +26,16 @@ def create_output_dir(output_dir, overwrite):
 
 
 def import_billing_codes(filename):
+    """
+    billing_code may be an exact code, a range (90935-90940) or a
+    prefix (45*). See CodeSet.from_spec.
+    """
     with open(filename, "r") as f:
         reader = csv.DictReader(f)
         codes = []
         for row in reader:
             codes.append((row["billing_code_type"], row["billing_code"]))
-    return codes
+    return CodeSet.from_spec(codes)
 
 
 def import_set(filename, ints=True):
@@ -85,11 +91,11 @@ def innetwork_to_rows(obj, root_hash_key):
         "billing_code_type_version": obj["billing_code_type_version"],
         "billing_code": obj["billing_code"],
         "description": obj["description"],
-        "root_hash_key": root_hash_key,
+        "root_hash_id": root_hash_key,
     }
 
     in_network_hash_key = hashdict(in_network_vals)
-    in_network_vals["in_network_hash_key"] = in_network_hash_key
+    in_network_vals["in_network_hash_id"] = in_network_hash_key
 
     rows.append(("in_network", in_network_vals))
 
@@ -101,9 +107,9 @@ def innetwork_to_rows(obj, root_hash_key):
                 "npi_numbers": provgroup["npi"],
                 # "tin_type": provgroup["tin"]["type"],
                 # "tin_value": provgroup["tin"]["value"],
-                "negotiated_rates_hash_key": neg_rates_hash_key,
-                "in_network_hash_key": in_network_hash_key,
-                "root_hash_key": root_hash_key,
+                "negotiated_rates_hash_id": neg_rates_hash_key,
+                "in_network_hash_id": in_network_hash_key,
+                "root_hash_id": root_hash_key,
             }
             rows.append(("provider_groups", provgroup_vals))
 
@@ -116,9 +122,9 @@ def innetwork_to_rows(obj, root_hash_key):
                 "additional_information": neg_price.get("additional_information", None),
                 "billing_code_modifier": bcm if (bcm := neg_price.get("billing_code_modifier", None)) else None,
                 "negotiated_rate": neg_price["negotiated_rate"],
-                "root_hash_key": root_hash_key,
-                "in_network_hash_key": in_network_hash_key,
-                "negotiated_rates_hash_key": neg_rates_hash_key,
+                "root_hash_id": root_hash_key,
+                "in_network_hash_id": in_network_hash_key,
+                "negotiated_rates_hash_id": neg_rates_hash_key,
             }
             rows.append(("negotiated_prices", neg_price_vals))
 
@@ -128,8 +134,8 @@ def innetwork_to_rows(obj, root_hash_key):
             "billing_code_type_version": bundle["billing_code_type_version"],
             "billing_code": bundle["billing_code"],
             "description": bundle["description"],
-            "root_hash_key": root_hash_key,
-            "in_network_hash_key": in_network_hash_key,
+            "root_hash_id": root_hash_key,
+            "in_network_hash_id": in_network_hash_key,
         }
         rows.append(("bundled_codes", bundle_vals))
 
@@ -179,6 +185,10 @@ def build_provrefs(init_row, parser, npi_list=None):
 
 
 def build_innetwork(init_row, parser, code_list=None, npi_list=None, provref_idx=None):
+    """
+    code_list is best passed as a CodeSet (see stream_json_to_csv), which
+    checks membership in O(log n) however many ranges it holds
+    """
     prefix, event, value = init_row
 
     builder = ijson.ObjectBuilder()
@@ -1,7 +1,14 @@
-from core import stream_json_to_csv
-from helpers import create_output_dir, import_set
+"""
+Run from processors/, as a module of the dialysis_example package:
+
+    python -m dialysis_example.process_dialysis -o dialysis -n dialysis_example/dialysis_npis.csv -u URL
+"""
 import logging
 import argparse
+from shards import ShardSet, ShardLocked
+
+from .core import stream_json_to_csv
+from .helpers import create_output_dir, import_set
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-u", "--url")
@@ -9,7 +16,7 @@ parser.add_argument("-o", "--out")
 parser.add_argument("-n", "--npi")
 args = parser.parse_args()
 
-logger = logging.getLogger("core")
+logger = logging.getLogger("dialysis_example.core")
 logger.setLevel(level=logging.DEBUG)
 
 output_dir = args.out
@@ -24,10 +31,25 @@ dialysis = [
 
 create_output_dir(output_dir, overwrite=False)
 
-try:
-    stream_json_to_csv(
-        args.url, output_dir=output_dir, code_list=dialysis, npi_list=npi_set
-    )
-except Exception as e:
-    logger.warn(f'Failed for {args.url}')
-    logger.warn(e)
\ No newline at end of file
+# Each URL is written to its own shard and only published when it's
+# done, so the processes started by dialysis.sh don't write over each
+# other. Merge them with `python shards.py dialysis`.
+shards = ShardSet(output_dir)
+
+if shards.is_published(args.url):
+    logger.info(f'Already published: {args.url}')
+else:
+    try:
+        with shards.open(args.url) as shard:
+            shard.clear()
+            try:
+                stream_json_to_csv(
+                    args.url, output_dir=shard.dir, code_list=dialysis, npi_list=npi_set
+                )
+                shard.publish()
+            except Exception as e:
+                shard.discard()
+                logger.warn(f'Failed for {args.url}')
+                logger.warn(e)
+    except ShardLocked as e:
+        logger.warn(e)
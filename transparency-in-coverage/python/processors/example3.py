@@ -1,10 +1,12 @@
 from core import flatten_json
-from helpers import import_set
+from mrfutils import import_set
 import argparse
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-u', '--url')
 parser.add_argument('-o', '--out')
+parser.add_argument('-m', '--memory', type = int, help = 'memory budget in MB')
+parser.add_argument('-s', '--stats', help = 'only write rate summaries per code, NPI and billing class to this CSV')
 args = parser.parse_args()
 
 obgyn_npi_set = import_set('data/obgyn_npi.csv')
@@ -23,5 +25,10 @@ c_sections = [
 ]
 
 flatten_json(
-    args.url, out_dir = args.out, code_set = c_sections, npi_set = npi_set
+    args.url,
+    out_dir = args.out,
+    code_set = c_sections,
+    npi_set = npi_set,
+    memory_limit = args.memory * 1_000_000 if args.memory else None,
+    stats_path = args.stats,
 )
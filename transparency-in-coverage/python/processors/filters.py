@@ -0,0 +1,81 @@
+from datetime import date
+
+
+class PriceFilter:
+    """
+    Declarative predicate on `negotiated_prices` entries, evaluated while
+    the file streams so that prices (and then whole negotiated rates)
+    that don't qualify are never kept:
+
+        PriceFilter(
+            billing_class = {'institutional'},
+            negotiated_type = {'negotiated', 'fee schedule'},
+            min_rate = 100,
+            expires_after = 'today',
+        )
+
+    Every condition that is set must hold. `expires_after` takes an ISO
+    date (or 'today') and keeps prices whose expiration_date is later;
+    MRF dates are ISO strings, so they're compared as such.
+    """
+
+    def __init__(
+        self,
+        billing_class = None,
+        negotiated_type = None,
+        min_rate = None,
+        max_rate = None,
+        expires_after = None,
+    ):
+        self.billing_class = set(billing_class) if billing_class else None
+        self.negotiated_type = set(negotiated_type) if negotiated_type else None
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+
+        if expires_after == 'today':
+            expires_after = date.today().isoformat()
+        self.expires_after = expires_after
+
+    @classmethod
+    def from_dict(cls, spec):
+        return cls(**spec) if spec else None
+
+    def __call__(self, neg_price):
+        if (
+            self.billing_class
+            and neg_price.get('billing_class') not in self.billing_class
+        ):
+            return False
+
+        if (
+            self.negotiated_type
+            and neg_price.get('negotiated_type') not in self.negotiated_type
+        ):
+            return False
+
+        rate = neg_price.get('negotiated_rate')
+
+        if self.min_rate is not None and (rate is None or rate < self.min_rate):
+            return False
+
+        if self.max_rate is not None and (rate is None or rate > self.max_rate):
+            return False
+
+        if (
+            self.expires_after
+            and str(neg_price.get('expiration_date', '')) <= self.expires_after
+        ):
+            return False
+
+        return True
+
+    def __bool__(self):
+        return any(
+            v is not None for v in (
+                self.billing_class,
+                self.negotiated_type,
+                self.min_rate,
+                self.max_rate,
+                self.expires_after,
+            )
+        )
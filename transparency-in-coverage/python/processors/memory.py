@@ -0,0 +1,164 @@
+"""
+Keeping a run inside a memory budget.
+
+A MemoryBudget samples the process RSS from a background thread. Code
+that can hold a lot in memory looks at it at natural checkpoints (each
+provider reference, each negotiated rate, each in_network item):
+
+  - past the soft limit (`soft_ratio` of the limit), it switches to a
+    cheaper strategy: provider references spill to a SpillDict on disk,
+    and MRFSource streams rows per negotiated rate instead of building
+    whole items
+  - past the limit, `check` raises MemoryBudgetExceeded with a report of
+    where the run was, so it stops cleanly instead of being OOM-killed
+"""
+import os
+import json
+import sqlite3
+import resource
+import tempfile
+import threading
+
+try:
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (ValueError, AttributeError, OSError):
+    PAGE_SIZE = 4096
+
+
+def current_rss():
+    """
+    Resident set size in bytes. Falls back to the peak where /proc
+    isn't available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        return peak_rss()
+
+
+def peak_rss():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # KB on Linux, bytes on macOS
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+
+class MemoryBudgetExceeded(Exception):
+
+    def __init__(self, report):
+        self.report = report
+        super().__init__(
+            f"RSS {report['rss_mb']} MB is over the {report['limit_mb']} MB budget: {report}"
+        )
+
+
+class MemoryBudget:
+    """
+    RSS limit in bytes, sampled every `interval` seconds. Use as a
+    context manager, or call `start` and `stop`.
+    """
+
+    def __init__(self, limit, soft_ratio = 0.8, interval = 0.1):
+        self.limit = limit
+        self.soft_limit = int(limit * soft_ratio)
+        self.interval = interval
+        self.rss = current_rss()
+        self.peak = self.rss
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        self.rss = current_rss()
+        self.peak = max(self.peak, self.rss)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self._sample()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    @property
+    def soft(self):
+        return self.rss >= self.soft_limit
+
+    def check(self, **context):
+        if self.rss >= self.limit:
+            # Sample again so that a stale reading never aborts a run
+            self._sample()
+            if self.rss >= self.limit:
+                raise MemoryBudgetExceeded(self.report(**context))
+
+    def report(self, **context):
+        return {
+            'rss_mb':   round(self.rss / 1e6, 1),
+            'peak_mb':  round(self.peak / 1e6, 1),
+            'limit_mb': round(self.limit / 1e6, 1),
+            **context,
+        }
+
+
+class SpillDict:
+    """
+    Dict-like map of provider_group_id to provider groups kept in a
+    temporary SQLite file instead of memory. Supports what the filters
+    and MRFWriter use: `in`, `get`, `[]`, `len` and `items`.
+    """
+
+    def __init__(self):
+        fd, self.path = tempfile.mkstemp(suffix = '.sqlite')
+        os.close(fd)
+        self.conn = sqlite3.connect(self.path, check_same_thread = False)
+        self.conn.execute('PRAGMA journal_mode = OFF')
+        self.conn.execute('PRAGMA synchronous = OFF')
+        self.conn.execute('CREATE TABLE refs (id PRIMARY KEY, groups TEXT)')
+        self.n = 0
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self.n += 1
+        self.conn.execute('INSERT OR REPLACE INTO refs VALUES (?, ?)', (key, json.dumps(value)))
+
+    def get(self, key, default = None):
+        row = self.conn.execute('SELECT groups FROM refs WHERE id = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def __getitem__(self, key):
+        if (value := self.get(key)) is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.conn.execute('SELECT 1 FROM refs WHERE id = ?', (key,)).fetchone() is not None
+
+    def __len__(self):
+        return self.n
+
+    def items(self):
+        for key, groups in self.conn.execute('SELECT id, groups FROM refs ORDER BY id'):
+            yield key, json.loads(groups)
+
+    def close(self):
+        self.conn.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
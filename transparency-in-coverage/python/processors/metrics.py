@@ -0,0 +1,148 @@
+"""
+Process-wide counters and timers for finding where a run spends its
+time. Code anywhere in the flattener records into `METRICS`:
+
+    METRICS.incr('items_kept')
+    with METRICS.timer('sink_write'):
+        ...
+
+and the numbers can be read with `METRICS.snapshot()` or appended to a
+JSON-lines file every few seconds by a `MetricsReporter` (see
+`pipeline.run_pipeline`). Counters that already exist elsewhere, like
+how far into a file a reader is, are registered with `track` and read
+only when a snapshot is taken.
+"""
+import json
+import time
+import threading
+from contextlib import contextmanager
+from collections import defaultdict
+
+# Parser events are counted locally and added to the counter in chunks
+EVENT_CHUNK = 10_000
+
+
+class Metrics:
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.start_time = time.perf_counter()
+        self.counters = defaultdict(int)
+        self.timers = defaultdict(lambda: [0, 0.0])
+        self.tracked = []
+        # Counting every parser event costs a generator step per event,
+        # so it's only done when asked for
+        self.count_events = False
+
+    def incr(self, name, n = 1):
+        self.counters[name] += n
+
+    def add_time(self, name, secs):
+        timer = self.timers[name]
+        timer[0] += 1
+        timer[1] += secs
+
+    @contextmanager
+    def timer(self, name):
+        s = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - s)
+
+    def track(self, name, fn):
+        """
+        Adds `fn()` to counter `name` in every snapshot until `untrack`
+        """
+        self.tracked.append((name, fn))
+
+    def untrack(self, name, fn):
+        """
+        Stops calling `fn` and adds its last value to the counter for good
+        """
+        self.tracked.remove((name, fn))
+        self.counters[name] += _value(fn)
+
+    def counted(self, name, iterable):
+        n = 0
+        try:
+            for x in iterable:
+                n += 1
+                if n == EVENT_CHUNK:
+                    self.counters[name] += n
+                    n = 0
+                yield x
+        finally:
+            self.counters[name] += n
+
+    def snapshot(self):
+        elapsed = time.perf_counter() - self.start_time
+
+        counters = dict(self.counters)
+        for name, fn in list(self.tracked):
+            counters[name] = counters.get(name, 0) + _value(fn)
+
+        return {
+            'time':     time.time(),
+            'elapsed':  round(elapsed, 3),
+            'counters': counters,
+            'rates':    {
+                name: round(v / elapsed, 1) for name, v in counters.items()
+            } if elapsed > 0 else {},
+            'timers':   {
+                name: {'calls': calls, 'secs': round(secs, 4)}
+                for name, (calls, secs) in dict(self.timers).items()
+            },
+        }
+
+    def dump(self, f):
+        f.write(json.dumps(self.snapshot()) + '\n')
+        f.flush()
+
+
+def _value(fn):
+    try:
+        return fn() or 0
+    except (OSError, ValueError):
+        return 0
+
+
+METRICS = Metrics()
+
+
+class MetricsReporter:
+    """
+    Appends a snapshot of `metrics` to `path` every `interval` seconds
+    from a daemon thread, and once more on `stop`
+    """
+
+    def __init__(self, path, interval = 10, metrics = METRICS):
+        self.path = path
+        self.interval = interval
+        self.metrics = metrics
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self, f):
+        while not self._stop.wait(self.interval):
+            self.metrics.dump(f)
+
+    def start(self):
+        self.f = open(self.path, 'a')
+        self._thread = threading.Thread(target = self._run, args = (self.f,), daemon = True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.metrics.dump(self.f)
+        self.f.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
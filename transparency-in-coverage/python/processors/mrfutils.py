@@ -1,3 +1,4 @@
+import io
 import os
 import csv
 import glob
@@ -5,11 +6,22 @@ import hashlib
 import json
 import ijson
 import requests
-import gzip
 import logging
 from urllib.parse import urlparse
-from pathlib import Path
 from schema import SCHEMA
+from codes import CodeSet
+from metrics import METRICS
+from memory import SpillDict
+from dedup import content_key
+from readers import (
+    MmapReader,
+    PipelinedReader,
+    READ_BUFFER_SIZE,
+    SNIFF_SIZE,
+    ThrottledReader,
+    sniff_compression,
+    open_decompressed,
+)
 
 log = logging.getLogger()
 logging.basicConfig(level=logging.INFO)
@@ -22,6 +34,15 @@ log.addHandler(file_handler)
 from collections import namedtuple
 Row = namedtuple('Row', ['filename', 'data'])
 
+IN_NETWORK_FIELDS = (
+    'negotiation_arrangement',
+    'name',
+    'billing_code_type',
+    'billing_code_type_version',
+    'billing_code',
+    'description',
+)
+
 
 def data_import(filename):
 
@@ -36,6 +57,15 @@ def data_import(filename):
         return objs
 
 
+def import_set(filename, ints = True):
+    """
+    Reads the first column of a CSV (eg. a list of NPIs) into a set
+    """
+    with open(filename, 'r') as f:
+        reader = csv.reader(f)
+        return {int(row[0]) if ints else row[0] for row in reader if row}
+
+
 def hashdict(data):
 
     if not data:
@@ -48,9 +78,7 @@ def hashdict(data):
     return dict_hash
 
 
-def in_network_item_to_rows(item, root_hash_key):
-
-    rows = []
+def in_network_row(item, root_hash_key):
 
     in_network_vals = {
         'negotiation_arrangement':   item['negotiation_arrangement'],
@@ -65,39 +93,59 @@ def in_network_item_to_rows(item, root_hash_key):
     in_network_hash_key = hashdict(in_network_vals)
     in_network_vals['in_network_hash_key'] = in_network_hash_key
 
-    rows.append(Row('in_network', in_network_vals))
+    return Row('in_network', in_network_vals)
 
-    for neg_rate in item.get('negotiated_rates', []):
-        neg_rates_hash_key = hashdict(neg_rate)
-
-        for provider_group in neg_rate['provider_groups']:
-            provider_group_vals = {
-                'npi_numbers':               provider_group['npi'],
-                'tin_type':                  provider_group['tin']['type'],
-                'tin_value':                 provider_group['tin']['value'],
-                'negotiated_rates_hash_key': neg_rates_hash_key,
-                'in_network_hash_key':       in_network_hash_key,
-                'root_hash_key':             root_hash_key,
-            }
-
-            rows.append(Row('provider_groups', provider_group_vals))
-
-        for neg_price in neg_rate['negotiated_prices']:
-
-            neg_price_vals = {
-                'billing_class':             neg_price['billing_class'],
-                'negotiated_type':           neg_price['negotiated_type'],
-                'expiration_date':           neg_price['expiration_date'],
-                'negotiated_rate':           neg_price['negotiated_rate'],
-                'in_network_hash_key':       in_network_hash_key,
-                'negotiated_rates_hash_key': neg_rates_hash_key,
-                'service_code':              None if not (v := neg_price.get('service_code')) else v,
-                'additional_information':    neg_price.get('additional_information'),
-                'billing_code_modifier':     None if not (v := neg_price.get('billing_code_modifier')) else v,
-                'root_hash_key':             root_hash_key,
-            }
-
-            rows.append(Row('negotiated_prices', neg_price_vals))
+
+def negotiated_rate_to_rows(neg_rate, in_network_hash_key, root_hash_key):
+
+    rows = []
+    neg_rates_hash_key = hashdict(neg_rate)
+
+    for provider_group in neg_rate.get('provider_groups', []):
+        provider_group_vals = {
+            'npi_numbers':               provider_group['npi'],
+            'tin_type':                  provider_group['tin']['type'],
+            'tin_value':                 provider_group['tin']['value'],
+            'negotiated_rates_hash_key': neg_rates_hash_key,
+            'in_network_hash_key':       in_network_hash_key,
+            'root_hash_key':             root_hash_key,
+        }
+
+        rows.append(Row('provider_groups', provider_group_vals))
+
+    # Only left on the rate with defer_references; the groups
+    # themselves are written once by MRFWriter
+    for provider_group_id in neg_rate.get('provider_references', []):
+        rows.append(Row('provider_references', {
+            'provider_group_id':         provider_group_id,
+            'negotiated_rates_hash_key': neg_rates_hash_key,
+            'in_network_hash_key':       in_network_hash_key,
+            'root_hash_key':             root_hash_key,
+        }))
+
+    for neg_price in neg_rate['negotiated_prices']:
+
+        neg_price_vals = {
+            'billing_class':             neg_price['billing_class'],
+            'negotiated_type':           neg_price['negotiated_type'],
+            'expiration_date':           neg_price['expiration_date'],
+            'negotiated_rate':           neg_price['negotiated_rate'],
+            'in_network_hash_key':       in_network_hash_key,
+            'negotiated_rates_hash_key': neg_rates_hash_key,
+            'service_code':              None if not (v := neg_price.get('service_code')) else v,
+            'additional_information':    neg_price.get('additional_information'),
+            'billing_code_modifier':     None if not (v := neg_price.get('billing_code_modifier')) else v,
+            'root_hash_key':             root_hash_key,
+        }
+
+        rows.append(Row('negotiated_prices', neg_price_vals))
+
+    return rows
+
+
+def bundled_code_rows(item, in_network_hash_key, root_hash_key):
+
+    rows = []
 
     for bundle in item.get('bundled_codes', []):
 
@@ -115,62 +163,404 @@ def in_network_item_to_rows(item, root_hash_key):
     return rows
 
 
+def in_network_item_to_rows(item, root_hash_key):
+
+    in_network = in_network_row(item, root_hash_key)
+    in_network_hash_key = in_network.data['in_network_hash_key']
+
+    rows = [in_network]
+
+    for neg_rate in item.get('negotiated_rates', []):
+        rows.extend(negotiated_rate_to_rows(neg_rate, in_network_hash_key, root_hash_key))
+
+    rows.extend(bundled_code_rows(item, in_network_hash_key, root_hash_key))
+
+    return rows
+
+
+def build_remote_reference(loc, npi_set):
+
+    with MRFOpen(loc) as f:
+        builder = ijson.ObjectBuilder()
+
+        parser = ijson.parse(f, use_float = True)
+        for prefix, event, value in parser:
+
+            if (
+                prefix.endswith('npi.item') 
+                and npi_set
+                and not value in npi_set
+            ):
+                continue
+
+            elif (
+                prefix.endswith('provider_groups.item') 
+                and event == 'end_map'
+            ):
+                if not builder.value['provider_groups'][-1]['npi']:
+                    builder.value['provider_groups'].pop()
+
+            builder.event(event, value)
+
+    return builder.value
+
+
+def build_remote_provider_references(remote_provider_references, npi_set):
+
+    new_provider_references = []
+
+    for pref in remote_provider_references:
+        loc = pref.get('location')
+        try:
+            remote_reference = build_remote_reference(loc, npi_set)
+            remote_reference['provider_group_id'] = pref['provider_group_id']
+            new_provider_references.append(remote_reference)
+        except Exception as e:
+            log.warn('Error retrieving remote provider references')
+            log.warn(loc)
+            log.warn(e)
+            pass
+
+    return new_provider_references
+
+
+def try_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def filter_provider_groups(provider_groups, npi_set):
+    """
+    Drops NPIs that aren't in `npi_set` (if given), then any provider
+    group that is left without NPIs
+    """
+    kept = []
+
+    for provider_group in provider_groups:
+        if npi_set:
+            provider_group['npi'] = [npi for npi in provider_group['npi'] if npi in npi_set]
+
+        if provider_group['npi']:
+            kept.append(provider_group)
+
+    return kept
+
+
+def filter_provider_reference(provider_reference, npi_set):
+    provider_reference['provider_groups'] = filter_provider_groups(
+        provider_reference.get('provider_groups', []), npi_set
+    )
+
+    if provider_reference['provider_groups']:
+        return provider_reference
+
+
+def filter_negotiated_rate(
+    neg_rate,
+    npi_set,
+    provider_references_map,
+    price_filter = None,
+    defer_references = False,
+):
+    """
+    Filters one negotiated rate dict the way `in_network_items` does.
+    Returns the rate, or None if it should be dropped.
+    """
+    if price_filter:
+        neg_rate['negotiated_prices'] = [
+            neg_price for neg_price in neg_rate.get('negotiated_prices', [])
+            if price_filter(neg_price)
+        ]
+        if not neg_rate['negotiated_prices']:
+            return
+
+    if 'provider_groups' in neg_rate:
+        neg_rate['provider_groups'] = filter_provider_groups(neg_rate['provider_groups'], npi_set)
+
+    for neg_price in neg_rate.get('negotiated_prices', []):
+        if 'service_code' in neg_price:
+            neg_price['service_code'] = [
+                try_int(v) for v in neg_price['service_code']
+            ]
+
+    if defer_references:
+        refs = [
+            ref for ref in neg_rate.pop('provider_references', [])
+            if provider_references_map and ref in provider_references_map
+        ]
+
+        if refs:
+            neg_rate['provider_references'] = refs
+        elif not neg_rate.get('provider_groups'):
+            return
+
+        return neg_rate
+
+    provider_groups = []
+    if provider_references_map:
+        for ref in neg_rate.get('provider_references', []):
+            if (grps := provider_references_map.get(ref)):
+                provider_groups.extend(grps)
+
+    if neg_rate.get('provider_references'):
+        neg_rate.pop('provider_references')
+
+    neg_rate.setdefault('provider_groups', [])
+    neg_rate['provider_groups'].extend(provider_groups)
+
+    if not neg_rate['provider_groups']:
+        return
+
+    return neg_rate
+
+
+def filter_in_network_item(
+    item,
+    npi_set,
+    code_set,
+    provider_references_map,
+    price_filter = None,
+    defer_references = False,
+):
+    """
+    Applies the same filtering and provider reference merging as
+    `MRFObjectBuilder.in_network_items` to an in_network item that has
+    already been parsed into a dict (eg. a line of splitter.py output).
+    Returns the item, or None if nothing in it should be kept.
+    """
+    billing_code_tup = item['billing_code_type'], str(item['billing_code'])
+
+    if code_set and billing_code_tup not in code_set:
+        log.debug(f'Skipping: {billing_code_tup}')
+        METRICS.incr('items_skipped')
+        return
+
+    if 'negotiated_rates' not in item:
+        METRICS.incr('items_kept')
+        return item
+
+    negotiated_rates = []
+
+    for neg_rate in item['negotiated_rates']:
+        if (neg_rate := filter_negotiated_rate(
+            neg_rate, npi_set, provider_references_map, price_filter, defer_references
+        )):
+            negotiated_rates.append(neg_rate)
+
+    if not negotiated_rates:
+        log.debug(f"No rates for {billing_code_tup}")
+        METRICS.incr('items_empty')
+        return
+
+    item['negotiated_rates'] = negotiated_rates
+    log.debug(f"Found: {billing_code_tup}")
+    METRICS.incr('items_kept')
+    return item
+
+
 class InvalidMRF(Exception):
     pass
 
 
 class MRFOpen:
+    """
+    Context manager that opens a local or remote MRF for streaming.
+
+    Compression is detected from the first bytes of the file, so gzip,
+    zstd, xz, bz2 and zip files are all read through a streaming
+    decompressor regardless of what they are named.
+
+    With `pipelined = True`, gzipped files are inflated on a background
+    thread (see `readers.PipelinedReader`) so that decompression overlaps
+    with parsing. `external_gunzip = True` additionally lets that reader
+    hand decompression off to `igzip`/`pigz` when one is installed.
 
-    def __init__(self, loc):
+    Local uncompressed files are memory-mapped (see `readers.MmapReader`)
+    and handed to the parser as bytes, so `tell()` and `seek()` on the
+    returned file work in byte offsets.
+
+    A `readers.RateLimiter` caps how fast remote files are downloaded.
+    """
+
+    def __init__(self, loc, pipelined = False, external_gunzip = False, limiter = None):
         self.loc = loc
+        self.pipelined = pipelined
+        self.external_gunzip = external_gunzip
+        self.limiter = limiter
         self.f = None
         self.r = None
-        self.suffix = ''.join(Path(urlparse(self.loc).path).suffixes)
+        self.src = None
+        self.extra = None
+        self.compression = None
+        self.is_remote = urlparse(self.loc).scheme in ('http', 'https')
 
-        if self.suffix not in ('.json.gz', '.json'):
-            log.critical(f'Not JSON: {self.loc}')
-            raise InvalidMRF
+    def _open_source(self):
+        if self.is_remote:
+            self.r = requests.get(self.loc, stream = True)
+            # Undo any HTTP Content-Encoding; file-level compression is
+            # detected below
+            self.r.raw.decode_content = True
+            # Let io.BufferedReader drain its buffer after the socket closes
+            self.r.raw.auto_close = False
+
+            raw = self.r.raw
+            if self.limiter:
+                raw = ThrottledReader(raw, self.limiter)
+            return io.BufferedReader(raw, buffer_size = READ_BUFFER_SIZE)
+
+        return open(self.loc, 'rb', buffering = READ_BUFFER_SIZE)
 
     def __enter__(self):
-        is_remote = urlparse(self.loc).scheme in ('http', 'https')
+        self.src = self._open_source()
 
-        if is_remote:
-            self.r = requests.get(self.loc, stream = True)
+        try:
+            head = self.src.peek(SNIFF_SIZE)[:SNIFF_SIZE]
+        except Exception as e:
+            log.critical(e)
+            raise InvalidMRF
 
-        if self.suffix == '.json.gz':
-            if is_remote:
-                self.f = gzip.GzipFile(fileobj = self.r.raw)
+        self.compression = sniff_compression(head)
+
+        if self.compression is None and head.lstrip()[:1] not in (b'{', b'['):
+            log.critical(f'Not JSON: {self.loc}')
+            raise InvalidMRF
+
+        if self.compression == 'gzip' and self.pipelined:
+            if self.is_remote:
+                self.f = PipelinedReader(fileobj = self.src, external = self.external_gunzip)
             else:
-                self.f = gzip.open(self.loc, 'r')
+                self.src.close()
+                self.f = PipelinedReader(path = self.loc, external = self.external_gunzip)
+
+        elif self.compression:
             try:
-                self.f.read(1)
+                self.f, self.extra = open_decompressed(self.src, self.compression)
             except Exception as e:
                 log.critical(e)
                 raise InvalidMRF
+
+        elif self.is_remote:
+            self.f = self.src
+
         else:
-            if is_remote:
-                self.r.raw.decode_content = True
-                self.f = self.r.raw
-            else:
-                self.f = open(self.loc, 'r')
+            self.src.close()
+            self.f = MmapReader(self.loc)
+
+        if self.compression:
+            # The name doesn't matter, but what's inside has to be JSON
+            try:
+                inner = self.f.peek(SNIFF_SIZE)
+            except Exception as e:
+                log.critical(e)
+                raise InvalidMRF
+
+            if inner.lstrip()[:1] not in (b'{', b'['):
+                log.critical(f'Not JSON inside {self.compression}: {self.loc}')
+                raise InvalidMRF
 
         log.info(f'Succesfully opened file: {self.loc}')
-        return self.f
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
+        METRICS.track('bytes_read', self.bytes_read)
+        METRICS.track('bytes_decompressed', self.bytes_decompressed)
 
+        return self.f
+
+    def bytes_read(self):
+        """
+        Bytes taken from the file or socket so far, before decompression
+        """
+        if isinstance(self.f, PipelinedReader):
+            return self.f.bytes_in
         if self.r:
-            self.r.close()
+            return self.r.raw.tell()
+        if not self.src.closed:
+            return self.src.tell()
+        return self.f.tell()
+
+    def bytes_consumed(self):
+        """
+        Bytes of the file handed on to the decompressor (or the parser,
+        for an uncompressed file) so far. Unlike `bytes_read`, this leaves
+        out what is still waiting in the read buffer.
+        """
+        if isinstance(self.f, PipelinedReader):
+            return self.f.bytes_in
+        if not self.src.closed:
+            return self.src.tell()
+        return self.f.tell()
+
+    def bytes_decompressed(self):
+        if isinstance(self.f, PipelinedReader):
+            return self.f.bytes_out
+        return self.f.tell()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
 
         if self.f:
+            METRICS.untrack('bytes_read', self.bytes_read)
+            METRICS.untrack('bytes_decompressed', self.bytes_decompressed)
+
             self.f.close()
 
+        if self.extra:
+            self.extra.close()
+
+        if self.src:
+            self.src.close()
+
+        if self.r:
+            self.r.close()
+
 
 class MRFObjectBuilder:
 
 
-    def __init__(self, f):
+    def __init__(self, f, budget = None, track_items = False, summary = None):
         self.parser = ijson.parse(f, use_float = True)
+        # Optional memory.MemoryBudget, checked at each provider
+        # reference and negotiated rate
+        self.budget = budget
+
+        if METRICS.count_events:
+            self.parser = METRICS.counted('ijson_events', self.parser)
+
+        # Counting in_network items as the parser passes them lets a
+        # checkpoint say how far into the file a run is
+        self.items_started = 0
+        self.items_ended = 0
+
+        if track_items:
+            self.parser = self._track_items(self.parser)
+
+        # Optional bloom.FileSummary, which sees every event before any
+        # filtering
+        if summary is not None:
+            self.parser = summary.tap(self.parser)
+
+
+    def _track_items(self, parser):
+        for row in parser:
+            if row[0] == 'in_network.item':
+                if row[1] == 'start_map':
+                    self.items_started += 1
+                elif row[1] == 'end_map':
+                    self.items_ended += 1
+            yield row
+
+
+    def skip_items(self, n):
+        """
+        Passes over the first `n` in_network items without building them.
+        Needs `track_items = True` and the parser to be at in_network.
+        """
+        if n <= 0:
+            return
+
+        for _ in self.parser:
+            if self.items_ended >= n:
+                return
 
 
     def ffwd(self, to_row):
@@ -194,41 +584,147 @@ class MRFObjectBuilder:
             raise InvalidMRF
 
 
-    def in_network_items(self, npi_set, code_set, provider_references_map):
+    def _prefilter_codes(self, code_set):
+        """
+        Passes parser events through, except for in_network items whose
+        billing code isn't in `code_set`. An item's events are held back
+        until its billing_code_type and billing_code have both been seen,
+        and a rejected item is skipped without building any of it.
+
+        If negotiated_rates starts before the code is known, the held
+        events are released so that the rates aren't buffered, and a
+        ('in_network.item', 'discard', None) event is sent if the item
+        turns out to be unwanted.
+        """
+        pending = None
+
+        for row in self.parser:
+            prefix, event, value = row
+
+            if pending is None and (prefix, event) == ('in_network.item', 'start_map'):
+                pending = [row]
+                streaming = False
+                billing_code_type = billing_code = None
+                continue
+
+            if pending is None:
+                yield row
+                if (prefix, event) == ('in_network', 'end_array'):
+                    return
+                continue
+
+            if prefix == 'in_network.item.billing_code_type' and event != 'map_key':
+                billing_code_type = value
+            elif prefix == 'in_network.item.billing_code' and event != 'map_key':
+                billing_code = str(value)
+
+            if billing_code_type is not None and not code_set.has_type(billing_code_type):
+                keep = False
+            elif billing_code_type is not None and billing_code is not None:
+                keep = (billing_code_type, billing_code) in code_set
+            elif (prefix, event) == ('in_network.item', 'end_map'):
+                keep = True
+            else:
+                keep = None
+
+            if keep is None:
+                if streaming:
+                    yield row
+                elif (prefix, event) == ('in_network.item.negotiated_rates', 'start_array'):
+                    yield from pending
+                    yield row
+                    pending = []
+                    streaming = True
+                else:
+                    pending.append(row)
+                continue
+
+            if keep:
+                yield from pending
+                yield row
+            else:
+                log.debug(f'Skipping: {billing_code_type, billing_code}')
+                METRICS.incr('items_skipped')
+                if streaming:
+                    yield ('in_network.item', 'discard', None)
+                if (prefix, event) != ('in_network.item', 'end_map'):
+                    self.ffwd(('in_network.item', 'end_map', None))
+
+            pending = None
+
+
+    def _skip_item(self, events):
+        # Stops early on a discard too: the prefilter swallows the rest of
+        # a discarded item itself
+        for prefix, event, value in events:
+            if (prefix, event) in (
+                ('in_network.item', 'end_map'),
+                ('in_network.item', 'discard'),
+            ):
+                break
+
+
+    def _skip_rate(self, events):
+        for prefix, event, value in events:
+            if (prefix, event) == ('in_network.item.negotiated_rates.item', 'end_map'):
+                break
+
+
+    def in_network_items(
+        self,
+        npi_set,
+        code_set,
+        provider_references_map,
+        price_filter = None,
+        defer_references = False,
+    ):
+        """
+        Yields the in_network items that match the filters, with the
+        groups of their provider_references merged into provider_groups.
+
+        With `defer_references = True`, rates keep a `provider_references`
+        list of the group ids that are in `provider_references_map`
+        instead, so that referenced groups aren't copied into every rate
+        that uses them (see MRFWriter).
+        """
+        # Items are built in a list of their own, so that this can start
+        # at any item boundary (eg. after skip_items), not only at the
+        # start of the in_network array
         builder = ijson.ObjectBuilder()
+        builder.event('start_array', None)
 
-        for prefix, event, value in self.parser:
+        if code_set:
+            events = self._prefilter_codes(CodeSet.compile(code_set))
+        else:
+            events = self.parser
+
+        for prefix, event, value in events:
 
             if (prefix, event, value) == ('in_network', 'end_array', None):
                 return
 
+            elif (prefix, event) == ('in_network', 'start_array'):
+                continue
+
             elif (prefix, event, value) == ('in_network.item', 'end_map', None):
-                log.info(f"Found: {billing_code_tup}")
-                yield builder.value.pop()
-                
-            elif (
-                (prefix, event) == ('in_network.item.negotiated_rates', 'start_array')
-            ):
-                billing_code_type = builder.value[-1]['billing_code_type']
-                billing_code = str(builder.value[-1]['billing_code'])
-                billing_code_tup = billing_code_type, billing_code
+                item = builder.value.pop()
+                log.debug(f"Found: {item.get('billing_code_type'), item.get('billing_code')}")
+                METRICS.incr('items_kept')
+                yield item
 
-                if (
-                    code_set
-                    and billing_code_tup not in code_set
-                ):
-                    log.debug(f'Skipping: {billing_code_tup}')                    
-                    self.ffwd(('in_network.item', 'end_map', None))
-                    builder.value.pop()
-                    builder.containers.pop()
-                    continue
+            elif (prefix, event) == ('in_network.item', 'discard'):
+                builder.value.pop()
+                builder.containers.pop()
+                continue
 
             elif (
                 (prefix, event) == ('in_network.item.negotiated_rates', 'end_array')
                 and not builder.value[-1]['negotiated_rates']
             ):
-                log.info(f"No rates for {billing_code_tup}")
-                self.ffwd(('in_network.item', 'end_map', None))
+                billing_code_tup = builder.value[-1].get('billing_code_type'), builder.value[-1].get('billing_code')
+                log.debug(f"No rates for {billing_code_tup}")
+                METRICS.incr('items_empty')
+                self._skip_item(events)
                 builder.value.pop()
                 builder.containers.pop()
                 builder.containers.pop()
@@ -240,13 +736,66 @@ class MRFObjectBuilder:
             ):
                 provider_groups = []
 
+                if self.budget:
+                    self.budget.check(
+                        stage = 'in_network',
+                        billing_code = builder.value[-1].get('billing_code'),
+                        rates_in_item = len(builder.value[-1].get('negotiated_rates', [])),
+                    )
+
             elif (
                 provider_references_map 
+                and not defer_references
                 and prefix.endswith('provider_references.item')
                 and (grps := provider_references_map.get(value))
             ):
                 provider_groups.extend(grps)
 
+            elif (
+                price_filter
+                and prefix.endswith('negotiated_prices.item')
+                and event == 'end_map'
+                and not price_filter(builder.value[-1]['negotiated_rates'][-1]['negotiated_prices'][-1])
+            ):
+                builder.value[-1]['negotiated_rates'][-1]['negotiated_prices'].pop()
+
+            elif (
+                price_filter
+                and (prefix, event) == ('in_network.item.negotiated_rates.item.provider_groups', 'start_array')
+                and 'negotiated_prices' in builder.value[-1]['negotiated_rates'][-1]
+                and not builder.value[-1]['negotiated_rates'][-1]['negotiated_prices']
+            ):
+                # None of this rate's prices qualified, so don't build its
+                # provider groups
+                self._skip_rate(events)
+                builder.value[-1]['negotiated_rates'].pop()
+                builder.containers.pop()
+                continue
+
+            elif (
+                price_filter
+                and prefix.endswith('negotiated_rates.item')
+                and event == 'end_map'
+                and not builder.value[-1]['negotiated_rates'][-1].get('negotiated_prices')
+            ):
+                builder.value[-1]['negotiated_rates'].pop()
+
+            elif (
+                defer_references
+                and prefix.endswith('negotiated_rates.item')
+                and event == 'end_map'
+            ):
+                neg_rate = builder.value[-1]['negotiated_rates'][-1]
+                refs = [
+                    ref for ref in neg_rate.pop('provider_references', [])
+                    if provider_references_map and ref in provider_references_map
+                ]
+
+                if refs:
+                    neg_rate['provider_references'] = refs
+                elif not neg_rate.get('provider_groups'):
+                    builder.value[-1]['negotiated_rates'].pop()
+
             elif (
                 prefix.endswith('negotiated_rates.item') 
                 and event == 'end_map'
@@ -276,39 +825,174 @@ class MRFObjectBuilder:
                     continue
 
             elif prefix.endswith('service_code.item'):
-                try:
-                    value = int(value)
-                except ValueError:
-                    pass
+                value = try_int(value)
 
             
             builder.event(event, value)
 
 
+    def in_network_row_batches(
+        self,
+        root_hash_key,
+        npi_set,
+        code_set,
+        provider_references_map,
+        price_filter = None,
+        defer_references = False,
+    ):
+        """
+        Bounded-memory version of `in_network_items` that never builds a
+        whole item. Yields lists of Rows: each negotiated rate is built on
+        its own, filtered like `filter_negotiated_rate`, and turned into
+        rows as soon as it closes. The in_network row (and hash key) is
+        made from the scalar fields that come before negotiated_rates and
+        sent with the first rate that's kept.
+
+        Rows come out the same as `in_network_item_to_rows` would make
+        them. Only the item's scalars and one rate are held at a time,
+        unless the in_network fields come after negotiated_rates, in
+        which case that item's rows are held until it ends.
+        """
+        if code_set:
+            events = self._prefilter_codes(CodeSet.compile(code_set))
+        else:
+            events = self.parser
+
+        rates_prefix = 'in_network.item.negotiated_rates'
+        rate_prefix = 'in_network.item.negotiated_rates.item'
+
+        item_builder = None
+        rate_builder = None
+
+        for prefix, event, value in events:
+
+            if rate_builder is not None:
+                rate_builder.event(event, value)
+
+                if (prefix, event) != (rate_prefix, 'end_map'):
+                    continue
+
+                neg_rate = filter_negotiated_rate(
+                    rate_builder.value, npi_set, provider_references_map, price_filter, defer_references
+                )
+                rate_builder = None
+
+                if not neg_rate:
+                    continue
+
+                n_rates += 1
+                item = item_builder.value
+
+                if in_network is None and all(f in item for f in IN_NETWORK_FIELDS):
+                    in_network = in_network_row(item, root_hash_key)
+                    batch = [in_network]
+                else:
+                    batch = []
+
+                if in_network is None:
+                    pending_rates.append(neg_rate)
+                    continue
+
+                batch.extend(negotiated_rate_to_rows(
+                    neg_rate, in_network.data['in_network_hash_key'], root_hash_key
+                ))
+                yield batch
+
+            elif (prefix, event) == ('in_network', 'end_array'):
+                return
+
+            elif (prefix, event) == ('in_network.item', 'start_map'):
+                item_builder = ijson.ObjectBuilder()
+                item_builder.event(event, value)
+                in_network = None
+                has_rates = False
+                n_rates = 0
+                pending_rates = []
+
+            elif (prefix, event) == ('in_network.item', 'discard'):
+                item_builder = None
+
+            elif prefix == rates_prefix and event in ('start_array', 'end_array'):
+                has_rates = True
+
+            elif (prefix, event) == (rate_prefix, 'start_map'):
+                rate_builder = ijson.ObjectBuilder()
+                rate_builder.event(event, value)
+
+                if self.budget:
+                    self.budget.check(
+                        stage = 'in_network',
+                        billing_code = item_builder.value.get('billing_code'),
+                        pending_rates = len(pending_rates),
+                    )
+
+            elif (prefix, event) == ('in_network.item', 'end_map'):
+                item_builder.event(event, value)
+                item = item_builder.value
+                item_builder = None
+                billing_code_tup = item.get('billing_code_type'), item.get('billing_code')
+
+                if has_rates and not n_rates:
+                    log.debug(f"No rates for {billing_code_tup}")
+                    METRICS.incr('items_empty')
+                    continue
+
+                batch = []
+                if in_network is None:
+                    in_network = in_network_row(item, root_hash_key)
+                    batch.append(in_network)
+
+                in_network_hash_key = in_network.data['in_network_hash_key']
+                for neg_rate in pending_rates:
+                    batch.extend(negotiated_rate_to_rows(neg_rate, in_network_hash_key, root_hash_key))
+
+                batch.extend(bundled_code_rows(item, in_network_hash_key, root_hash_key))
+
+                log.debug(f"Found: {billing_code_tup}")
+                METRICS.incr('items_kept')
+                # Sent even when empty: it marks the end of an item, where
+                # a checkpoint can be taken
+                yield batch
+
+            elif item_builder is not None:
+                item_builder.event(event, value)
+
+
     def build_provider_references(self, npi_set):
 
-        local_provider_references, remote_provider_references = self._build_local_provider_references(npi_set)
-        new_provider_references = self._build_remote_provider_references(remote_provider_references, npi_set)
+        local_provider_references, remote_provider_references, spill = self._build_local_provider_references(npi_set)
+        new_provider_references = build_remote_provider_references(remote_provider_references, npi_set)
 
         if new_provider_references:
             local_provider_references.extend(new_provider_references)        
 
+        if spill is not None:
+            for pref in local_provider_references:
+                spill[pref['provider_group_id']] = pref['provider_groups']
+            return spill
+
         return {
             pref['provider_group_id']: pref['provider_groups'] for pref in local_provider_references
         }
 
 
     def _build_local_provider_references(self, npi_set):
+        """
+        Returns the local provider references that have groups left, the
+        remote ones, and, if the memory budget's soft limit was reached,
+        the SpillDict that the local ones were moved to
+        """
         remote_provider_references = []
         builder = ijson.ObjectBuilder()
+        spill = None
+        n_refs = 0
 
         for prefix, event, value in self.parser:
 
             if (
                 (prefix, event, value) == ('provider_references', 'end_array', None)
             ):
-                local_provider_references = builder.value
-                return builder.value, remote_provider_references
+                return builder.value, remote_provider_references, spill
 
             elif (
                 prefix.endswith('npi.item')
@@ -334,63 +1018,102 @@ class MRFObjectBuilder:
                 elif not builder.value[-1].get('provider_groups'):
                     builder.value.pop()
 
+                n_refs += 1
+
+                if self.budget:
+                    self.budget.check(stage = 'provider_references', provider_references = n_refs)
+
+                    if spill is None and self.budget.soft:
+                        log.warning(f'Memory budget: spilling provider references to disk after {n_refs}')
+                        spill = SpillDict()
+
+                if spill is not None:
+                    # Completed references move to disk; `builder.value`
+                    # only ever holds the one being built
+                    for pref in builder.value:
+                        spill[pref['provider_group_id']] = pref['provider_groups']
+                    builder.value.clear()
 
             builder.event(event, value)
 
 
-    def _build_remote_reference(self, loc, npi_set):
+class MRFWriter:
+    """
+    Appends the rows of each in_network item to `{out_dir}/{table}.csv`.
 
-        with MRFOpen(loc) as f:
-            builder = ijson.ObjectBuilder()
+    When items come from `in_network_items(..., defer_references = True)`,
+    pass the provider references map here too. Each referenced provider
+    group is then written to provider_groups once, the first time a rate
+    refers to it, instead of once per rate.
 
-            parser = ijson.parse(f, use_float = True)
-            for prefix, event, value in parser:
+    With a `dedup.KeyStore` as well, a group already written by any run
+    that shares the store is only linked to with a provider_group_links
+    row.
+    """
 
-                if (
-                    prefix.endswith('npi.item') 
-                    and npi_set
-                    and not value in npi_set
-                ):
-                    continue
+    def __init__(self, provider_references_map = None, key_store = None):
+        self.root_data_written = False
+        self.root_hash_key = None
+        self.provider_references_map = provider_references_map
+        self.key_store = key_store
+        self.written_references = set()
 
-                elif (
-                    prefix.endswith('provider_groups.item') 
-                    and event == 'end_map'
-                ):
-                    if not builder.value['provider_groups'][-1]['npi']:
-                        builder.value['provider_groups'].pop()
 
-                builder.event(event, value)
+    def _referenced_group_rows(self, provider_group_ids, root_hash_key):
+        group_rows = []
+
+        for provider_group_id in provider_group_ids:
+            if provider_group_id in self.written_references:
+                continue
 
-        return builder.value
+            self.written_references.add(provider_group_id)
+            provider_groups = self.provider_references_map.get(provider_group_id, [])
 
+            if self.key_store is not None:
+                source = self.key_store.claim(
+                    content_key(provider_groups), [root_hash_key, provider_group_id]
+                ) or [root_hash_key, provider_group_id]
 
-    def _build_remote_provider_references(self, remote_provider_references, npi_set):
+                group_rows.append(Row('provider_group_links', {
+                    'root_hash_key':            root_hash_key,
+                    'provider_group_id':        provider_group_id,
+                    'source_root_hash_key':     source[0],
+                    'source_provider_group_id': source[1],
+                }))
 
-        new_provider_references = []
+                if source != [root_hash_key, provider_group_id]:
+                    continue
 
-        for pref in remote_provider_references:
-            loc = pref.get('location')
-            try:
-                remote_reference = self._build_remote_reference(loc, npi_set)
-                remote_reference['provider_group_id'] = pref['provider_group_id']
-                new_provider_references.append(remote_reference)
-            except Exception as e:
-                log.warn('Error retrieving remote provider references')
-                log.warn(loc)
-                log.warn(e)
-                pass
+            for provider_group in provider_groups:
+                group_rows.append(Row('provider_groups', {
+                    'npi_numbers':       provider_group['npi'],
+                    'tin_type':          provider_group['tin']['type'],
+                    'tin_value':         provider_group['tin']['value'],
+                    'provider_group_id': provider_group_id,
+                    'root_hash_key':     root_hash_key,
+                }))
 
+        return group_rows
 
-class MRFWriter:
 
-    def __init__(self):
-        self.root_data_written = False
+    def root_hash(self, root_data):
+        # Hash before root_hash_key is added to root_data in _prepare, so
+        # every item gets the same key as the root row
+        if self.root_hash_key is None:
+            self.root_hash_key = hashdict(root_data)
+
+        return self.root_hash_key
+
 
+    def _prepare(self, rows, root_data):
+        root_hash_key = self.root_hash(root_data)
 
-    def _prepare(self, item, root_data):
-        root_hash_key = hashdict(root_data)
-        rows = in_network_item_to_rows(item, root_hash_key)
+        if self.provider_references_map is not None:
+            provider_group_ids = [
+                row.data['provider_group_id'] for row in rows
+                if row.filename == 'provider_references'
+            ]
+            rows.extend(self._referenced_group_rows(provider_group_ids, root_hash_key))
 
         if not self.root_data_written:
             root_data['root_hash_key'] = root_hash_key
@@ -400,14 +1123,24 @@ class MRFWriter:
 
 
     def write_in_network_item(self, item, root_data, out_dir):
+        rows = in_network_item_to_rows(item, self.root_hash(root_data))
+        self.write_rows(rows, root_data, out_dir)
+
+
+    def write_rows(self, rows, root_data, out_dir):
 
         if not os.path.exists(out_dir):
             os.mkdir(out_dir)
 
-        rows = self._prepare(item, root_data)
+        rows = self._prepare(rows, root_data)
 
+        # Open each table's file once per batch; rows keep their order
+        # within a table
+        tables = {}
         for row in rows:
-            filename, data = row.filename, row.data
+            tables.setdefault(row.filename, []).append(row.data)
+
+        for filename, table_rows in tables.items():
             fieldnames = SCHEMA[filename]
             file_loc = f'{out_dir}/{filename}.csv'
             file_exists = os.path.exists(file_loc)
@@ -418,9 +1151,42 @@ class MRFWriter:
                 if not file_exists:
                     writer.writeheader()
 
-                writer.writerow(data)
+                writer.writerows(table_rows)
 
         self.root_data_written = True
 
 
+    def write_batch(self, batch, root_data, out_dir):
+        """
+        Same as `write_rows` for a `rowbatch.RowBatch`, whose row tuples
+        are already in SCHEMA order
+        """
+        if not os.path.exists(out_dir):
+            os.mkdir(out_dir)
+
+        root_hash_key = self.root_hash(root_data)
+
+        if self.provider_references_map is not None:
+            provider_group_ids = batch.column('provider_references', 'provider_group_id')
+            batch.extend_rows(self._referenced_group_rows(provider_group_ids, root_hash_key))
 
+        if not self.root_data_written:
+            root_data['root_hash_key'] = root_hash_key
+            batch.extend_rows([Row('root', root_data)])
+
+        for filename, table_rows in batch.tables.items():
+            if not table_rows:
+                continue
+
+            file_loc = f'{out_dir}/{filename}.csv'
+            file_exists = os.path.exists(file_loc)
+
+            with open(file_loc, 'a') as f:
+                writer = csv.writer(f)
+
+                if not file_exists:
+                    writer.writerow(SCHEMA[filename])
+
+                writer.writerows(table_rows)
+
+        self.root_data_written = True
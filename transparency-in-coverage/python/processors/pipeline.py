@@ -0,0 +1,620 @@
+"""
+Composable streaming pipeline for flattening MRFs.
+
+A run is a chain of generators with explicit batch sizes between them:
+
+    source  -> batched items -> flatten -> batched rows -> [stages] -> sink
+
+    source = MRFSource(loc, npi_set = npi_set, code_set = code_set)
+    sink = CSVSink(out_dir, source)
+    run_pipeline(source, sink)
+
+Sources yield filtered in_network items (or, with `stream_rates`, lists
+of rows) and expose the file's root_data, root_hash_key and provider
+references map once iteration has started. Rows travel between stages
+as `rowbatch.RowBatch` objects. Extra stages are any callable that
+takes an iterable of row batches and returns one, so
+caching, parallelism or instrumentation can be slotted in without
+touching the core loop. Sinks have `write(batch)` and `close()`.
+
+Each stage's time is recorded in `metrics.METRICS` as `stage.<name>`.
+The timers are cumulative: pulling a batch from a stage also runs the
+stages before it, so a stage's own time is the difference from the
+previous one.
+"""
+import os
+import json
+import time
+import cProfile
+import logging
+
+from mrfutils import (
+    MRFOpen,
+    MRFObjectBuilder,
+    MRFWriter,
+    hashdict,
+    build_remote_provider_references,
+    filter_provider_reference,
+    filter_in_network_item,
+)
+from readers import MmapReader, PrefixedReader, find_array, skip_values
+from splitter import iter_jsonl, shard_paths
+from codes import CodeSet
+from rowbatch import RowBatch, COLUMNS
+from metrics import METRICS, MetricsReporter
+from memory import SpillDict
+from dedup import content_key
+from stats import Aggregator, key_getter, write_summaries, MAX_KEYS, QUANTILES, STREAM_GROUP_BY
+
+log = logging.getLogger(__name__)
+
+
+def batched(iterable, size):
+    batch = []
+
+    for x in iterable:
+        batch.append(x)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+class MRFSource:
+    """
+    Source and filter stages: opens `loc` with MRFOpen, reads the root
+    and provider references, and yields the in_network items that pass
+    the filters. Files that put provider_references after in_network are
+    read twice.
+
+    With a `memory.MemoryBudget`, the source switches to `stream_rates`
+    once RSS passes the budget's soft limit, and `memory_report` holds
+    the file's peak RSS and provider reference map size when it's done.
+
+    `track_position = True` keeps count of the in_network items the
+    parser has finished (`items_done`), for checkpoints, and the first
+    `skip_items` items are passed over without being built. In local
+    uncompressed files, `item_offset` finds where the last of them ended,
+    and given that as `resume_offset` the source seeks past the skipped
+    items instead of parsing them.
+
+    With a `dedup.KeyStore`, items and referenced provider groups that
+    have been written before are replaced by link rows (see dedup.py).
+
+    A `bloom.FileSummary` collects the NPIs and billing codes the file
+    mentions, and is marked complete once all of it has been read.
+
+    A `readers.RateLimiter` caps the download rate of remote files.
+    """
+
+    def __init__(
+        self,
+        loc,
+        npi_set = None,
+        code_set = None,
+        price_filter = None,
+        defer_references = False,
+        stream_rates = False,
+        pipelined = False,
+        budget = None,
+        track_position = False,
+        skip_items = 0,
+        resume_offset = None,
+        key_store = None,
+        summary = None,
+        limiter = None,
+    ):
+        self.loc = loc
+        self.npi_set = npi_set
+        self.code_set = CodeSet.compile(code_set) if code_set else None
+        self.price_filter = price_filter
+        self.defer_references = defer_references
+        self.stream_rates = stream_rates
+        self.pipelined = pipelined
+        self.budget = budget
+        self.track_position = track_position
+        self.skip_items = skip_items
+        self.resume_offset = resume_offset
+        self.key_store = key_store
+        self.summary = summary
+        self.limiter = limiter
+
+        self.root_data = None
+        self.root_hash_key = None
+        self.provider_references_map = None
+        self.memory_report = None
+        self._opener = None
+        self._builder = None
+        # Items before the builder's, when it started past some
+        self._items_before = 0
+        # (offset, items_done) of the last item_offset
+        self._last_offset = None
+        self.seeked = False
+
+    @property
+    def items_done(self):
+        return self._items_before + self._builder.items_ended if self._builder else self.skip_items
+
+    @property
+    def at_item_boundary(self):
+        return self._builder is None or self._builder.items_started == self._builder.items_ended
+
+    def bytes_read(self):
+        try:
+            return self._opener.bytes_read()
+        except (AttributeError, OSError, ValueError):
+            return None
+
+    def item_offset(self):
+        """
+        Offset in the file of what follows the last in_network item
+        finished, or None if the file can't be seeked in. Brackets are
+        only scanned from the previous offset, so this is cheap to call
+        at every checkpoint.
+        """
+        f = self._opener.f if self._opener else None
+        if not isinstance(f, MmapReader) or f.closed or not self.at_item_boundary:
+            return None
+
+        data = f.view()
+        if self._last_offset is None:
+            start = find_array(data, b'in_network')
+            if start is None:
+                return None
+            self._last_offset = (start, 0)
+
+        offset, items_done = self._last_offset
+        offset = skip_values(data, offset, self.items_done - items_done)
+        if offset is not None:
+            self._last_offset = (offset, self.items_done)
+        return offset
+
+    def _open(self):
+        self._opener = MRFOpen(self.loc, pipelined = self.pipelined, limiter = self.limiter)
+        return self._opener
+
+    def _builder_for(self, f):
+        self._builder = MRFObjectBuilder(f, self.budget, self.track_position, self.summary)
+        self._items_before = 0
+        return self._builder
+
+    def _skip(self, m, f):
+        """
+        Gets the parser past the first `skip_items` in_network items and
+        returns the builder to carry on with
+        """
+        if not self.skip_items:
+            return m
+
+        if self.resume_offset is not None and isinstance(f, MmapReader):
+            log.info(f'Seeking past the first {self.skip_items} in_network items, to byte {self.resume_offset}')
+            f.seek(self.resume_offset)
+            m = self._builder_for(PrefixedReader(b'{"in_network":[', f))
+            m.ffwd(('in_network', 'start_array', None))
+            self._items_before = self.skip_items
+            self._last_offset = (self.resume_offset, self.skip_items)
+            self.seeked = True
+            return m
+
+        log.info(f'Skipping the first {self.skip_items} in_network items')
+        m.skip_items(self.skip_items)
+        return m
+
+    def _switch_to_streaming(self):
+        log.warning(f'Memory budget: streaming rows per negotiated rate from here on ({self.budget.report()})')
+        self.stream_rates = True
+
+    def _in_network(self, m):
+        args = (
+            self.npi_set,
+            self.code_set,
+            self.provider_references_map,
+            self.price_filter,
+            self.defer_references,
+        )
+
+        if not self.stream_rates and self.budget and self.budget.soft:
+            self._switch_to_streaming()
+
+        if self.stream_rates:
+            yield from m.in_network_row_batches(self.root_hash_key, *args)
+            return
+
+        items = m.in_network_items(*args)
+
+        for item in items:
+            yield item
+
+            if self.budget and self.budget.soft:
+                # The parser is at an item boundary, so the rest of the
+                # file can be read by in_network_row_batches
+                items.close()
+                self._switch_to_streaming()
+                yield from m.in_network_row_batches(self.root_hash_key, *args)
+                return
+
+    def __iter__(self):
+        yield from self._iter_file()
+
+        # Items seeked past weren't seen
+        if self.summary:
+            self.summary.complete = not self.seeked
+
+        if self.budget:
+            p_ref_map = self.provider_references_map
+            self.memory_report = self.budget.report(
+                loc = self.loc,
+                provider_references = len(p_ref_map) if p_ref_map else 0,
+                spilled_references = isinstance(p_ref_map, SpillDict),
+                streamed_rates = self.stream_rates,
+            )
+            log.info(f'Memory: {self.memory_report}')
+
+    def _iter_file(self):
+        with self._open() as f:
+
+            m = self._builder_for(f)
+
+            self.root_data, cur_row = m.build_root()
+            self.root_hash_key = hashdict(self.root_data)
+
+            if cur_row == ('', 'map_key', 'provider_references'):
+                self.provider_references_map = m.build_provider_references(self.npi_set)
+
+                m.ffwd(('', 'map_key', 'in_network'))
+                m = self._skip(m, f)
+                yield from self._in_network(m)
+                return
+
+            m.ffwd(('', 'map_key', 'provider_references'))
+            self.provider_references_map = m.build_provider_references(self.npi_set)
+
+        with self._open() as f:
+
+            m = self._builder_for(f)
+
+            m.ffwd(('', 'map_key', 'in_network'))
+            m = self._skip(m, f)
+            yield from self._in_network(m)
+
+
+class JSONLSource:
+    """
+    Same as MRFSource, for a file already split into JSONL shards by
+    splitter.py. Each line is parsed whole instead of event by event.
+    """
+
+    def __init__(
+        self,
+        split_dir,
+        npi_set = None,
+        code_set = None,
+        price_filter = None,
+        defer_references = False,
+    ):
+        self.split_dir = split_dir
+        self.npi_set = npi_set
+        self.code_set = CodeSet.compile(code_set) if code_set else None
+        self.price_filter = price_filter
+        self.defer_references = defer_references
+
+        self.root_data = None
+        self.root_hash_key = None
+        self.provider_references_map = None
+
+    def _build_provider_references(self):
+        local_provider_references = []
+        remote_provider_references = []
+
+        for path in shard_paths(self.split_dir, 'provider_references'):
+            for pref in iter_jsonl(path):
+                if pref.get('location'):
+                    remote_provider_references.append(pref)
+                elif (pref := filter_provider_reference(pref, self.npi_set)):
+                    local_provider_references.append(pref)
+
+        local_provider_references.extend(
+            build_remote_provider_references(remote_provider_references, self.npi_set)
+        )
+
+        return {
+            pref['provider_group_id']: pref['provider_groups'] for pref in local_provider_references
+        }
+
+    def __iter__(self):
+        with open(os.path.join(self.split_dir, 'root.json')) as f:
+            self.root_data = json.load(f)
+
+        self.root_hash_key = hashdict(self.root_data)
+        self.provider_references_map = self._build_provider_references()
+
+        for path in shard_paths(self.split_dir, 'in_network'):
+            for item in iter_jsonl(path):
+                if (item := filter_in_network_item(
+                    item,
+                    self.npi_set,
+                    self.code_set,
+                    self.provider_references_map,
+                    self.price_filter,
+                    self.defer_references,
+                )):
+                    yield item
+
+
+def flatten(item_batches, source, batch_size = 10_000):
+    """
+    Flatten stage: turns batches of items into RowBatches of about
+    `batch_size` rows. Lists of rows, which sources yield with
+    `stream_rates`, are just re-batched.
+    """
+    key_store = getattr(source, 'key_store', None)
+    dedup = Deduplicator(key_store, source) if key_store else None
+    batch = RowBatch()
+
+    for items in item_batches:
+        for item in items:
+            if dedup:
+                dedup.add(batch, item)
+            elif isinstance(item, list):
+                batch.extend_rows(item)
+            else:
+                batch.add_item(item, source.root_hash_key)
+
+        if len(batch) >= batch_size:
+            yield batch
+            batch = RowBatch()
+
+    if batch:
+        yield batch
+
+
+class Deduplicator:
+    """
+    Adds items to a RowBatch as `flatten` does, keyed on their content
+    instead of their root, and only once across every run that shares
+    the KeyStore. Every item also gets an in_network_links row.
+    """
+
+    def __init__(self, key_store, source):
+        self.key_store = key_store
+        self.source = source
+        self.group_keys = {}
+
+    def _group_key(self, provider_group_id):
+        # Reference ids only mean something within a file, so items are
+        # keyed on the groups they point at
+        if (key := self.group_keys.get(provider_group_id)) is None:
+            groups = self.source.provider_references_map.get(provider_group_id, [])
+            key = self.group_keys[provider_group_id] = content_key(groups)
+        return key
+
+    def item_key(self, item):
+        if not self.source.defer_references:
+            return content_key(item)
+
+        rates = [
+            {**rate, 'provider_references': [self._group_key(i) for i in rate['provider_references']]}
+            if 'provider_references' in rate else rate
+            for rate in item.get('negotiated_rates', [])
+        ]
+        return content_key({**item, 'negotiated_rates': rates})
+
+    def add(self, batch, item):
+        root_hash_key = self.source.root_hash_key
+        links = batch.tables['in_network_links']
+
+        # Streamed rows aren't a whole item, so are kept as they are
+        if isinstance(item, list):
+            batch.extend_rows(item)
+            for filename, data in item:
+                if filename == 'in_network':
+                    links.append((root_hash_key, data['in_network_hash_key']))
+            return
+
+        key = self.item_key(item)
+        links.append((root_hash_key, key))
+
+        if self.key_store.claim(key) is None:
+            batch.add_item(item, root_hash_key, key)
+
+
+class CSVSink:
+    """
+    Writes row batches to `{out_dir}/{table}.csv` through MRFWriter, which
+    adds the root row and, with `defer_references`, the referenced
+    provider groups.
+    """
+
+    def __init__(self, out_dir, source):
+        self.out_dir = out_dir
+        self.source = source
+        self.writer = None
+        # Writer state saved by a checkpoint, see checkpoint.CheckpointSink
+        self.restored = None
+
+    def write(self, batch):
+        if self.writer is None:
+            p_ref_map = self.source.provider_references_map if self.source.defer_references else None
+            self.writer = MRFWriter(p_ref_map, getattr(self.source, 'key_store', None))
+            self.writer.root_hash_key = self.source.root_hash_key
+
+            if self.restored:
+                self.writer.root_data_written = self.restored['root_data_written']
+                self.writer.written_references = set(self.restored['written_references'])
+
+        self.writer.write_batch(batch, self.source.root_data, self.out_dir)
+
+    def close(self):
+        pass
+
+
+def _indexes(table, *names):
+    return [COLUMNS[table].index(name) for name in names]
+
+
+class StatsSink:
+    """
+    Feeds rows straight into a `stats.Aggregator` instead of writing
+    them: each negotiated price counts once for every NPI of its rate's
+    provider groups. Summaries are the same as `stats.aggregate_outputs`
+    over the CSVs a CSVSink would have written. The rows of a rate
+    always travel in one batch, so the join is per batch; only a
+    billing code per in_network item is kept between batches.
+    """
+
+    def __init__(self, source, group_by = STREAM_GROUP_BY, max_keys = MAX_KEYS):
+        self.source = source
+        self.group_by = tuple(group_by)
+        self.get_key = key_getter(self.group_by)
+        self.aggregator = Aggregator(max_keys)
+        self.codes = {}
+
+    def write(self, batch):
+        root_hash_key = self.source.root_hash_key
+        tables = batch.tables
+
+        key, code_type, code = _indexes('in_network', 'in_network_hash_key', 'billing_code_type', 'billing_code')
+        for row in tables['in_network']:
+            self.codes[row[key]] = row[code_type], row[code]
+
+        npis = {}
+
+        in_network, rate, npi_numbers = _indexes('provider_groups', 'in_network_hash_key', 'negotiated_rates_hash_key', 'npi_numbers')
+        for row in tables['provider_groups']:
+            npis.setdefault((row[in_network], row[rate]), set()).update(map(str, row[npi_numbers]))
+
+        in_network, rate, group_id = _indexes('provider_references', 'in_network_hash_key', 'negotiated_rates_hash_key', 'provider_group_id')
+        for row in tables['provider_references']:
+            for group in self.source.provider_references_map.get(row[group_id], []):
+                npis.setdefault((row[in_network], row[rate]), set()).update(map(str, group['npi']))
+
+        in_network, rate, billing_class, negotiated_type, negotiated_rate = _indexes(
+            'negotiated_prices',
+            'in_network_hash_key',
+            'negotiated_rates_hash_key',
+            'billing_class',
+            'negotiated_type',
+            'negotiated_rate',
+        )
+        add = self.aggregator.add
+        get_key = self.get_key
+
+        for row in tables['negotiated_prices']:
+            rate_npis = npis.get((row[in_network], row[rate]))
+            if not rate_npis:
+                continue
+
+            code_type, code = self.codes.get(row[in_network], ('', ''))
+            value = float(row[negotiated_rate])
+            for npi in rate_npis:
+                add(get_key((code_type, code, npi, root_hash_key, row[billing_class], row[negotiated_type])), value)
+
+    def write_summaries(self, path, quantiles = QUANTILES):
+        """
+        Writes the summaries to a CSV once the pipeline has finished, and
+        lets go of the aggregator. Returns the number of rows.
+        """
+        try:
+            return write_summaries(self.aggregator.items(), path, self.group_by, quantiles)
+        finally:
+            self.aggregator.close()
+
+    def close(self):
+        # Summaries are only written if the run got to the end
+        pass
+
+
+class ListSink:
+    """
+    Collects rows in one RowBatch in memory, mostly for tests and notebooks
+    """
+
+    def __init__(self):
+        self.batch = RowBatch()
+
+    def write(self, batch):
+        self.batch.extend(batch)
+
+    def close(self):
+        pass
+
+
+def timed_stage(name, iterable):
+    """
+    Records the time spent producing each batch of `iterable`
+    """
+    it = iter(iterable)
+    timer = f'stage.{name}'
+
+    while True:
+        s = time.perf_counter()
+        try:
+            batch = next(it)
+        except StopIteration:
+            return
+        finally:
+            METRICS.add_time(timer, time.perf_counter() - s)
+        yield batch
+
+
+def write_batches(rows, sink):
+    try:
+        for batch in rows:
+            with METRICS.timer('sink_write'):
+                sink.write(batch)
+
+            for table, table_rows in batch.tables.items():
+                if table_rows:
+                    METRICS.incr(f'rows.{table}', len(table_rows))
+    finally:
+        sink.close()
+
+
+def run_pipeline(
+    source,
+    sink,
+    stages = (),
+    item_batch_size = 100,
+    row_batch_size = 10_000,
+    metrics_path = None,
+    metrics_interval = 10,
+    profile_path = None,
+):
+    """
+    Runs `source` through flatten and `stages` into `sink`.
+
+    `metrics_path` appends a METRICS snapshot (which then also counts
+    parser events) to that JSON-lines file every `metrics_interval`
+    seconds. `profile_path` runs the whole pipeline under cProfile and
+    dumps the stats there, for `python -m pstats` or snakeviz; every
+    stage is its own generator function, so stages also show up by
+    name in py-spy output.
+    """
+    batches = timed_stage('source', batched(source, item_batch_size))
+    rows = timed_stage('flatten', flatten(batches, source, row_batch_size))
+
+    for stage in stages:
+        rows = timed_stage(getattr(stage, '__name__', 'stage'), stage(rows))
+
+    reporter = None
+    if metrics_path:
+        METRICS.count_events = True
+        reporter = MetricsReporter(metrics_path, metrics_interval).start()
+
+    profiler = cProfile.Profile() if profile_path else None
+
+    try:
+        if profiler:
+            profiler.runcall(write_batches, rows, sink)
+        else:
+            write_batches(rows, sink)
+    finally:
+        if profiler:
+            profiler.dump_stats(profile_path)
+            log.info(f'Profile written to {profile_path}')
+
+        if reporter:
+            reporter.stop()
+            METRICS.count_events = False
@@ -0,0 +1,293 @@
+"""
+Cheap estimates of what's in the files of a downloader catalog, before
+committing to full runs.
+
+    python probe.py ../downloaders/uhc_data.db -n npis.csv -c codes.csv -j 16 -m 50
+
+For each file in the catalog's `in_network_files`, a probe reads the
+root, the whole provider_references section and in_network items until
+`max_bytes` of the file have been read past the start of in_network.
+It records, in an `in_network_probes` table next to `in_network_files`:
+
+  - items and negotiated rates sampled, and items per MB of in_network
+    as stored, from which `estimated_items` extrapolates the items in
+    the rest of the catalog's `size`
+  - the billing code types seen, as {type: items}
+  - how many of the NPIs seen (in provider_references and in inline
+    provider groups) and of the codes seen are in the sets given
+  - whether the whole file, or the whole of provider_references, was
+    read
+
+and Bloom filters of the NPIs and codes seen (see bloom.py).
+
+Files are probed `jobs` at a time, each in its own process. Only files
+read to the end can be ruled out for certain: `ranked_urls` skips those
+without matches and puts the rest in order of their matches.
+"""
+import time
+import json
+import sqlite3
+import logging
+import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import ijson
+
+from bloom import FileSummary
+from codes import CodeSet, import_code_spec
+from mrfutils import MRFOpen, import_set
+
+log = logging.getLogger(__name__)
+
+PROBE_BYTES = 50_000_000
+
+# How many parser events go by between checks of the bytes read
+CHECK_EVERY = 10_000
+
+# The parser reads ahead by a chunk, so this is how closely the start
+# of in_network is placed
+PARSE_BUFFER = 8 * 1024
+
+COLUMNS = (
+    'url',
+    'probed_at',
+    'reporting_entity_name',
+    'bytes_read',
+    'complete',
+    'references_complete',
+    'items',
+    'rates',
+    'items_per_mb',
+    'estimated_items',
+    'code_types',
+    'codes_seen',
+    'code_matches',
+    'provider_references',
+    'remote_references',
+    'npis_seen',
+    'npi_matches',
+    'error',
+)
+
+
+def probe(loc, npi_set = None, code_set = None, max_bytes = PROBE_BYTES):
+    """
+    Reads the start of one MRF and returns a dict of COLUMNS (but for
+    the catalog's own `estimated_items`), and the bloom.FileSummary of
+    what was read
+    """
+    code_set = CodeSet.compile(code_set) if code_set else None
+
+    root = {}
+    code_types = Counter()
+    items = rates = n_references = 0
+    summary = FileSummary()
+
+    in_network_start = None
+    in_network_offset = None
+    references_started = references_complete = False
+    complete = True
+
+    with (mrf := MRFOpen(loc)) as f:
+        events = summary.tap(ijson.parse(f, use_float = True, buf_size = PARSE_BUFFER))
+
+        for n, (prefix, event, value) in enumerate(events):
+
+            if prefix == 'in_network.item':
+                if event == 'start_map':
+                    items += 1
+
+            elif prefix == 'in_network.item.billing_code_type':
+                code_types[value] += 1
+
+            elif prefix == 'in_network.item.negotiated_rates.item':
+                if event == 'start_map':
+                    rates += 1
+
+            elif prefix == 'provider_references.item':
+                if event == 'start_map':
+                    n_references += 1
+
+            elif prefix == 'provider_references':
+                references_started = True
+                references_complete = event == 'end_array'
+
+            elif prefix == 'in_network':
+                if event == 'start_array':
+                    in_network_start = mrf.bytes_read()
+                    in_network_offset = mrf.bytes_decompressed()
+
+            elif '.' not in prefix and event in ('string', 'number'):
+                root[prefix] = value
+
+            # Items past the budget are only worth reading on the way to
+            # provider_references if they haven't come by yet
+            if (
+                in_network_start is not None
+                and n % CHECK_EVERY == 0
+                and mrf.bytes_read() - in_network_start > max_bytes
+                and (references_complete or not references_started)
+            ):
+                complete = False
+                break
+
+        bytes_read = mrf.bytes_read()
+        bytes_consumed = mrf.bytes_consumed()
+        bytes_decompressed = mrf.bytes_decompressed()
+
+    # Only what was parsed of in_network counts towards its density, not
+    # the root, provider_references or whatever the readers buffered
+    # ahead of the parser. The span is measured where the parser is, in
+    # decompressed bytes, and scaled back to bytes as stored.
+    if in_network_offset is not None and bytes_decompressed:
+        in_network_bytes = (bytes_decompressed - in_network_offset) * bytes_consumed / bytes_decompressed
+    else:
+        in_network_bytes = 0
+
+    summary.complete = complete
+    codes, npis = summary.codes, summary.npis
+
+    if code_set:
+        code_matches = sum(1 for c in codes if c in code_set)
+    else:
+        code_matches = None
+
+    return {
+        'url':                   loc,
+        'probed_at':             time.time(),
+        'reporting_entity_name': root.get('reporting_entity_name'),
+        'bytes_read':            bytes_read,
+        'complete':              complete,
+        'references_complete':   references_complete or not references_started and complete,
+        'items':                 items,
+        'rates':                 rates,
+        'items_per_mb':          items / in_network_bytes * 1_000_000 if in_network_bytes else None,
+        'code_types':            json.dumps(dict(code_types)),
+        'codes_seen':            len(codes),
+        'code_matches':          code_matches,
+        'provider_references':   n_references,
+        'remote_references':     summary.remote_references,
+        'npis_seen':             len(npis),
+        'npi_matches':           len(npis & npi_set) if npi_set else None,
+        'error':                 None,
+        'summary':               summary,
+    }
+
+
+def estimated_items(result, size):
+    """
+    Items in a file of `size` bytes, from a `probe` of it: the items
+    read, and as many again per MB as were in the sample for the bytes
+    that weren't read
+    """
+    if result.get('complete'):
+        return result['items']
+
+    rate = result.get('items_per_mb')
+    if not size or rate is None:
+        return None
+
+    return result['items'] + round(rate * max(size - result['bytes_read'], 0) / 1_000_000)
+
+
+# Set once per worker process, so the sets aren't sent with every file
+_probe_args = {}
+
+
+def _init_worker(npi_set, code_set, max_bytes):
+    _probe_args.update(npi_set = npi_set, code_set = code_set, max_bytes = max_bytes)
+
+
+def _probe_or_error(loc):
+    try:
+        return probe(loc, **_probe_args)
+    except Exception as e:
+        log.warning(f'Could not probe {loc}: {e!r}')
+        return {'url': loc, 'probed_at': time.time(), 'error': repr(e)}
+
+
+def create_probe_table(con):
+    con.execute(f"CREATE TABLE IF NOT EXISTS in_network_probes({', '.join(COLUMNS)}, PRIMARY KEY (url))")
+
+
+def probe_catalog(db_path, npi_set = None, code_set = None, max_bytes = PROBE_BYTES, jobs = 8, again = False, limit = None):
+    """
+    Probes the files of a downloader catalog, largest first, and records
+    the results in its `in_network_probes` table. Files probed already
+    are skipped unless `again`. Returns the number of files probed.
+    """
+    con = sqlite3.connect(db_path)
+    create_probe_table(con)
+
+    query = 'SELECT url, size FROM in_network_files'
+    if not again:
+        query += ' WHERE url NOT IN (SELECT url FROM in_network_probes WHERE error IS NULL)'
+    query += ' ORDER BY size DESC'
+    if limit:
+        query += f' LIMIT {int(limit)}'
+
+    sizes = dict(con.execute(query).fetchall())
+    log.info(f'Probing {len(sizes)} files from {db_path}')
+
+    init_args = (set(npi_set) if npi_set else None, CodeSet.compile(code_set) if code_set else None, max_bytes)
+
+    with ProcessPoolExecutor(jobs, initializer = _init_worker, initargs = init_args) as pool:
+        futures = [pool.submit(_probe_or_error, url) for url in sizes]
+
+        for future in as_completed(futures):
+            result = future.result()
+            result['estimated_items'] = estimated_items(result, sizes[result['url']])
+
+            if summary := result.pop('summary', None):
+                summary.save(db_path, result['url'], source = 'probe')
+
+            con.execute(
+                f"INSERT OR REPLACE INTO in_network_probes VALUES ({', '.join('?' * len(COLUMNS))})",
+                [result.get(c) for c in COLUMNS],
+            )
+            con.commit()
+
+    con.close()
+    return len(sizes)
+
+
+def ranked_urls(db_path):
+    """
+    URLs of probed files worth a full run, most promising first: files
+    read to the end without an NPI or code match are left out, the rest
+    go in order of NPI matches, code matches and estimated items
+    """
+    con = sqlite3.connect(db_path)
+    rows = con.execute(
+        'SELECT url FROM in_network_probes '
+        'WHERE error IS NULL '
+        'AND NOT (complete AND (IFNULL(npi_matches, 1) = 0 OR IFNULL(code_matches, 1) = 0)) '
+        'ORDER BY npi_matches DESC, code_matches DESC, estimated_items DESC'
+    ).fetchall()
+    con.close()
+    return [url for (url,) in rows]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Sample the files of a downloader catalog')
+    parser.add_argument('catalog', help = 'SQLite file written by a downloader')
+    parser.add_argument('-n', '--npis', help = 'CSV of NPIs to look for')
+    parser.add_argument('-c', '--codes', help = 'CSV of billing_code_type, billing_code specs to look for')
+    parser.add_argument('-m', '--megabytes', type = int, default = PROBE_BYTES // 1_000_000, help = 'MB of in_network to read per file')
+    parser.add_argument('-j', '--jobs', type = int, default = 8)
+    parser.add_argument('--limit', type = int, help = 'probe at most this many files')
+    parser.add_argument('--again', action = 'store_true', help = 'probe files that were probed already')
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.INFO)
+
+    probe_catalog(
+        args.catalog,
+        npi_set = import_set(args.npis) if args.npis else None,
+        code_set = import_code_spec(args.codes) if args.codes else None,
+        max_bytes = args.megabytes * 1_000_000,
+        jobs = args.jobs,
+        again = args.again,
+        limit = args.limit,
+    )
@@ -0,0 +1,432 @@
+"""
+On-disk indexes over flattened output, for "negotiated rates for code X
+at NPI Y" without scanning the tables.
+
+    python rate_index.py build -o index out_dir other_out_dir
+    python rate_index.py query index --type CPT --code 90935 --npi 1508935891
+
+    with RateIndex('index') as index:
+        index.rates('CPT', '90935', 1508935891)
+
+Each index is a file of fixed-width big-endian records sorted by their
+first field, memory-mapped and binary searched:
+
+  npi.idx    NPI -> provider group key
+  group.idx  provider group key -> negotiated_rates_hash_key
+  code.idx   (billing code type, billing code) -> in_network_hash_key
+  price.idx  negotiated_rates_hash_key -> (file, byte offset) of its
+             negotiated_prices rows
+  link.idx   in_network_hash_key -> root_hash_key, from in_network_links
+
+A provider group listed inline on a rate is keyed by that rate's
+negotiated_rates_hash_key. A referenced group (`defer_references`) is
+keyed on its (root_hash_key, provider_group_id), following
+provider_group_links when the group was deduplicated (see dedup.py), and
+group.idx leads from it to the rates that reference it. An item
+deduplicated across files is written once, under the root of the first
+file that had it, so link.idx gives every plan that has it and its rows
+are returned once per plan. Hash keys are 16 hex digits, so fit 64
+bits; other keys are hashed to 64 bits.
+
+Indexes are built with an external sort, so memory stays bounded.
+provider_group_links and provider_references are each sorted on the
+group key and merge-joined, rather than the links being held in memory.
+"""
+import os
+import sys
+import csv
+import json
+import mmap
+import heapq
+import struct
+import hashlib
+import logging
+import argparse
+import tempfile
+
+from compact import input_dirs
+
+log = logging.getLogger(__name__)
+
+INDEXES = {
+    'npi':   '>QQ',
+    'group': '>QQ',
+    'code':  '>QQ',
+    'price': '>QQQ',
+    'link':  '>QQ',
+}
+
+RUN_RECORDS = 1_000_000
+
+
+def hash64(*values):
+    """
+    64-bit key for values that aren't a hash key already
+    """
+    return int(hashlib.sha256(json.dumps(values).encode('utf-8')).hexdigest()[:16], 16)
+
+
+def key64(hash_key):
+    return int(hash_key, 16)
+
+
+def _iter_csv(path):
+    """
+    Yields (byte offset, row) for every row of a CSV after the header.
+    Quoted fields can hold newlines, so a record runs until its quotes
+    balance.
+    """
+    with open(path, 'rb') as f:
+        header = None
+        offset = f.tell()
+        record = b''
+
+        for line in iter(f.readline, b''):
+            record += line
+            if record.count(b'"') % 2:
+                continue
+
+            row = next(csv.reader([record.decode('utf-8')]))
+            if header is None:
+                header = row
+            else:
+                yield offset, dict(zip(header, row))
+
+            offset += len(record)
+            record = b''
+
+
+def _tables(dirs, table):
+    for d in dirs:
+        path = os.path.join(d, f'{table}.csv')
+        if os.path.exists(path):
+            yield path
+
+
+def _npi_numbers(value):
+    value = value.strip('[]')
+    return [int(npi) for npi in value.split(',') if npi.strip()]
+
+
+class SortedWriter:
+    """
+    Writes records to `path` sorted and without duplicates, spilling
+    sorted runs of `run_records` to disk
+    """
+
+    def __init__(self, path, fmt, run_records = RUN_RECORDS):
+        self.path = path
+        self.struct = struct.Struct(fmt)
+        self.run_records = run_records
+        self.run_dir = tempfile.mkdtemp(prefix = '.runs_', dir = os.path.dirname(path))
+        self.runs = []
+        self.records = []
+
+    def add(self, *values):
+        self.records.append(self.struct.pack(*values))
+        if len(self.records) >= self.run_records:
+            self._spill()
+
+    def _spill(self):
+        path = os.path.join(self.run_dir, f'run_{len(self.runs)}')
+        with open(path, 'wb') as f:
+            f.writelines(sorted(set(self.records)))
+        self.runs.append(path)
+        self.records = []
+
+    def _iter_run(self, path):
+        size = self.struct.size
+        with open(path, 'rb') as f:
+            while record := f.read(size):
+                yield record
+
+    def close(self):
+        self._spill()
+        n = 0
+        last = None
+
+        with open(f'{self.path}.part', 'wb') as f:
+            for record in heapq.merge(*(self._iter_run(p) for p in self.runs)):
+                if record != last:
+                    f.write(record)
+                    n += 1
+                    last = record
+
+        os.replace(f'{self.path}.part', self.path)
+        for path in self.runs:
+            os.remove(path)
+        os.rmdir(self.run_dir)
+        return n
+
+
+def _iter_records(path, fmt):
+    record = struct.Struct(fmt)
+    with open(path, 'rb') as f:
+        while data := f.read(record.size):
+            yield record.unpack(data)
+
+
+def _resolve_links(references, links):
+    """
+    Merge-joins (group key, rate key) references with (group key, source
+    group key) links, both sorted on the group key. Yields each rate
+    under its source group if the group was deduplicated, otherwise under
+    its own.
+    """
+    links = iter(links)
+    link = next(links, None)
+
+    for group_key, rate_key in references:
+        while link is not None and link[0] < group_key:
+            link = next(links, None)
+
+        if link is not None and link[0] == group_key:
+            yield link[1], rate_key
+        else:
+            yield group_key, rate_key
+
+
+def build_index(inputs, index_dir, run_records = RUN_RECORDS):
+    """
+    Builds the indexes for the output directories or ShardSets in
+    `inputs` into `index_dir`. Returns the number of records per index.
+    """
+    dirs = input_dirs(inputs)
+    os.makedirs(index_dir, exist_ok = True)
+    writers = {
+        name: SortedWriter(os.path.join(index_dir, f'{name}.idx'), fmt, run_records)
+        for name, fmt in INDEXES.items()
+    }
+
+    for path in _tables(dirs, 'provider_groups'):
+        for _, row in _iter_csv(path):
+            if row['negotiated_rates_hash_key']:
+                group_key = key64(row['negotiated_rates_hash_key'])
+            else:
+                group_key = hash64(row['root_hash_key'], row['provider_group_id'])
+
+            for npi in _npi_numbers(row['npi_numbers']):
+                writers['npi'].add(npi, group_key)
+
+    # Both sides of the join are sorted into temporary files next to
+    # the indexes
+    joined = {
+        name: SortedWriter(os.path.join(index_dir, f'.{name}'), '>QQ', run_records)
+        for name in ('links', 'references')
+    }
+
+    for path in _tables(dirs, 'provider_group_links'):
+        for _, row in _iter_csv(path):
+            joined['links'].add(
+                hash64(row['root_hash_key'], row['provider_group_id']),
+                hash64(row['source_root_hash_key'], row['source_provider_group_id']),
+            )
+
+    for path in _tables(dirs, 'provider_references'):
+        for _, row in _iter_csv(path):
+            joined['references'].add(
+                hash64(row['root_hash_key'], row['provider_group_id']),
+                key64(row['negotiated_rates_hash_key']),
+            )
+
+    for writer in joined.values():
+        writer.close()
+
+    try:
+        for group_key, rate_key in _resolve_links(
+            _iter_records(joined['references'].path, '>QQ'),
+            _iter_records(joined['links'].path, '>QQ'),
+        ):
+            writers['group'].add(group_key, rate_key)
+    finally:
+        for writer in joined.values():
+            os.remove(writer.path)
+
+    for path in _tables(dirs, 'in_network'):
+        for _, row in _iter_csv(path):
+            writers['code'].add(
+                hash64(row['billing_code_type'], row['billing_code']),
+                key64(row['in_network_hash_key']),
+            )
+
+    for path in _tables(dirs, 'in_network_links'):
+        for _, row in _iter_csv(path):
+            writers['link'].add(key64(row['in_network_hash_key']), key64(row['root_hash_key']))
+
+    files = list(_tables(dirs, 'negotiated_prices'))
+    for i, path in enumerate(files):
+        for offset, row in _iter_csv(path):
+            writers['price'].add(key64(row['negotiated_rates_hash_key']), i, offset)
+
+    counts = {name: writer.close() for name, writer in writers.items()}
+
+    with open(os.path.join(index_dir, 'meta.json'), 'w') as f:
+        json.dump({'files': [os.path.abspath(p) for p in files], 'counts': counts}, f)
+
+    log.info(f'Built {index_dir}: {counts}')
+    return counts
+
+
+class SortedFile:
+    """
+    A memory-mapped index file, binary searched on its first field
+    """
+
+    def __init__(self, path, fmt):
+        self.struct = struct.Struct(fmt)
+        self.f = open(path, 'rb')
+        size = os.path.getsize(path)
+        self.n = size // self.struct.size
+        self.mm = mmap.mmap(self.f.fileno(), 0, access = mmap.ACCESS_READ) if size else b''
+
+    def lookup(self, key):
+        """
+        The rest of the fields of every record whose first is `key`
+        """
+        size = self.struct.size
+        target = struct.pack('>Q', key)
+        lo, hi = 0, self.n
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.mm[mid * size:mid * size + 8] < target:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        results = []
+        while lo < self.n:
+            record = self.struct.unpack_from(self.mm, lo * size)
+            if record[0] != key:
+                break
+            results.append(record[1:])
+            lo += 1
+        return results
+
+    def close(self):
+        if self.n:
+            self.mm.close()
+        self.f.close()
+
+
+class RateIndex:
+    """
+    Queries over an index built by `build_index`. Keys come back as the
+    hex hash keys used in the tables.
+    """
+
+    def __init__(self, index_dir):
+        with open(os.path.join(index_dir, 'meta.json')) as f:
+            self.files = json.load(f)['files']
+        self.indexes = {
+            name: SortedFile(os.path.join(index_dir, f'{name}.idx'), fmt)
+            for name, fmt in INDEXES.items()
+        }
+        # file id -> (open file, header)
+        self._files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        for index in self.indexes.values():
+            index.close()
+        for f, _ in self._files.values():
+            f.close()
+
+    def _open(self, file_id):
+        if file_id not in self._files:
+            f = open(self.files[file_id], 'rb')
+            header = next(csv.reader([f.readline().decode('utf-8')]))
+            self._files[file_id] = f, header
+        return self._files[file_id]
+
+    def negotiated_rates_keys(self, npi):
+        """
+        negotiated_rates_hash_keys of the rates whose provider groups
+        include `npi`
+        """
+        keys = set()
+        for (group_key,) in self.indexes['npi'].lookup(int(npi)):
+            referenced = self.indexes['group'].lookup(group_key)
+            if referenced:
+                keys.update(k for (k,) in referenced)
+            else:
+                keys.add(group_key)
+        return {f'{k:016x}' for k in keys}
+
+    def in_network_keys(self, billing_code_type, billing_code):
+        key = hash64(billing_code_type, str(billing_code))
+        return {f'{k:016x}' for (k,) in self.indexes['code'].lookup(key)}
+
+    def prices(self, negotiated_rates_hash_key):
+        """
+        negotiated_prices rows of one rate, read from the output files
+        """
+        rows = []
+        for file_id, offset in self.indexes['price'].lookup(key64(negotiated_rates_hash_key)):
+            f, header = self._open(file_id)
+            f.seek(offset)
+            record = f.readline()
+            while record.count(b'"') % 2:
+                record += f.readline()
+            rows.append(dict(zip(header, next(csv.reader([record.decode('utf-8')])))))
+        return rows
+
+    def root_hash_keys(self, in_network_hash_key):
+        """
+        Every plan linked to a deduplicated item, or an empty set
+        """
+        return {f'{k:016x}' for (k,) in self.indexes['link'].lookup(key64(in_network_hash_key))}
+
+    def rates(self, billing_code_type, billing_code, npi):
+        """
+        negotiated_prices rows for `billing_code` at `npi`, across every
+        plan in the index. Rows of a deduplicated item come once per plan
+        that links to it, with that plan's root_hash_key.
+        """
+        in_network_keys = self.in_network_keys(billing_code_type, billing_code)
+        if not in_network_keys:
+            return []
+
+        roots = {key: sorted(self.root_hash_keys(key)) for key in in_network_keys}
+
+        rows = []
+        for key in sorted(self.negotiated_rates_keys(npi)):
+            for r in self.prices(key):
+                if r['in_network_hash_key'] not in in_network_keys:
+                    continue
+                if linked := roots[r['in_network_hash_key']]:
+                    rows.extend({**r, 'root_hash_key': root} for root in linked)
+                else:
+                    rows.append(r)
+        return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest = 'command', required = True)
+
+    build = commands.add_parser('build', help = 'index output directories or ShardSets')
+    build.add_argument('inputs', nargs = '+')
+    build.add_argument('-o', '--out', required = True)
+
+    query = commands.add_parser('query', help = 'negotiated prices for a code at an NPI')
+    query.add_argument('index')
+    query.add_argument('-t', '--type', required = True, help = 'billing_code_type, eg. CPT')
+    query.add_argument('-c', '--code', required = True)
+    query.add_argument('-n', '--npi', required = True, type = int)
+
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.INFO)
+
+    if args.command == 'build':
+        build_index(args.inputs, args.out)
+    else:
+        with RateIndex(args.index) as index:
+            writer = csv.writer(sys.stdout)
+            for row in index.rates(args.type, args.code, args.npi):
+                writer.writerow(row.values())
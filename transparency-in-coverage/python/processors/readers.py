@@ -0,0 +1,612 @@
+import io
+import os
+import re
+import mmap
+import bz2
+import lzma
+import zipfile
+import tempfile
+import time
+import queue
+import shutil
+import logging
+import threading
+import multiprocessing
+import subprocess
+from contextlib import ExitStack
+import zlib
+import gzip
+
+log = logging.getLogger(__name__)
+
+# zlib/gzip magic number: 31 tells zlib to expect a gzip header
+GZIP_WBITS = 31
+EXTERNAL_GUNZIPS = ('igzip', 'pigz')
+
+READ_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Longest magic number is xz's (6 bytes)
+MAGIC_NUMBERS = (
+    (b'\x1f\x8b',                  'gzip'),
+    (b'\x28\xb5\x2f\xfd',          'zstd'),
+    (b'\xfd7zXZ\x00',              'xz'),
+    (b'BZh',                       'bz2'),
+    (b'PK\x03\x04',                'zip'),
+)
+SNIFF_SIZE = max(len(magic) for magic, _ in MAGIC_NUMBERS)
+
+# Everything up to and including the next bracket outside of a string.
+# Unrolled so that a failed match doesn't backtrack more than once.
+_NEXT_BRACKET = re.compile(
+    rb'[^\[\]{}"]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^\[\]{}"]*)*([\[\]{}])', re.DOTALL
+)
+_OPENING = b'[{'
+_VALUE_SEPARATOR = re.compile(rb'\s*,?')
+
+
+def sniff_compression(head):
+    """
+    Returns the compression format named by the magic number at the start
+    of `head`, or None if it looks uncompressed
+    """
+    for magic, compression in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return compression
+
+
+def open_zstd(fileobj, read_size = READ_BUFFER_SIZE):
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('Reading .zst files requires the zstandard package')
+
+    # MRFs are often compressed with --long, which needs a larger window
+    dctx = zstandard.ZstdDecompressor(max_window_size = 2**31)
+    reader = dctx.stream_reader(fileobj, read_size = read_size)
+    return io.BufferedReader(reader, buffer_size = read_size)
+
+
+def open_zip_member(fileobj):
+    """
+    Opens the first JSON member of a zip archive. Zip needs random
+    access to find its central directory, so unseekable streams are
+    spooled to a temporary file first.
+
+    Returns the member and an ExitStack that closes the archive and the
+    spool.
+    """
+    stack = ExitStack()
+
+    try:
+        if not fileobj.seekable():
+            spool = stack.enter_context(tempfile.TemporaryFile())
+            shutil.copyfileobj(fileobj, spool, READ_BUFFER_SIZE)
+            spool.seek(0)
+            fileobj = spool
+
+        zf = stack.enter_context(zipfile.ZipFile(fileobj))
+        names = [n for n in zf.namelist() if not n.endswith('/')]
+        json_names = [n for n in names if '.json' in n]
+
+        if not names:
+            raise zipfile.BadZipFile('Empty zip archive')
+
+        member = zf.open((json_names or names)[0])
+    except BaseException:
+        stack.close()
+        raise
+
+    return member, stack
+
+
+def open_decompressed(fileobj, compression):
+    """
+    Wraps a binary file object in a streaming decompressor for
+    `compression` (as returned by `sniff_compression`). Returns the
+    wrapped file and any extra object that must be closed with it.
+    """
+    if compression == 'zstd':
+        return open_zstd(fileobj), None
+
+    elif compression == 'xz':
+        return lzma.LZMAFile(fileobj), None
+
+    elif compression == 'bz2':
+        return bz2.BZ2File(fileobj), None
+
+    elif compression == 'zip':
+        return open_zip_member(fileobj)
+
+    elif compression == 'gzip':
+        return gzip.GzipFile(fileobj = fileobj), None
+
+    return fileobj, None
+
+
+class MmapReader(io.RawIOBase):
+    """
+    Read-only binary file object over a memory-mapped local file.
+
+    `readinto` copies straight out of the mapping into the caller's
+    buffer, and `view` hands out zero-copy memoryview slices for callers
+    that can work on them directly. `read` has to return `bytes` (ijson
+    checks for it), which costs a single copy but skips the text layer's
+    decode pass.
+
+    `tell` and `seek` work in byte offsets of the underlying file. Note
+    that the parser reads ahead, so `tell` is the offset of the end of
+    the last chunk handed to it rather than of the last event.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self.size = os.fstat(self._file.fileno()).st_size
+
+        if self.size:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access = mmap.ACCESS_READ)
+            if hasattr(self._mmap, 'madvise'):
+                self._mmap.madvise(mmap.MADV_SEQUENTIAL)
+            self._view = memoryview(self._mmap)
+        else:
+            self._mmap = None
+            self._view = memoryview(b'')
+
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+
+        self._pos = min(max(offset, 0), self.size)
+        return self._pos
+
+    def view(self, start = None, stop = None):
+        """
+        Zero-copy slice of the file between two byte offsets
+        """
+        return self._view[start:stop]
+
+    def peek(self, size = 1):
+        return self._view[self._pos:self._pos + size].tobytes()
+
+    def read(self, size = -1):
+        if size is None or size < 0:
+            size = self.size - self._pos
+
+        chunk = self._view[self._pos:self._pos + size]
+        self._pos += len(chunk)
+        return chunk.tobytes()
+
+    def readinto(self, b):
+        chunk = self._view[self._pos:self._pos + len(b)]
+        n = len(chunk)
+        memoryview(b).cast('B')[:n] = chunk
+        self._pos += n
+        return n
+
+    def close(self):
+        if self.closed:
+            return
+
+        self._view.release()
+
+        if self._mmap:
+            self._mmap.close()
+
+        self._file.close()
+        super().close()
+
+
+def find_array(data, key):
+    """
+    Offset just past the `[` that opens the array under `key` in the
+    top-level object of the JSON in `data` (eg. an MmapReader's `view`),
+    or None. Only brackets are looked at, so this is much faster than
+    parsing.
+    """
+    key_before = re.compile(rb'"' + re.escape(key) + rb'"\s*:\s*\Z')
+    depth = pos = 0
+
+    while (m := _NEXT_BRACKET.match(data, pos)):
+        pos = m.end()
+
+        if data[pos - 1] in _OPENING:
+            if depth == 1 and key_before.search(bytes(data[max(0, pos - 256):pos - 1])):
+                return pos
+            depth += 1
+        else:
+            depth -= 1
+
+
+def skip_values(data, pos, n):
+    """
+    Offset of what follows the next `n` values of a JSON array in
+    `data`, from `pos` between two of them, past any comma. None if the
+    array ends first. The values have to be objects or arrays.
+    """
+    depth = 0
+
+    while n and (m := _NEXT_BRACKET.match(data, pos)):
+        pos = m.end()
+
+        if data[pos - 1] in _OPENING:
+            depth += 1
+        else:
+            depth -= 1
+            if depth < 0:
+                return None
+            if depth == 0:
+                n -= 1
+
+    if n:
+        return None
+
+    return _VALUE_SEPARATOR.match(data, pos).end()
+
+
+class PrefixedReader(io.RawIOBase):
+    """
+    Reads `prefix`, then the rest of `f`. Puts a parser back in the
+    middle of a document, eg. `b'{"in_network":['` and a file seeked to
+    the start of an item.
+    """
+
+    def __init__(self, prefix, f):
+        self.prefix = prefix
+        self.f = f
+
+    def readable(self):
+        return True
+
+    def read(self, size = -1):
+        # ijson reads nothing first, to check for bytes
+        if size == 0:
+            return b''
+
+        if self.prefix:
+            data, self.prefix = self.prefix, b''
+            return data
+
+        return self.f.read(size)
+
+
+def find_external_gunzip():
+    """
+    Returns the path of the first external gzip decompressor found on the
+    PATH, or None
+    """
+    for cmd in EXTERNAL_GUNZIPS:
+        if (path := shutil.which(cmd)):
+            return path
+
+
+class PipelinedReader(io.RawIOBase):
+    """
+    Read-only file-like object that inflates a gzip stream on a
+    background thread.
+
+    Decompressed data is collected into buffers of `buffer_size` bytes
+    and handed over through a queue holding at most `n_buffers` of them,
+    so the inflater can run ahead of the parser by a bounded amount.
+    zlib releases the GIL while inflating, which lets decompression and
+    parsing overlap.
+
+    Pass either `fileobj` (eg. `requests.Response.raw`) or `path`. With
+    `external = True` and `igzip` or `pigz` on the PATH, inflating is done
+    by that process instead of zlib.
+    """
+
+    def __init__(
+        self,
+        fileobj = None,
+        path = None,
+        buffer_size = 4 * 1024 * 1024,
+        n_buffers = 8,
+        read_size = 1024 * 1024,
+        external = False,
+    ):
+        if (fileobj is None) == (path is None):
+            raise ValueError('Pass exactly one of fileobj or path')
+
+        self.fileobj = fileobj
+        self.path = path
+        self.buffer_size = buffer_size
+        self.read_size = read_size
+
+        self._queue = queue.Queue(maxsize = n_buffers)
+        self._stop = threading.Event()
+        self._buf = memoryview(b'')
+        self._pos = 0
+        self._eof = False
+        self._proc = None
+        self._threads = []
+
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.read_time = 0.0
+        self.inflate_time = 0.0
+        self.wait_time = 0.0
+        self.start_time = time.perf_counter()
+
+        gunzip = find_external_gunzip() if external else None
+
+        if gunzip:
+            self._start_external(gunzip)
+        else:
+            self._start_thread(self._inflate)
+
+    def _start_thread(self, target):
+        thread = threading.Thread(target = target, daemon = True)
+        thread.start()
+        self._threads.append(thread)
+
+    def _start_external(self, gunzip):
+        log.info(f'Decompressing with {gunzip}')
+
+        if self.path:
+            self.bytes_in = os.path.getsize(self.path)
+            self._proc = subprocess.Popen(
+                [gunzip, '-d', '-c', self.path],
+                stdout = subprocess.PIPE,
+            )
+        else:
+            self._proc = subprocess.Popen(
+                [gunzip, '-d', '-c'],
+                stdin = subprocess.PIPE,
+                stdout = subprocess.PIPE,
+            )
+            self._start_thread(self._feed)
+
+        self._start_thread(self._drain)
+
+    def _put(self, item):
+        # Blocks while the ring is full, but wakes up to notice close()
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout = 0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _read_source(self, f):
+        s = time.perf_counter()
+        chunk = f.read(self.read_size)
+        self.read_time += time.perf_counter() - s
+        self.bytes_in += len(chunk)
+        return chunk
+
+    def _inflate(self):
+        f = self.fileobj if self.fileobj is not None else open(self.path, 'rb')
+        d = zlib.decompressobj(GZIP_WBITS)
+        out = []
+        out_size = 0
+
+        try:
+            while not self._stop.is_set():
+                chunk = self._read_source(f)
+
+                if not chunk:
+                    break
+
+                while chunk:
+                    s = time.perf_counter()
+                    data = d.decompress(chunk)
+                    self.inflate_time += time.perf_counter() - s
+
+                    out.append(data)
+                    out_size += len(data)
+
+                    # Concatenated gzip members (eg. from pigz). Like
+                    # GzipFile, NUL padding after a member is skipped
+                    if d.eof and d.unused_data:
+                        chunk = d.unused_data.lstrip(b'\0')
+                        if chunk:
+                            d = zlib.decompressobj(GZIP_WBITS)
+                    else:
+                        chunk = None
+
+                if out_size >= self.buffer_size:
+                    if not self._put(b''.join(out)):
+                        return
+                    out, out_size = [], 0
+
+            if not d.eof and self.bytes_in:
+                raise zlib.error('Compressed stream ended before the end-of-stream marker')
+
+            if out:
+                self._put(b''.join(out))
+
+            self._put(None)
+
+        except Exception as e:
+            self._put(e)
+
+        finally:
+            if self.fileobj is None:
+                f.close()
+
+    def _feed(self):
+        try:
+            while not self._stop.is_set():
+                chunk = self._read_source(self.fileobj)
+                if not chunk:
+                    break
+                self._proc.stdin.write(chunk)
+        except (BrokenPipeError, ValueError):
+            pass
+        finally:
+            try:
+                self._proc.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def _drain(self):
+        try:
+            while not self._stop.is_set():
+                s = time.perf_counter()
+                data = self._proc.stdout.read(self.buffer_size)
+                self.inflate_time += time.perf_counter() - s
+
+                if not data:
+                    break
+
+                if not self._put(data):
+                    return
+
+            if self._proc.wait() != 0:
+                raise zlib.error(f'External decompressor exited with {self._proc.returncode}')
+
+            self._put(None)
+
+        except Exception as e:
+            self._put(e)
+
+    def _next_buffer(self):
+        s = time.perf_counter()
+        item = self._queue.get()
+        self.wait_time += time.perf_counter() - s
+
+        if isinstance(item, Exception):
+            self._eof = True
+            raise item
+
+        if item is None:
+            self._eof = True
+            return False
+
+        self._buf = memoryview(item)
+        self._pos = 0
+        return True
+
+    def readable(self):
+        return True
+
+    def peek(self, size = 1):
+        while self._pos >= len(self._buf) and not self._eof:
+            self._next_buffer()
+        return bytes(self._buf[self._pos:self._pos + size])
+
+    def read(self, size = -1):
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(self.buffer_size), b''))
+
+        while self._pos >= len(self._buf):
+            if self._eof or not size or not self._next_buffer():
+                return b''
+
+        chunk = self._buf[self._pos:self._pos + size]
+        self._pos += len(chunk)
+        self.bytes_out += len(chunk)
+        return bytes(chunk)
+
+    def readinto(self, b):
+        chunk = self.read(len(b))
+        b[:len(chunk)] = chunk
+        return len(chunk)
+
+    def stats(self):
+        """
+        Throughput of each stage in MB/s. `parse` is measured over the
+        time the consumer spent not waiting for data.
+        """
+        elapsed = time.perf_counter() - self.start_time
+        mb_in = self.bytes_in / 1_000_000
+        mb_out = self.bytes_out / 1_000_000
+
+        def rate(mb, secs):
+            return round(mb / secs, 3) if secs > 0 else None
+
+        return {
+            'mb_in':        round(mb_in, 3),
+            'mb_out':       round(mb_out, 3),
+            'elapsed':      round(elapsed, 3),
+            'read_mbps':    rate(mb_in, self.read_time),
+            'inflate_mbps': rate(mb_out, self.inflate_time),
+            'parse_mbps':   rate(mb_out, elapsed - self.wait_time),
+            'overall_mbps': rate(mb_out, elapsed),
+        }
+
+    def close(self):
+        if self.closed:
+            return
+
+        self._stop.set()
+
+        if self._proc:
+            self._proc.kill()
+            self._proc.wait()
+
+        for thread in self._threads:
+            thread.join(timeout = 1)
+
+        log.info(f'Decompression stats: {self.stats()}')
+        super().close()
+
+
+class RateLimiter:
+    """
+    Token bucket of `rate` bytes a second, shared by every process it's
+    handed to when they start (eg. through a pool's initializer). Reads
+    may run ahead by up to `burst` bytes; after that, `consume` sleeps
+    until the average is back under `rate`.
+    """
+
+    def __init__(self, rate, burst = None):
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = multiprocessing.Value('d', self.burst)
+        self._stamp = multiprocessing.Value('d', time.monotonic(), lock = False)
+
+    def consume(self, n):
+        with self._tokens.get_lock():
+            now = time.monotonic()
+            tokens = min(self.burst, self._tokens.value + (now - self._stamp.value) * self.rate)
+            self._tokens.value = tokens - n
+            self._stamp.value = now
+
+        if tokens < n:
+            time.sleep((n - tokens) / self.rate)
+
+
+class ThrottledReader(io.RawIOBase):
+    """
+    Raw file object that takes the bytes `raw` reads out of a
+    RateLimiter. They're counted by `raw.tell()`, which for a urllib3
+    response is what came over the wire, before any Content-Encoding
+    was undone.
+    """
+
+    def __init__(self, raw, limiter):
+        self.raw = raw
+        self.limiter = limiter
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        start = self.raw.tell()
+        n = self.raw.readinto(b)
+        if (wire := self.raw.tell() - start):
+            self.limiter.consume(wire)
+        return n
+
+    def tell(self):
+        return self.raw.tell()
+
+    def close(self):
+        if not self.closed:
+            self.raw.close()
+        super().close()
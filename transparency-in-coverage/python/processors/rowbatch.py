@@ -0,0 +1,192 @@
+"""
+Batched rows for the flattener. Instead of a `Row(filename, dict)` per
+in_network item, provider group, negotiated price and bundle, a RowBatch
+keeps one list per table and appends a plain tuple of column values (in
+SCHEMA order) per row. The tuples are built through a `layout` per
+table, so a change to SCHEMA's column order can't shift values into the
+wrong columns. Tuples are a single small allocation, don't take
+part in GC cycles once filled, and go straight into `csv.writer`.
+
+    batch = RowBatch()
+    for item in items:
+        batch.add_item(item, root_hash_key)
+    writer.write_batch(batch, root_data, out_dir)
+"""
+from operator import itemgetter
+
+from schema import SCHEMA
+from mrfutils import Row, hashdict, in_network_row
+
+COLUMNS = {table: tuple(columns) for table, columns in SCHEMA.items()}
+
+
+def layout(table, fields):
+    """
+    Returns a function that takes a tuple of values for `fields`, in
+    that order, and returns the row tuple in the column order of
+    COLUMNS[table], with None for the columns not in `fields`
+    """
+    columns = COLUMNS[table]
+    fields = tuple(fields)
+
+    if unknown := [f for f in fields if f not in columns]:
+        raise KeyError(f'{table} has no columns {unknown}')
+
+    if columns[:len(fields)] == fields:
+        pad = (None,) * (len(columns) - len(fields))
+        return (lambda values: values + pad) if pad else tuple
+
+    # Missing columns read the None appended after the values
+    getter = itemgetter(*(fields.index(c) if c in fields else len(fields) for c in columns))
+    return lambda values: getter(values + (None,))
+
+
+BUNDLED_CODE = layout('bundled_codes', (
+    'root_hash_key',
+    'in_network_hash_key',
+    'billing_code_type_version',
+    'description',
+    'billing_code',
+    'billing_code_type',
+))
+
+PROVIDER_GROUP = layout('provider_groups', (
+    'root_hash_key',
+    'in_network_hash_key',
+    'negotiated_rates_hash_key',
+    'tin_type',
+    'tin_value',
+    'npi_numbers',
+))
+
+PROVIDER_REFERENCE = layout('provider_references', (
+    'root_hash_key',
+    'in_network_hash_key',
+    'negotiated_rates_hash_key',
+    'provider_group_id',
+))
+
+NEGOTIATED_PRICE = layout('negotiated_prices', (
+    'root_hash_key',
+    'in_network_hash_key',
+    'negotiated_rates_hash_key',
+    'billing_class',
+    'negotiated_type',
+    'service_code',
+    'expiration_date',
+    'additional_information',
+    'billing_code_modifier',
+    'negotiated_rate',
+))
+
+
+class RowBatch:
+    """
+    Per-table lists of row tuples, in the column order of COLUMNS
+    """
+
+    __slots__ = ('tables',)
+
+    def __init__(self):
+        self.tables = {table: [] for table in COLUMNS}
+
+    def __len__(self):
+        return sum(len(rows) for rows in self.tables.values())
+
+    def add_item(self, item, root_hash_key, in_network_hash_key = None):
+        """
+        Same rows as `in_network_item_to_rows`. `in_network_hash_key`
+        replaces the item's own, eg. with a dedup.content_key.
+        """
+        in_network = in_network_row(item, root_hash_key)
+        if in_network_hash_key:
+            in_network.data['in_network_hash_key'] = in_network_hash_key
+        self.extend_rows([in_network])
+
+        in_network_hash_key = in_network.data['in_network_hash_key']
+
+        for neg_rate in item.get('negotiated_rates', []):
+            self.add_rate(neg_rate, in_network_hash_key, root_hash_key)
+
+        bundles = self.tables['bundled_codes']
+
+        for bundle in item.get('bundled_codes', []):
+            bundles.append(BUNDLED_CODE((
+                root_hash_key,
+                in_network_hash_key,
+                bundle['billing_code_type_version'],
+                bundle['description'],
+                bundle['billing_code'],
+                bundle['billing_code_type'],
+            )))
+
+    def add_rate(self, neg_rate, in_network_hash_key, root_hash_key):
+        """
+        Same rows as `negotiated_rate_to_rows`
+        """
+        neg_rates_hash_key = hashdict(neg_rate)
+
+        groups = self.tables['provider_groups']
+
+        for provider_group in neg_rate.get('provider_groups', []):
+            groups.append(PROVIDER_GROUP((
+                root_hash_key,
+                in_network_hash_key,
+                neg_rates_hash_key,
+                provider_group['tin']['type'],
+                provider_group['tin']['value'],
+                provider_group['npi'],
+            )))
+
+        references = self.tables['provider_references']
+
+        for provider_group_id in neg_rate.get('provider_references', []):
+            references.append(PROVIDER_REFERENCE((
+                root_hash_key,
+                in_network_hash_key,
+                neg_rates_hash_key,
+                provider_group_id,
+            )))
+
+        prices = self.tables['negotiated_prices']
+
+        for neg_price in neg_rate['negotiated_prices']:
+            prices.append(NEGOTIATED_PRICE((
+                root_hash_key,
+                in_network_hash_key,
+                neg_rates_hash_key,
+                neg_price['billing_class'],
+                neg_price['negotiated_type'],
+                None if not (v := neg_price.get('service_code')) else v,
+                neg_price['expiration_date'],
+                neg_price.get('additional_information'),
+                None if not (v := neg_price.get('billing_code_modifier')) else v,
+                neg_price['negotiated_rate'],
+            )))
+
+    def extend_rows(self, rows):
+        """
+        Adds `Row(filename, dict)` objects, eg. from `in_network_row_batches`
+        """
+        for filename, data in rows:
+            self.tables[filename].append(
+                tuple(data.get(column) for column in COLUMNS[filename])
+            )
+
+    def extend(self, other):
+        for table, rows in other.tables.items():
+            self.tables[table].extend(rows)
+
+    def column(self, table, name):
+        i = COLUMNS[table].index(name)
+        return [row[i] for row in self.tables[table]]
+
+    def rows(self):
+        """
+        Yields a `Row(filename, dict)` per row, for code that still needs
+        one object per row
+        """
+        for table, rows in self.tables.items():
+            columns = COLUMNS[table]
+            for values in rows:
+                yield Row(table, dict(zip(columns, values)))
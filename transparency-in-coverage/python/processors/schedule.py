@@ -0,0 +1,400 @@
+"""
+Crawls the in_network files of downloader catalogs with a pool of
+workers, within bandwidth and disk budgets.
+
+    python schedule.py ../downloaders/uhc_data.db ../downloaders/aetna_data.db \\
+        -o crawl -w 8 --bandwidth 200 --disk 500 -n npis.csv
+
+Files are handed out longest-processing-time first: largest first (by
+the catalog's `size`), each to the next worker that comes free, so the
+longest files aren't left for the end. Files without a known size go
+last. `lpt_plan` shows how the sizes split across workers.
+
+Budgets:
+
+  - `bandwidth` (bytes a second) is shared by every worker through a
+    readers.RateLimiter, for streamed files and downloads alike
+  - `disk` (bytes) bounds what running files take up: a staged file's
+    own size, plus `output_ratio` of its size for the output. A file
+    only starts once its share fits next to those already running, or
+    when nothing else is.
+
+A file that fits the disk budget is staged: downloaded to
+`{out_dir}/.staged` (a partial download carries on where it stopped),
+flattened from disk and deleted. Larger files, and every file without a
+disk budget, are streamed from their URL. Each file is written as a
+shard of `out_dir` (see shards.py), with checkpoints. Shards,
+checkpoints and catalog entries are keyed on the URL, staged or not.
+
+The queue is a SQLite file, `{out_dir}/queue.db` by default. A crawl
+that was killed carries on when run again: files that were running go
+back in the queue and resume from their checkpoints. Files that fail
+are retried up to `max_attempts` times.
+"""
+import os
+import time
+import heapq
+import sqlite3
+import hashlib
+import logging
+import argparse
+from pathlib import Path
+from urllib.parse import urlparse
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+
+from core import run
+from codes import import_code_spec
+from mrfutils import import_set
+from shards import ShardSet, ShardLocked
+from readers import RateLimiter, READ_BUFFER_SIZE
+
+log = logging.getLogger(__name__)
+
+STAGED = 'staged'
+STREAMED = 'streamed'
+
+# Bytes of output expected per byte of input
+OUTPUT_RATIO = 0.1
+MAX_ATTEMPTS = 3
+CHECKPOINT_INTERVAL = 60
+
+
+def lpt_plan(sizes, workers):
+    """
+    Longest-processing-time-first assignment of jobs of `sizes` to
+    `workers`. Returns the job indexes of each worker and each worker's
+    total size.
+    """
+    heap = [(0, w) for w in range(workers)]
+    plan = [[] for _ in range(workers)]
+    loads = [0] * workers
+
+    for i in sorted(range(len(sizes)), key = lambda i: -sizes[i]):
+        load, w = heapq.heappop(heap)
+        plan[w].append(i)
+        loads[w] = load + sizes[i]
+        heapq.heappush(heap, (loads[w], w))
+
+    return plan, loads
+
+
+def choose_strategy(size, disk, output_ratio = OUTPUT_RATIO):
+    if disk is not None and size is not None and size * (1 + output_ratio) <= disk:
+        return STAGED
+    return STREAMED
+
+
+def reservation(size, strategy, output_ratio = OUTPUT_RATIO):
+    """
+    Bytes of disk a file is expected to take up while it runs
+    """
+    if size is None:
+        return 0
+    output = round(size * output_ratio)
+    return size + output if strategy == STAGED else output
+
+
+def staged_path(out_dir, url):
+    """
+    Where a file is downloaded to. The name keeps the URL's, so it's
+    easy to tell which file it is.
+    """
+    name = Path(urlparse(url).path).name
+    key = hashlib.sha256(url.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(out_dir, '.staged', f'{key}_{name}')
+
+
+def stage(url, path, limiter = None):
+    """
+    Downloads `url` to `path`, carrying on from `{path}.part` if an
+    earlier download stopped
+    """
+    if os.path.exists(path):
+        return path
+
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    part = f'{path}.part'
+    start = os.path.getsize(part) if os.path.exists(part) else 0
+    headers = {'Range': f'bytes={start}-'} if start else {}
+
+    with requests.get(url, stream = True, headers = headers) as r:
+        # The part file already holds the whole file
+        if r.status_code == 416:
+            os.replace(part, path)
+            return path
+
+        r.raise_for_status()
+        if r.status_code != 206:
+            start = 0
+
+        with open(part, 'ab' if start else 'wb') as f:
+            wire = 0
+            for chunk in r.iter_content(READ_BUFFER_SIZE):
+                # Bytes that came over the wire, before Content-Encoding
+                # was undone
+                if limiter:
+                    limiter.consume(r.raw.tell() - wire)
+                    wire = r.raw.tell()
+                f.write(chunk)
+
+    os.replace(part, path)
+    log.info(f'Staged {url} ({os.path.getsize(path)} bytes)')
+    return path
+
+
+class CrawlQueue:
+    """
+    The files of a crawl and their state (pending, running, done or
+    failed), in a SQLite file owned by one scheduler at a time
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'url TEXT PRIMARY KEY, catalog TEXT, size INTEGER, state TEXT, strategy TEXT, '
+            'reserved INTEGER, attempts INTEGER, started_at REAL, finished_at REAL, error TEXT)'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, size)')
+        self.conn.commit()
+
+    def add_catalog(self, catalog_path):
+        """
+        Queues the files of a downloader catalog that aren't queued yet.
+        Returns how many were added.
+        """
+        con = sqlite3.connect(catalog_path)
+        rows = con.execute('SELECT url, size FROM in_network_files').fetchall()
+        con.close()
+
+        before = self.conn.total_changes
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO jobs (url, catalog, size, state, attempts) VALUES (?, ?, ?, 'pending', 0)",
+            # Downloaders record -1 when there was no content-length
+            [(url, catalog_path, size if size is not None and size >= 0 else None) for url, size in rows],
+        )
+        self.conn.commit()
+        return self.conn.total_changes - before
+
+    def recover(self):
+        """
+        Puts files left running by a crawl that was killed back in the
+        queue. Returns how many there were.
+        """
+        n = self.conn.execute("UPDATE jobs SET state = 'pending' WHERE state = 'running'").rowcount
+        self.conn.commit()
+        if n:
+            log.info(f'Resuming {n} files that were running')
+        return n
+
+    def claim(self, disk = None, output_ratio = OUTPUT_RATIO):
+        """
+        Marks the largest pending file whose disk reservation fits as
+        running and returns it as a dict, or returns None if none fits
+        """
+        reserved, n_running = self.conn.execute(
+            "SELECT IFNULL(SUM(reserved), 0), COUNT(*) FROM jobs WHERE state = 'running'"
+        ).fetchone()
+
+        pending = self.conn.execute(
+            "SELECT url, size, strategy FROM jobs WHERE state = 'pending' "
+            'ORDER BY size IS NULL, size DESC'
+        ).fetchall()
+
+        for url, size, strategy in pending:
+            # Kept from an earlier attempt, whose shard and checkpoint
+            # are keyed on where the file was read from
+            strategy = strategy or choose_strategy(size, disk, output_ratio)
+            need = reservation(size, strategy, output_ratio)
+
+            if disk is None or not n_running or reserved + need <= disk:
+                self.conn.execute(
+                    "UPDATE jobs SET state = 'running', strategy = ?, reserved = ?, started_at = ? WHERE url = ?",
+                    (strategy, need, time.time(), url),
+                )
+                self.conn.commit()
+                return {'url': url, 'size': size, 'strategy': strategy, 'reserved': need}
+
+    def finish(self, url):
+        self.conn.execute(
+            "UPDATE jobs SET state = 'done', reserved = 0, finished_at = ?, error = NULL WHERE url = ?",
+            (time.time(), url),
+        )
+        self.conn.commit()
+
+    def fail(self, url, error, max_attempts = MAX_ATTEMPTS):
+        """
+        Records a failed attempt. Returns True if the file won't be
+        tried again.
+        """
+        self.conn.execute(
+            'UPDATE jobs SET attempts = attempts + 1, reserved = 0, error = ?, '
+            "state = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END "
+            'WHERE url = ?',
+            (error, max_attempts, url),
+        )
+        self.conn.commit()
+        return self.state(url) == 'failed'
+
+    def state(self, url):
+        return self.conn.execute('SELECT state FROM jobs WHERE url = ?', (url,)).fetchone()[0]
+
+    def counts(self):
+        return dict(self.conn.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+
+    def pending_sizes(self):
+        return [size for (size,) in self.conn.execute(
+            "SELECT IFNULL(size, 0) FROM jobs WHERE state = 'pending'"
+        )]
+
+    def close(self):
+        self.conn.close()
+
+
+# Set once per worker process, so that they share the limiter
+_worker_args = {}
+
+
+def _init_worker(limiter, npi_set, code_set, run_kwargs):
+    _worker_args.update(limiter = limiter, npi_set = npi_set, code_set = code_set, run_kwargs = run_kwargs)
+
+
+def crawl_file(url, strategy, out_dir):
+    """
+    Flattens one file into a shard of `out_dir`, staging it first if
+    `strategy` says so
+    """
+    limiter = _worker_args.get('limiter')
+    source_loc = None
+
+    if strategy == STAGED:
+        source_loc = stage(url, staged_path(out_dir, url), limiter)
+
+    # The URL names the file either way, so its shard, checkpoint and
+    # catalog entry are the same whether it was staged or streamed
+    run(
+        url,
+        _worker_args.get('npi_set'),
+        _worker_args.get('code_set'),
+        out_dir,
+        shard = True,
+        checkpoint_interval = CHECKPOINT_INTERVAL,
+        resume = True,
+        limiter = limiter,
+        source_loc = source_loc,
+        **_worker_args.get('run_kwargs', {}),
+    )
+
+    # run only logs a file that another process is writing, so fail
+    # here for the queue to try it again
+    if not ShardSet(out_dir).is_published(url):
+        raise ShardLocked(f'{url} was not published, another process is writing it')
+
+    if source_loc:
+        os.remove(source_loc)
+
+
+def _remove_staged(out_dir, url):
+    for path in (staged_path(out_dir, url), f'{staged_path(out_dir, url)}.part'):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def crawl(
+    catalogs,
+    out_dir,
+    npi_set = None,
+    code_set = None,
+    workers = 4,
+    bandwidth = None,
+    disk = None,
+    output_ratio = OUTPUT_RATIO,
+    max_attempts = MAX_ATTEMPTS,
+    queue_path = None,
+    **run_kwargs,
+):
+    """
+    Queues the files of every catalog in `catalogs` and flattens them
+    into shards of `out_dir`, `workers` at a time. Other keyword
+    arguments go to `core.run`. Returns the number of files per state.
+    """
+    os.makedirs(out_dir, exist_ok = True)
+    queue = CrawlQueue(queue_path or os.path.join(out_dir, 'queue.db'))
+
+    for catalog in catalogs:
+        log.info(f'Queued {queue.add_catalog(catalog)} files from {catalog}')
+    queue.recover()
+
+    limiter = RateLimiter(bandwidth) if bandwidth else None
+    init_args = (limiter, npi_set, code_set, run_kwargs)
+    running = {}
+
+    try:
+        with ProcessPoolExecutor(workers, initializer = _init_worker, initargs = init_args) as pool:
+            while True:
+                while len(running) < workers and (job := queue.claim(disk, output_ratio)):
+                    log.info(f"Starting {job['url']} ({job['strategy']}, {job['size']} bytes)")
+                    running[pool.submit(crawl_file, job['url'], job['strategy'], out_dir)] = job
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when = FIRST_COMPLETED)
+
+                for future in done:
+                    job = running.pop(future)
+                    try:
+                        future.result()
+                        queue.finish(job['url'])
+                        log.info(f"Finished {job['url']}")
+                    except Exception as e:
+                        log.warning(f"Failed {job['url']}: {e!r}")
+                        if queue.fail(job['url'], repr(e), max_attempts):
+                            _remove_staged(out_dir, job['url'])
+
+        return queue.counts()
+    finally:
+        queue.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Flatten the files of downloader catalogs, largest first')
+    parser.add_argument('catalogs', nargs = '+', help = 'SQLite files written by the downloaders')
+    parser.add_argument('-o', '--out', required = True)
+    parser.add_argument('-w', '--workers', type = int, default = 4)
+    parser.add_argument('-n', '--npis', help = 'CSV of NPIs to keep')
+    parser.add_argument('-c', '--codes', help = 'CSV of billing_code_type, billing_code specs to keep')
+    parser.add_argument('-m', '--memory', type = int, help = 'memory budget per worker in MB')
+    parser.add_argument('--bandwidth', type = float, help = 'MB/s shared by all workers')
+    parser.add_argument('--disk', type = float, help = 'GB of disk for staged files and output')
+    parser.add_argument('--queue', help = 'queue file (default: OUT/queue.db)')
+    parser.add_argument('--plan', action = 'store_true', help = 'only show how the pending files split across workers')
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.INFO)
+
+    if args.plan:
+        os.makedirs(args.out, exist_ok = True)
+        queue = CrawlQueue(args.queue or os.path.join(args.out, 'queue.db'))
+        for catalog in args.catalogs:
+            queue.add_catalog(catalog)
+        _, loads = lpt_plan(queue.pending_sizes(), args.workers)
+        for w, load in enumerate(loads):
+            print(f'worker {w}: {load / 1e9:.1f} GB')
+        queue.close()
+    else:
+        counts = crawl(
+            args.catalogs,
+            args.out,
+            npi_set = import_set(args.npis) if args.npis else None,
+            code_set = import_code_spec(args.codes) if args.codes else None,
+            workers = args.workers,
+            bandwidth = args.bandwidth * 1_000_000 if args.bandwidth else None,
+            disk = args.disk * 1_000_000_000 if args.disk else None,
+            queue_path = args.queue,
+            memory_limit = args.memory * 1_000_000 if args.memory else None,
+        )
+        log.info(f'Crawl: {counts}')
@@ -40,6 +40,34 @@ SCHEMA = {
         "tin_type",
         "tin_value",
         "npi_numbers",
+        # Only filled in when references are deferred (see MRFWriter),
+        # where groups are written once rather than per rate
+        "provider_group_id",
+    ],
+    "provider_references": [
+        "root_hash_key",
+        "in_network_hash_key",
+        "negotiated_rates_hash_key",
+        "provider_group_id",
+    ],
+    "bundled_codes": [
+        "root_hash_key",
+        "in_network_hash_key",
+        "billing_code_type_version",
+        "description",
+        "billing_code",
+        "billing_code_type",
+    ],
+    # Written with a dedup.KeyStore
+    "in_network_links": [
+        "root_hash_key",
+        "in_network_hash_key",
+    ],
+    "provider_group_links": [
+        "root_hash_key",
+        "provider_group_id",
+        "source_root_hash_key",
+        "source_provider_group_id",
     ],
     # "covered_services": [
     #     "root_hash_key",
@@ -50,14 +78,6 @@ SCHEMA = {
     #     "billing_code_type",
     #     "covered_services_hash_key",
     # ],
-    # "bundled_codes": [
-    #     "root_hash_key",
-    #     "in_network_hash_key",
-    #     "billing_code_type_version",
-    #     "description",
-    #     "billing_code",
-    #     "billing_code_type",
-    # ],
     # "negotiated_rates": [
     #     "root_hash_key",
     #     "in_network_hash_key",
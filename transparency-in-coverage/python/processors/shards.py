@@ -0,0 +1,239 @@
+"""
+Exactly-once output for runs that share an output directory.
+
+Each source file is written to a private directory, `{out_dir}/.tmp/{key}`,
+which only the process holding its lock writes to. When the file is
+finished, the directory is renamed to `{out_dir}/shards/{key}` (a rename
+within one filesystem is atomic) and recorded in `{out_dir}/manifest.jsonl`.
+Only shards in the manifest count, so a failed or running process never
+leaves partial rows where they'd be read, and a file that has already
+been published isn't published again.
+
+    shards = ShardSet(out_dir)
+    with shards.open(loc) as shard:
+        ...write CSVs to shard.dir...
+        shard.publish()
+
+    shards.merge()  # {out_dir}/{table}.csv
+
+`merge` concatenates the shards table by table with large sequential
+copies, keeping only the first shard's header.
+"""
+import os
+import json
+import time
+import fcntl
+import shutil
+import logging
+import argparse
+from contextlib import contextmanager
+
+from mrfutils import hashdict
+
+log = logging.getLogger(__name__)
+
+COPY_BUFFER = 16 * 1024 * 1024
+
+
+def shard_key(loc):
+    """
+    Same key as checkpoints use
+    """
+    return hashdict({'loc': loc})
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class ShardLocked(Exception):
+    """
+    Another process is writing the same source file
+    """
+
+
+class Shard:
+    """
+    One source file's private output directory. Use as a context manager
+    to hold its lock.
+    """
+
+    def __init__(self, shards, loc):
+        self.shards = shards
+        self.loc = loc
+        self.key = shard_key(loc)
+        self.dir = os.path.join(shards.tmp_dir, self.key)
+        self.path = os.path.join(shards.shards_dir, self.key)
+        self.published = False
+        self._lock = None
+
+    def __enter__(self):
+        os.makedirs(self.shards.tmp_dir, exist_ok = True)
+        self._lock = open(f'{self.dir}.lock', 'a')
+        try:
+            fcntl.flock(self._lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock.close()
+            self._lock = None
+            raise ShardLocked(f'{self.loc} is being written by another process')
+
+        os.makedirs(self.dir, exist_ok = True)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # The lock file stays: removing it would let two processes lock
+        # different files under the same name
+        fcntl.flock(self._lock, fcntl.LOCK_UN)
+        self._lock.close()
+        self._lock = None
+
+    def clear(self):
+        """
+        Drops anything left by an earlier attempt
+        """
+        shutil.rmtree(self.dir, ignore_errors = True)
+        os.makedirs(self.dir)
+
+    def discard(self):
+        shutil.rmtree(self.dir, ignore_errors = True)
+
+    def publish(self, **info):
+        """
+        Moves the shard into the output set. Returns False (and discards
+        the shard) if `loc` was published in the meantime.
+        """
+        os.makedirs(self.dir, exist_ok = True)
+        shutil.rmtree(os.path.join(self.dir, '.checkpoints'), ignore_errors = True)
+
+        tables = {}
+        for name in sorted(os.listdir(self.dir)):
+            if not name.endswith('.csv'):
+                continue
+            path = os.path.join(self.dir, name)
+            with open(path, 'rb') as f:
+                os.fsync(f.fileno())
+            tables[name[:-len('.csv')]] = os.path.getsize(path)
+
+        with self.shards.locked():
+            if self.shards.is_published(self.loc):
+                log.info(f'Already published, discarding: {self.loc}')
+                self.discard()
+                return False
+
+            # Left by a process that died between the rename and the
+            # manifest entry
+            if os.path.exists(self.path):
+                shutil.rmtree(self.path)
+
+            os.makedirs(self.shards.shards_dir, exist_ok = True)
+            os.rename(self.dir, self.path)
+            _fsync_dir(self.shards.shards_dir)
+
+            entry = {'key': self.key, 'loc': self.loc, 'time': time.time(), 'tables': tables, **info}
+            with open(self.shards.manifest_path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+        self.published = True
+        log.info(f'Published {self.loc} as {self.path}')
+        return True
+
+
+class ShardSet:
+    """
+    The shards published to `out_dir`
+    """
+
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+        self.tmp_dir = os.path.join(out_dir, '.tmp')
+        self.shards_dir = os.path.join(out_dir, 'shards')
+        self.manifest_path = os.path.join(out_dir, 'manifest.jsonl')
+        self.lock_path = os.path.join(out_dir, '.manifest.lock')
+
+    @contextmanager
+    def locked(self):
+        os.makedirs(self.out_dir, exist_ok = True)
+        with open(self.lock_path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return []
+
+        entries = []
+        with open(self.manifest_path) as f:
+            for line in f:
+                # A line cut short by a crash was never published
+                if line.endswith('\n'):
+                    entries.append(json.loads(line))
+        return entries
+
+    def is_published(self, loc):
+        key = shard_key(loc)
+        return any(entry['key'] == key for entry in self.manifest())
+
+    def open(self, loc):
+        return Shard(self, loc)
+
+    def merge(self, dest_dir = None, buffer_size = COPY_BUFFER):
+        """
+        Concatenates the published shards into `{dest_dir}/{table}.csv`
+        (`out_dir` by default), in the order they were published. Each
+        table is written to a temporary file and renamed into place.
+        """
+        dest_dir = dest_dir or self.out_dir
+        os.makedirs(dest_dir, exist_ok = True)
+
+        with self.locked():
+            entries = self.manifest()
+
+        tables = sorted({table for entry in entries for table in entry['tables']})
+
+        for table in tables:
+            dest = os.path.join(dest_dir, f'{table}.csv')
+            tmp = f'{dest}.part'
+            header = None
+
+            with open(tmp, 'wb') as out:
+                for entry in entries:
+                    if table not in entry['tables']:
+                        continue
+
+                    with open(os.path.join(self.shards_dir, entry['key'], f'{table}.csv'), 'rb') as f:
+                        first = f.readline()
+
+                        if header is None:
+                            header = first
+                            out.write(header)
+                        elif first != header:
+                            raise ValueError(f"{entry['loc']} has a different {table} header")
+
+                        shutil.copyfileobj(f, out, buffer_size)
+
+                out.flush()
+                os.fsync(out.fileno())
+
+            os.replace(tmp, dest)
+
+        log.info(f'Merged {len(entries)} shards into {dest_dir}')
+        return tables
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Merge published shards into one CSV per table')
+    parser.add_argument('out_dir')
+    parser.add_argument('-d', '--dest', help = 'defaults to out_dir')
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.INFO)
+    ShardSet(args.out_dir).merge(args.dest)
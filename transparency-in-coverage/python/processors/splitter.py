@@ -0,0 +1,233 @@
+"""
+Splits a (possibly huge) MRF or index file into sharded JSONL, one array
+item per line, without holding more than one item and a few shards in
+memory at a time. Scalar values at the top level are written once to
+root.json.
+
+    python splitter.py -u index.json.gz -o anthem_index -k reporting_structure
+    python splitter.py -u in_network.json.gz -o split -k in_network -k provider_references
+
+Each shard can then be read with `iter_jsonl`, which parses whole lines
+with orjson (when installed) instead of going event by event through
+ijson.
+"""
+import os
+import gzip
+import json
+import ijson
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from mrfutils import MRFOpen
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+log = logging.getLogger(__name__)
+
+
+def loads(line):
+    if orjson:
+        return orjson.loads(line)
+    return json.loads(line)
+
+
+def dumps(obj):
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators = (',', ':')).encode('utf-8')
+
+
+def iter_jsonl(path):
+    """
+    Yields one object per line of a (possibly gzipped) JSONL shard
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+
+    with opener(path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                yield loads(line)
+
+
+def shard_paths(out_dir, key):
+    names = sorted(
+        name for name in os.listdir(out_dir)
+        if name.startswith(f'{key}_') and '.jsonl' in name
+    )
+    return [os.path.join(out_dir, name) for name in names]
+
+
+class ShardWriter:
+    """
+    Collects serialized lines for one top-level array and hands full
+    shards to a thread pool to be (optionally) compressed and written.
+    At most `max_pending` shards are held in memory at once.
+    """
+
+    def __init__(self, executor, out_dir, key, shard_size, compress, max_pending):
+        self.executor = executor
+        self.out_dir = out_dir
+        self.key = key
+        self.shard_size = shard_size
+        self.compress = compress
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.futures = []
+        self.lines = []
+        self.size = 0
+        self.n_shards = 0
+        self.n_items = 0
+
+    def add(self, obj):
+        line = dumps(obj)
+        self.lines.append(line)
+        self.size += len(line) + 1
+        self.n_items += 1
+
+        if self.size >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if not self.lines:
+            return
+
+        suffix = '.jsonl.gz' if self.compress else '.jsonl'
+        path = os.path.join(self.out_dir, f'{self.key}_{self.n_shards:05d}{suffix}')
+
+        self.pending.acquire()
+        self.futures.append(
+            self.executor.submit(self._write, path, self.lines)
+        )
+
+        self.n_shards += 1
+        self.lines = []
+        self.size = 0
+
+    def _write(self, path, lines):
+        try:
+            data = b'\n'.join(lines) + b'\n'
+            tmp = f'{path}.part'
+
+            if self.compress:
+                with gzip.open(tmp, 'wb', compresslevel = 3) as f:
+                    f.write(data)
+            else:
+                with open(tmp, 'wb') as f:
+                    f.write(data)
+
+            os.replace(tmp, path)
+        finally:
+            self.pending.release()
+
+    def wait(self):
+        for future in self.futures:
+            future.result()
+
+
+def split_mrf(
+    loc,
+    out_dir,
+    keys = ('in_network', 'provider_references'),
+    shard_size = 256_000_000,
+    workers = 4,
+    compress = False,
+):
+    """
+    Streams `loc` and writes the items of each top-level array in `keys`
+    to `{out_dir}/{key}_NNNNN.jsonl`. Top-level arrays not in `keys` are
+    skipped; everything else goes into `{out_dir}/root.json`.
+
+    Returns a dict of item counts per key.
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    root = {}
+    writers = {}
+
+    with ThreadPoolExecutor(max_workers = workers) as executor, MRFOpen(loc) as f:
+
+        for key in keys:
+            writers[key] = ShardWriter(
+                executor, out_dir, key, shard_size, compress,
+                max_pending = 2 * workers,
+            )
+
+        parser = ijson.parse(f, use_float = True)
+
+        key = None
+        writer = None
+        item_prefix = None
+        builder = None
+
+        for prefix, event, value in parser:
+
+            if builder is not None:
+                builder.event(event, value)
+
+                if prefix == item_prefix and event in ('end_map', 'end_array'):
+                    writer.add(builder.value)
+                    builder = None
+
+                elif prefix == key and event in ('end_map', 'end_array'):
+                    root[key] = builder.value
+                    builder = None
+
+            elif prefix == '' and event == 'map_key':
+                key = value
+                writer = writers.get(key)
+                item_prefix = f'{key}.item'
+
+            elif prefix == item_prefix and writer:
+                if event in ('start_map', 'start_array'):
+                    builder = ijson.ObjectBuilder()
+                    builder.event(event, value)
+                else:
+                    writer.add(value)
+
+            elif prefix == key and event in ('start_map', 'start_array'):
+                # A top-level array we aren't splitting is skipped; any
+                # other nested value is kept with the root
+                if event == 'start_map':
+                    builder = ijson.ObjectBuilder()
+                    builder.event(event, value)
+
+            elif prefix == key and event not in ('end_map', 'end_array'):
+                root[key] = value
+
+        for writer in writers.values():
+            writer.flush()
+
+        for writer in writers.values():
+            writer.wait()
+
+    with open(os.path.join(out_dir, 'root.json'), 'w') as f:
+        json.dump(root, f)
+
+    counts = {key: writer.n_items for key, writer in writers.items()}
+    log.info(f'Split {loc}: {counts}')
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-u', '--url')
+    parser.add_argument('-o', '--out')
+    parser.add_argument('-k', '--key', action = 'append', help = 'top-level array to split (repeatable)')
+    parser.add_argument('-s', '--shard-size', type = int, default = 256, help = 'MB per shard, before compression')
+    parser.add_argument('-w', '--workers', type = int, default = 4)
+    parser.add_argument('--gzip', action = 'store_true')
+    args = parser.parse_args()
+
+    split_mrf(
+        args.url,
+        args.out,
+        keys = args.key or ('in_network', 'provider_references'),
+        shard_size = args.shard_size * 1_000_000,
+        workers = args.workers,
+        compress = args.gzip,
+    )
@@ -0,0 +1,627 @@
+"""
+Negotiated rate statistics (count, min, max, mean and quantiles) per
+billing code, NPI and plan, or any other grouping of FIELDS.
+
+    python stats.py -o summary.csv out_dir other_out_dir -j 4
+    python stats.py -o summary.csv out_dir -g billing_code -g npi -g billing_class
+
+Inputs are output directories or ShardSets (see shards.py), aggregated
+in parallel, one directory per process. Each joins negotiated_prices to
+provider_groups (and provider_references) on their rate keys with a
+partitioned hash join that spills to disk when the groups don't fit in
+`partition_bytes`, and feeds one RateStats per group. Groups spill to
+sorted run files past `max_keys`, and the runs of every directory are
+merged at the end, so memory is bounded either way.
+
+Quantiles come from a QuantileSketch with 1% relative error. Sketches
+and sums merge exactly, so the summaries don't depend on how the rows
+were split between directories, runs or processes.
+
+Deduplicated output (see dedup.py) links rows in one directory to plans
+and provider groups in others, so the links of every input are first
+sorted into a LinkIndex on disk, which each directory looks them up in.
+"""
+import os
+import csv
+import json
+import math
+import zlib
+import heapq
+import shutil
+import logging
+import argparse
+import tempfile
+from operator import itemgetter
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from compact import input_dirs
+from rate_index import SortedWriter, SortedFile, hash64, key64, RUN_RECORDS
+
+log = logging.getLogger(__name__)
+
+# What a joined price row can be grouped by
+FIELDS = ('billing_code_type', 'billing_code', 'npi', 'root_hash_key', 'billing_class', 'negotiated_type')
+
+GROUP_BY = ('billing_code', 'npi', 'root_hash_key')
+# For a single file, where the plan is always the same
+STREAM_GROUP_BY = ('billing_code', 'npi', 'billing_class')
+QUANTILES = (0.1, 0.25, 0.5, 0.75, 0.9)
+
+MAX_KEYS = 500_000
+PARTITION_BYTES = 256 * 1024 * 1024
+
+
+def _exact_add(partials, x):
+    """
+    Adds `x` to a list of non-overlapping partial sums (Shewchuk), which
+    `math.fsum` turns into the correctly rounded total in any order
+    """
+    i = 0
+    for y in partials:
+        if abs(x) < abs(y):
+            x, y = y, x
+        hi = x + y
+        lo = y - (hi - x)
+        if lo:
+            partials[i] = lo
+            i += 1
+        x = hi
+    partials[i:] = [x]
+
+
+class QuantileSketch:
+    """
+    Log-bucketed histogram (as in DDSketch): every value lands in the
+    bucket `ceil(log(|x|) / log(gamma))`, so a quantile is within
+    `alpha` of the true value relative to it. Merging adds bucket
+    counts, so it's exact and order doesn't matter.
+    """
+
+    __slots__ = ('positive', 'negative', 'zero')
+
+    alpha = 0.01
+    gamma = (1 + alpha) / (1 - alpha)
+    log_gamma = math.log(gamma)
+
+    def __init__(self):
+        self.positive = {}
+        self.negative = {}
+        self.zero = 0
+
+    def add(self, x):
+        if x > 0:
+            i = math.ceil(math.log(x) / self.log_gamma)
+            self.positive[i] = self.positive.get(i, 0) + 1
+        elif x < 0:
+            i = math.ceil(math.log(-x) / self.log_gamma)
+            self.negative[i] = self.negative.get(i, 0) + 1
+        else:
+            self.zero += 1
+
+    def merge(self, other):
+        for i, n in other.positive.items():
+            self.positive[i] = self.positive.get(i, 0) + n
+        for i, n in other.negative.items():
+            self.negative[i] = self.negative.get(i, 0) + n
+        self.zero += other.zero
+
+    def _value(self, i):
+        return 2 * self.gamma ** i / (self.gamma + 1)
+
+    def quantile(self, q, count):
+        rank = q * (count - 1)
+        seen = 0
+
+        for i in sorted(self.negative, reverse = True):
+            seen += self.negative[i]
+            if seen > rank:
+                return -self._value(i)
+
+        seen += self.zero
+        if seen > rank:
+            return 0.0
+
+        for i in sorted(self.positive):
+            seen += self.positive[i]
+            if seen > rank:
+                return self._value(i)
+
+    def state(self):
+        return [sorted(self.positive.items()), sorted(self.negative.items()), self.zero]
+
+    @classmethod
+    def from_state(cls, state):
+        sketch = cls()
+        positive, negative, sketch.zero = state
+        sketch.positive = dict(positive)
+        sketch.negative = dict(negative)
+        return sketch
+
+
+class RateStats:
+
+    __slots__ = ('count', 'min', 'max', 'partials', 'sketch')
+
+    def __init__(self):
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self.partials = []
+        self.sketch = QuantileSketch()
+
+    def add(self, x):
+        self.count += 1
+        if x < self.min:
+            self.min = x
+        if x > self.max:
+            self.max = x
+        _exact_add(self.partials, x)
+        self.sketch.add(x)
+
+    def merge(self, other):
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        for x in other.partials:
+            _exact_add(self.partials, x)
+        self.sketch.merge(other.sketch)
+
+    def summary(self, quantiles = QUANTILES):
+        summary = {
+            'count': self.count,
+            'min':   self.min,
+            'max':   self.max,
+            'mean':  math.fsum(self.partials) / self.count,
+        }
+        for q in quantiles:
+            value = self.sketch.quantile(q, self.count)
+            summary[quantile_name(q)] = min(max(value, self.min), self.max)
+        return summary
+
+    def state(self):
+        return [self.count, self.min, self.max, self.partials, self.sketch.state()]
+
+    @classmethod
+    def from_state(cls, state):
+        stats = cls()
+        stats.count, stats.min, stats.max, stats.partials, sketch = state
+        stats.sketch = QuantileSketch.from_state(sketch)
+        return stats
+
+
+def quantile_name(q):
+    return f'p{round(q * 100):g}'
+
+
+class Aggregator:
+    """
+    RateStats per group key (a tuple of strings). Past `max_keys` groups
+    the stats are written to a sorted run file in `spill_dir`, and
+    `items` merges the runs back together.
+    """
+
+    def __init__(self, max_keys = MAX_KEYS, spill_dir = None):
+        self.max_keys = max_keys
+        self.spill_dir = spill_dir
+        self.own_spill_dir = spill_dir is None
+        self.stats = {}
+        self.runs = []
+
+    def add(self, key, rate):
+        if (stats := self.stats.get(key)) is None:
+            if len(self.stats) >= self.max_keys:
+                self.spill()
+            stats = self.stats[key] = RateStats()
+        stats.add(rate)
+
+    def spill(self):
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix = 'stats_')
+
+        fd, path = tempfile.mkstemp(suffix = '.jsonl', dir = self.spill_dir)
+        with os.fdopen(fd, 'w') as f:
+            for key, stats in sorted(self.stats.items()):
+                f.write(json.dumps([key, stats.state()]) + '\n')
+
+        self.runs.append(path)
+        self.stats = {}
+        return path
+
+    def items(self):
+        """
+        (key, RateStats) in key order
+        """
+        if not self.runs:
+            return iter(sorted(self.stats.items()))
+        if self.stats:
+            self.spill()
+        return merge_runs(self.runs)
+
+    def close(self):
+        """
+        Deletes the run files
+        """
+        for path in self.runs:
+            if os.path.exists(path):
+                os.remove(path)
+        if self.own_spill_dir and self.spill_dir:
+            shutil.rmtree(self.spill_dir, ignore_errors = True)
+        self.runs = []
+        self.stats = {}
+
+
+def _iter_run(path):
+    with open(path) as f:
+        for line in f:
+            key, state = json.loads(line)
+            yield tuple(key), state
+
+
+def merge_runs(paths):
+    """
+    Merges sorted run files from Aggregator.spill, combining the stats
+    of equal keys
+    """
+    current_key, current = None, None
+
+    for key, state in heapq.merge(*(_iter_run(p) for p in paths), key = itemgetter(0)):
+        if key != current_key:
+            if current is not None:
+                yield current_key, current
+            current_key, current = key, RateStats.from_state(state)
+        else:
+            current.merge(RateStats.from_state(state))
+
+    if current is not None:
+        yield current_key, current
+
+
+def write_summaries(items, path, group_by = GROUP_BY, quantiles = QUANTILES):
+    """
+    Writes (key, RateStats) pairs to a CSV. Returns the number of rows.
+    """
+    n = 0
+    with open(path, 'w', newline = '') as f:
+        writer = csv.writer(f)
+        writer.writerow([*group_by, 'count', 'min', 'max', 'mean', *map(quantile_name, quantiles)])
+
+        for key, stats in items:
+            writer.writerow([*key, *stats.summary(quantiles).values()])
+            n += 1
+    return n
+
+
+def _read_table(out_dir, table):
+    path = os.path.join(out_dir, f'{table}.csv')
+    if not os.path.exists(path):
+        return
+    with open(path, newline = '') as f:
+        yield from csv.DictReader(f)
+
+
+def _table_size(out_dir, table):
+    path = os.path.join(out_dir, f'{table}.csv')
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def _npi_numbers(value):
+    return value.strip('[]').replace(' ', '').split(',') if value.strip('[]') else []
+
+
+class LinkIndex:
+    """
+    What aggregating any one output directory needs from the others when
+    they hold deduplicated output, as sorted, memory-mapped files (see
+    rate_index.py) in `links_dir`:
+
+      plan.idx    in_network_hash_key -> root_hash_key of every plan
+                  linked to the item
+      group.idx   provider group -> the group it was deduplicated to
+      npi.idx     such a source group -> its NPIs
+
+    Provider groups are keyed by `hash64(root_hash_key, provider_group_id)`.
+    """
+
+    FORMAT = '>QQ'
+    NAMES = ('plan', 'group', 'npi')
+
+    def __init__(self, links_dir):
+        self.indexes = {
+            name: SortedFile(os.path.join(links_dir, f'{name}.idx'), self.FORMAT)
+            for name in self.NAMES
+        }
+
+    @classmethod
+    def build(cls, dirs, links_dir, run_records = RUN_RECORDS):
+        """
+        Sorts the links of every directory in `dirs` into `links_dir`,
+        with an external sort so memory stays bounded
+        """
+        os.makedirs(links_dir, exist_ok = True)
+
+        def writer(name):
+            return SortedWriter(os.path.join(links_dir, f'{name}.idx'), cls.FORMAT, run_records)
+
+        plans, groups, sources = writer('plan'), writer('group'), writer('.sources')
+
+        for d in dirs:
+            for r in _read_table(d, 'in_network_links'):
+                plans.add(key64(r['in_network_hash_key']), key64(r['root_hash_key']))
+
+            for r in _read_table(d, 'provider_group_links'):
+                group = hash64(r['root_hash_key'], r['provider_group_id'])
+                source = hash64(r['source_root_hash_key'], r['source_provider_group_id'])
+                if source != group:
+                    groups.add(group, source)
+                    sources.add(source, group)
+
+        plans.close()
+        groups.close()
+
+        npis = writer('npi')
+        try:
+            if sources.close():
+                source_index = SortedFile(sources.path, cls.FORMAT)
+                try:
+                    for d in dirs:
+                        for r in _read_table(d, 'provider_groups'):
+                            if r['negotiated_rates_hash_key']:
+                                continue
+                            group = hash64(r['root_hash_key'], r['provider_group_id'])
+                            if source_index.lookup(group):
+                                for npi in _npi_numbers(r['npi_numbers']):
+                                    npis.add(group, int(npi))
+                finally:
+                    source_index.close()
+        finally:
+            npis.close()
+            if os.path.exists(sources.path):
+                os.remove(sources.path)
+
+        return cls(links_dir)
+
+    def plans(self, in_network_hash_key):
+        return [f'{k:016x}' for (k,) in self.indexes['plan'].lookup(key64(in_network_hash_key))]
+
+    def source(self, group):
+        """
+        The group `group` was deduplicated to, or None
+        """
+        found = self.indexes['group'].lookup(group)
+        return found[0][0] if found else None
+
+    def npis(self, group):
+        return [str(npi) for (npi,) in self.indexes['npi'].lookup(group)]
+
+    def close(self):
+        for index in self.indexes.values():
+            index.close()
+
+
+def _group_rows(out_dir, links):
+    """
+    Yields (rate key, NPIs) for every provider group, inline or
+    referenced. A rate key is (root_hash_key, in_network_hash_key,
+    negotiated_rates_hash_key).
+    """
+    referenced = defaultdict(list)
+
+    for r in _read_table(out_dir, 'provider_groups'):
+        npis = _npi_numbers(r['npi_numbers'])
+        if r['negotiated_rates_hash_key']:
+            yield (r['root_hash_key'], r['in_network_hash_key'], r['negotiated_rates_hash_key']), npis
+        else:
+            referenced[hash64(r['root_hash_key'], r['provider_group_id'])].extend(npis)
+
+    for r in _read_table(out_dir, 'provider_references'):
+        group = hash64(r['root_hash_key'], r['provider_group_id'])
+        source = links.source(group)
+        if source is None:
+            npis = referenced.get(group)
+        else:
+            npis = referenced.get(source) or links.npis(source)
+        if npis:
+            yield (r['root_hash_key'], r['in_network_hash_key'], r['negotiated_rates_hash_key']), npis
+
+
+def _price_rows(out_dir):
+    """
+    Yields (rate key, (billing_class, negotiated_type, negotiated_rate))
+    """
+    for r in _read_table(out_dir, 'negotiated_prices'):
+        key = (r['root_hash_key'], r['in_network_hash_key'], r['negotiated_rates_hash_key'])
+        yield key, (r['billing_class'], r['negotiated_type'], r['negotiated_rate'])
+
+
+def _partition(rows, n, part_dir, name):
+    """
+    Splits (key, values) rows into `n` files by a hash of the key
+    """
+    paths = [os.path.join(part_dir, f'{name}_{i}.jsonl') for i in range(n)]
+    files = [open(p, 'w') for p in paths]
+    try:
+        for key, values in rows:
+            i = zlib.crc32('\0'.join(key).encode('utf-8')) % n
+            files[i].write(json.dumps([key, values]) + '\n')
+    finally:
+        for f in files:
+            f.close()
+    return paths
+
+
+def _read_partition(path):
+    with open(path) as f:
+        for line in f:
+            key, values = json.loads(line)
+            yield tuple(key), values
+
+
+def join_prices(groups, prices):
+    """
+    Hash join of provider groups to prices on the rate key. Yields
+    (rate key, billing_class, negotiated_type, negotiated_rate, NPIs),
+    each NPI once per price.
+    """
+    npis = defaultdict(set)
+    for key, group_npis in groups:
+        npis[key].update(group_npis)
+
+    for key, (billing_class, negotiated_type, rate) in prices:
+        if (rate_npis := npis.get(key)):
+            yield key, billing_class, negotiated_type, float(rate), sorted(rate_npis)
+
+
+def _joined(out_dir, partition_bytes, part_dir, links):
+    """
+    `join_prices` over one output directory, partitioned if the groups
+    are bigger than `partition_bytes`
+    """
+    size = _table_size(out_dir, 'provider_groups') + _table_size(out_dir, 'provider_references')
+    n = 1 + size // partition_bytes
+    group_rows = _group_rows(out_dir, links)
+
+    if n == 1:
+        yield from join_prices(group_rows, _price_rows(out_dir))
+        return
+
+    log.info(f'Joining {out_dir} in {n} partitions')
+    group_parts = _partition(group_rows, n, part_dir, 'groups')
+    price_parts = _partition(_price_rows(out_dir), n, part_dir, 'prices')
+
+    for group_part, price_part in zip(group_parts, price_parts):
+        yield from join_prices(_read_partition(group_part), _read_partition(price_part))
+        os.remove(group_part)
+        os.remove(price_part)
+
+
+def key_getter(group_by):
+    """
+    Picks the `group_by` fields out of a record in FIELDS order
+    """
+    unknown = set(group_by) - set(FIELDS)
+    if unknown:
+        raise ValueError(f'Can only group by {FIELDS}, not {sorted(unknown)}')
+
+    getter = itemgetter(*(FIELDS.index(field) for field in group_by))
+    if len(group_by) == 1:
+        return lambda record: (getter(record),)
+    return getter
+
+
+# Opened once per worker process
+_links = {}
+
+
+def _init_worker(links_dir):
+    _links['index'] = LinkIndex(links_dir)
+
+
+def _aggregate_linked_dir(out_dir, group_by, spill_dir, max_keys, partition_bytes):
+    return aggregate_dir(out_dir, group_by, spill_dir, max_keys, partition_bytes, _links['index'])
+
+
+def aggregate_dir(out_dir, group_by, spill_dir, max_keys = MAX_KEYS, partition_bytes = PARTITION_BYTES, links = None):
+    """
+    Aggregates one output directory into sorted run files in `spill_dir`
+    and returns their paths. `links` is a LinkIndex of every directory
+    aggregated together, or of this one by default.
+    """
+    if links is None:
+        links_dir = tempfile.mkdtemp(prefix = 'links_', dir = spill_dir)
+        links = LinkIndex.build([out_dir], links_dir)
+        try:
+            return aggregate_dir(out_dir, group_by, spill_dir, max_keys, partition_bytes, links)
+        finally:
+            links.close()
+            shutil.rmtree(links_dir, ignore_errors = True)
+
+    codes = {
+        r['in_network_hash_key']: (r['billing_code_type'], r['billing_code'])
+        for r in _read_table(out_dir, 'in_network')
+    }
+    get_key = key_getter(group_by)
+    aggregator = Aggregator(max_keys, spill_dir)
+    part_dir = tempfile.mkdtemp(prefix = 'join_', dir = spill_dir)
+    joined = _joined(out_dir, partition_bytes, part_dir, links)
+    # With dedup, an item's rows carry the root that wrote them; the
+    # links say which plans have it. Prices come grouped by item, so
+    # the last lookup is kept.
+    last_key, plans = None, None
+
+    try:
+        for (root, in_network_key, _), billing_class, negotiated_type, rate, npis in joined:
+            code_type, code = codes.get(in_network_key, ('', ''))
+            if in_network_key != last_key:
+                last_key, plans = in_network_key, links.plans(in_network_key)
+            for plan in plans or (root,):
+                for npi in npis:
+                    aggregator.add(get_key((code_type, code, npi, plan, billing_class, negotiated_type)), rate)
+    finally:
+        shutil.rmtree(part_dir, ignore_errors = True)
+
+    aggregator.spill()
+    return aggregator.runs
+
+
+def aggregate_outputs(
+    inputs,
+    out_path,
+    group_by = GROUP_BY,
+    quantiles = QUANTILES,
+    jobs = 1,
+    max_keys = MAX_KEYS,
+    partition_bytes = PARTITION_BYTES,
+):
+    """
+    Writes rate summaries for the output directories or ShardSets in
+    `inputs` to `out_path`, aggregating `jobs` directories at a time.
+    Returns the number of summary rows.
+    """
+    dirs = input_dirs(inputs)
+    key_getter(group_by)
+    spill_dir = tempfile.mkdtemp(prefix = '.stats_', dir = os.path.dirname(os.path.abspath(out_path)))
+    links_dir = os.path.join(spill_dir, 'links')
+    args = [(d, tuple(group_by), spill_dir, max_keys, partition_bytes) for d in dirs]
+
+    try:
+        LinkIndex.build(dirs, links_dir).close()
+
+        if jobs > 1:
+            with ProcessPoolExecutor(jobs, initializer = _init_worker, initargs = (links_dir,)) as pool:
+                runs = list(pool.map(_aggregate_linked_dir, *zip(*args)))
+        else:
+            links = LinkIndex(links_dir)
+            try:
+                runs = [aggregate_dir(*a, links = links) for a in args]
+            finally:
+                links.close()
+
+        n = write_summaries(merge_runs([p for r in runs for p in r]), out_path, group_by, quantiles)
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors = True)
+
+    log.info(f'Wrote {n} summaries of {len(dirs)} outputs to {out_path}')
+    return n
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Negotiated rate statistics over flattened output')
+    parser.add_argument('inputs', nargs = '+', help = 'output directories or ShardSets')
+    parser.add_argument('-o', '--out', required = True)
+    parser.add_argument('-g', '--group-by', action = 'append', choices = FIELDS, help = f'default: {GROUP_BY}')
+    parser.add_argument('-q', '--quantile', action = 'append', type = float, help = f'default: {QUANTILES}')
+    parser.add_argument('-j', '--jobs', type = int, default = 1)
+    parser.add_argument('--max-keys', type = int, default = MAX_KEYS, help = 'groups held in memory per process')
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.INFO)
+
+    aggregate_outputs(
+        args.inputs,
+        args.out,
+        group_by = args.group_by or GROUP_BY,
+        quantiles = args.quantile or QUANTILES,
+        jobs = args.jobs,
+        max_keys = args.max_keys,
+    )
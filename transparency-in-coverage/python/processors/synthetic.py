@@ -0,0 +1,296 @@
+"""
+Deterministic synthetic MRFs for benchmarks. The same arguments (and
+seed) always produce the same bytes, so runs can be compared across
+commits:
+
+    generate_mrf('synthetic.json.gz', n_items = 10_000, compression = 'gzip')
+
+Items are written one at a time, so files much larger than memory can
+be made. Remote provider references are written next to the MRF as
+`ref_{id}.json` and pointed at `remote_base_url`; see `serve_directory`
+for a local HTTP stand-in.
+"""
+import os
+import bz2
+import gzip
+import lzma
+import json
+import random
+import logging
+import argparse
+import threading
+from contextlib import contextmanager
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+log = logging.getLogger(__name__)
+
+NPI_BASE = 1_000_000_000
+CODE_TYPES = ('CPT', 'HCPCS', 'MS-DRG')
+BILLING_CLASSES = ('professional', 'institutional')
+NEGOTIATED_TYPES = ('negotiated', 'derived', 'fee schedule', 'percentage')
+
+ROOT = {
+    'reporting_entity_name': 'Synthetic Health Plan',
+    'reporting_entity_type': 'health insurance issuer',
+    'last_updated_on':       '2022-07-01',
+    'version':               '1.0.0',
+}
+
+
+def synthetic_code(i):
+    """
+    The billing code of the `i`-th synthetic item
+    """
+    return CODE_TYPES[i % len(CODE_TYPES)], f'{10_000 + i // len(CODE_TYPES):05d}'
+
+
+def synthetic_npi(i):
+    return NPI_BASE + i
+
+
+def _open_output(path, compression):
+    if compression is None:
+        return open(path, 'wb')
+    if compression == 'gzip':
+        # mtime = 0 keeps the header, and so the file, reproducible
+        return gzip.GzipFile(filename = '', mode = 'wb', fileobj = open(path, 'wb'), mtime = 0)
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level = 3).stream_writer(open(path, 'wb'))
+    if compression == 'xz':
+        return lzma.open(path, 'wb')
+    if compression == 'bz2':
+        return bz2.open(path, 'wb')
+    raise ValueError(f'Unknown compression: {compression}')
+
+
+class _Writer:
+    """
+    Counts the uncompressed bytes written to the file
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.size = 0
+
+    def write(self, s):
+        b = s.encode('utf-8')
+        self.size += len(b)
+        self.f.write(b)
+
+    def close(self):
+        fileobj = getattr(self.f, 'fileobj', None)
+        self.f.close()
+        if fileobj:
+            fileobj.close()
+
+
+def _provider_group(rng, npis_per_group, npi_pool):
+    return {
+        'npi': [synthetic_npi(rng.randrange(npi_pool)) for _ in range(npis_per_group)],
+        'tin': {'type': 'ein', 'value': f'{rng.randrange(10**9):09d}'},
+    }
+
+
+def _negotiated_price(rng):
+    return {
+        'negotiated_type':        rng.choice(NEGOTIATED_TYPES),
+        'negotiated_rate':        round(rng.uniform(10, 100_000), 2),
+        'expiration_date':        rng.choice(('9999-12-31', '2023-12-31', '2022-06-30')),
+        'service_code':           rng.choice(([], ['11'], ['21', '22'])),
+        'billing_class':          rng.choice(BILLING_CLASSES),
+        'billing_code_modifier':  [],
+        'additional_information': '',
+    }
+
+
+def generate_mrf(
+    path,
+    n_items = 1_000,
+    rates_per_item = 10,
+    prices_per_rate = 2,
+    groups_per_rate = 1,
+    npis_per_group = 5,
+    npi_pool = 10_000,
+    n_provider_references = 100,
+    reference_ratio = 0.5,
+    n_remote_references = 0,
+    remote_base_url = None,
+    references_first = True,
+    rates_first = False,
+    compression = None,
+    seed = 0,
+):
+    """
+    Writes a synthetic in-network MRF to `path`.
+
+    `reference_ratio` is the share of negotiated rates that point at
+    provider_references instead of listing provider_groups inline. The
+    last `n_remote_references` references are remote files served from
+    `remote_base_url`. `references_first` puts provider_references before
+    in_network, and `rates_first` puts negotiated_rates before each
+    item's billing code fields.
+
+    Returns a dict describing what was written.
+    """
+    rng = random.Random(seed)
+    out_dir = os.path.dirname(os.path.abspath(path))
+    new_group = partial(_provider_group, rng, npis_per_group, npi_pool)
+
+    n_local = n_provider_references - n_remote_references
+    if n_remote_references and not remote_base_url:
+        raise ValueError('Remote references need a remote_base_url')
+
+    def write_references(w):
+        w.write('"provider_references":[')
+
+        for i in range(n_provider_references):
+            if i:
+                w.write(',')
+
+            groups = [new_group() for _ in range(groups_per_rate)]
+
+            if i < n_local:
+                pref = {'provider_groups': groups, 'provider_group_id': i}
+            else:
+                name = f'ref_{i}.json'
+                with open(os.path.join(out_dir, name), 'w') as f:
+                    json.dump({'provider_groups': groups}, f)
+                pref = {'provider_group_id': i, 'location': f'{remote_base_url}/{name}'}
+
+            w.write(json.dumps(pref))
+
+        w.write(']')
+
+    n_rates = 0
+
+    def write_in_network(w):
+        nonlocal n_rates
+        w.write('"in_network":[')
+
+        for i in range(n_items):
+            if i:
+                w.write(',')
+
+            code_type, code = synthetic_code(i)
+            fields = {
+                'negotiation_arrangement':   'ffs',
+                'name':                      f'Service {code}',
+                'billing_code_type':         code_type,
+                'billing_code_type_version': '2022',
+                'billing_code':              code,
+                'description':               f'Synthetic service {code_type} {code}',
+            }
+
+            rates = []
+            for _ in range(rates_per_item):
+                if n_provider_references and rng.random() < reference_ratio:
+                    rate = {'provider_references': [rng.randrange(n_provider_references)]}
+                else:
+                    rate = {'provider_groups': [new_group() for _ in range(groups_per_rate)]}
+
+                rate['negotiated_prices'] = [_negotiated_price(rng) for _ in range(prices_per_rate)]
+                rates.append(rate)
+
+            n_rates += len(rates)
+
+            if rates_first:
+                item = {'negotiated_rates': rates, **fields}
+            else:
+                item = {**fields, 'negotiated_rates': rates}
+
+            w.write(json.dumps(item))
+
+        w.write(']')
+
+    w = _Writer(_open_output(path, compression))
+
+    try:
+        w.write(json.dumps(ROOT)[:-1] + ',')
+
+        if references_first:
+            write_references(w)
+            w.write(',')
+            write_in_network(w)
+        else:
+            write_in_network(w)
+            w.write(',')
+            write_references(w)
+
+        w.write('}')
+    finally:
+        w.close()
+
+    info = {
+        'path':              path,
+        'size':              os.path.getsize(path),
+        'uncompressed_size': w.size,
+        'n_items':           n_items,
+        'n_rates':           n_rates,
+    }
+    log.info(f'Generated {info}')
+    return info
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+@contextmanager
+def serve_directory(directory):
+    """
+    Serves `directory` over HTTP on a free local port for the duration of
+    the block and yields its base URL
+    """
+    handler = partial(_QuietHandler, directory = directory)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--out', required = True)
+    parser.add_argument('-n', '--items', type = int, default = 1_000)
+    parser.add_argument('-r', '--rates', type = int, default = 10)
+    parser.add_argument('-p', '--prices', type = int, default = 2)
+    parser.add_argument('--groups-per-rate', type = int, default = 1, help = 'provider groups per negotiated rate')
+    parser.add_argument('--npis', type = int, default = 5, help = 'NPIs per provider group')
+    parser.add_argument('--npi-pool', type = int, default = 10_000)
+    parser.add_argument('--references', type = int, default = 100)
+    parser.add_argument('--reference-ratio', type = float, default = 0.5)
+    parser.add_argument('--remote-references', type = int, default = 0)
+    parser.add_argument('--remote-base-url', help = 'where the ref_{id}.json files will be served from')
+    parser.add_argument('--rates-first', action = 'store_true')
+    parser.add_argument('--in-network-first', action = 'store_true')
+    parser.add_argument('-c', '--compression', choices = ('gzip', 'zstd', 'xz', 'bz2'))
+    parser.add_argument('-s', '--seed', type = int, default = 0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.INFO)
+
+    generate_mrf(
+        args.out,
+        n_items = args.items,
+        rates_per_item = args.rates,
+        prices_per_rate = args.prices,
+        groups_per_rate = args.groups_per_rate,
+        npis_per_group = args.npis,
+        npi_pool = args.npi_pool,
+        n_provider_references = args.references,
+        reference_ratio = args.reference_ratio,
+        n_remote_references = args.remote_references,
+        remote_base_url = args.remote_base_url,
+        references_first = not args.in_network_first,
+        rates_first = args.rates_first,
+        compression = args.compression,
+        seed = args.seed,
+    )
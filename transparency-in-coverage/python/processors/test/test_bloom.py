@@ -0,0 +1,92 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from bloom import BloomFilter, candidate_urls
+from core import run
+from probe import probe
+from synthetic import generate_mrf, serve_directory, synthetic_npi, synthetic_code
+
+from test.test_probe import file_npis
+
+
+def summaries(db_path):
+    con = sqlite3.connect(db_path)
+    rows = con.execute('SELECT url, source, npis_complete, codes_complete, npis, codes FROM in_network_blooms')
+    result = {r[0]: r[1:] for r in rows}
+    con.close()
+    return result
+
+
+class TestBloom(unittest.TestCase):
+
+    def test_filter(self):
+        keys = [str(i) for i in range(1_000)]
+        bloom = BloomFilter.from_bytes(BloomFilter.for_keys(keys).to_bytes())
+
+        self.assertTrue(all(k in bloom for k in keys))
+        false_positives = sum(str(i) in bloom for i in range(1_000, 11_000))
+        self.assertLess(false_positives, 300)
+
+    def test_run_and_query(self):
+        with tempfile.TemporaryDirectory() as d, serve_directory(d) as url:
+            db_path = os.path.join(d, 'catalog.db')
+            con = sqlite3.connect(db_path)
+            con.execute('CREATE TABLE in_network_files(url PRIMARY KEY UNIQUE, size)')
+
+            paths = {
+                'refs_last': os.path.join(d, 'refs_last.json'),
+                'remote': os.path.join(d, 'remote.json'),
+                'unread': os.path.join(d, 'unread.json'),
+            }
+            generate_mrf(paths['refs_last'], n_items = 20, npi_pool = 500, references_first = False)
+            generate_mrf(
+                paths['remote'], n_items = 20, npi_pool = 500, seed = 1,
+                n_remote_references = 5, remote_base_url = url,
+            )
+            generate_mrf(paths['unread'], n_items = 20, npi_pool = 500, seed = 2)
+
+            for path in paths.values():
+                con.execute('INSERT INTO in_network_files VALUES (?, ?)', (path, 1))
+            con.commit()
+            con.close()
+
+            # Filters don't change what's summarized
+            for name in ('refs_last', 'remote'):
+                run(
+                    paths[name], {synthetic_npi(0)}, [synthetic_code(0)], os.path.join(d, name),
+                    catalog_path = db_path,
+                )
+
+            # A partial probe doesn't replace a complete summary
+            probe_result = probe(paths['refs_last'], max_bytes = 0)
+            self.assertFalse(probe_result['complete'])
+            probe_result['summary'].save(db_path, paths['refs_last'], source = 'probe')
+
+            saved = summaries(db_path)
+            npis = file_npis(paths['refs_last'])
+            self.assertEqual(saved[paths['refs_last']], ('run', 1, 1, len(npis), 20))
+            self.assertEqual(saved[paths['remote']][1:3], (0, 1))
+
+            missing_npi = synthetic_npi(10_000)
+            self.assertEqual(
+                candidate_urls(db_path, npi_set = {next(iter(npis))}),
+                list(paths.values()),
+            )
+            self.assertEqual(
+                candidate_urls(db_path, npi_set = {missing_npi}),
+                [paths['remote'], paths['unread']],
+            )
+            self.assertEqual(
+                candidate_urls(db_path, code_set = [('CPT', 'nope')]),
+                [paths['unread']],
+            )
+            self.assertEqual(
+                candidate_urls(db_path, code_set = [synthetic_code(0)]),
+                list(paths.values()),
+            )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import os
+import gzip
+import json
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from pathlib import Path
+
+from core import run
+from checkpoint import Checkpoint, CheckpointSink
+from mrfutils import MRFObjectBuilder
+from pipeline import MRFSource, CSVSink, run_pipeline
+
+
+TEST_FILE = str(Path(__file__).parent / 'test_file_1.json')
+
+
+class Crash(Exception):
+    pass
+
+
+class CrashingSink(CSVSink):
+    """
+    Writes `n` batches, then writes one more and crashes
+    """
+
+    def __init__(self, out_dir, source, n):
+        super().__init__(out_dir, source)
+        self.n = n
+
+    def write(self, batch):
+        super().write(batch)
+        self.n -= 1
+        if self.n < 0:
+            raise Crash
+
+
+def read_outputs(out_dir):
+    outputs = {}
+    for name in sorted(os.listdir(out_dir)):
+        if name.endswith('.csv'):
+            with open(os.path.join(out_dir, name)) as f:
+                outputs[name] = f.read()
+    return outputs
+
+
+class TestResume(unittest.TestCase):
+    def crash_then_resume(self, n, loc = TEST_FILE, **kwargs):
+        with tempfile.TemporaryDirectory() as expected_dir, tempfile.TemporaryDirectory() as out_dir:
+            run(loc, None, None, expected_dir, **kwargs)
+
+            source = MRFSource(loc, track_position = True, **kwargs)
+            checkpoint = Checkpoint(out_dir, loc, interval = 0)
+            sink = CheckpointSink(CrashingSink(out_dir, source, n), source, checkpoint)
+            sink.save()
+
+            with self.assertRaises(Crash):
+                run_pipeline(source, sink, item_batch_size = 50, row_batch_size = 1)
+
+            state = checkpoint.load()
+            if n:
+                self.assertGreater(state['items_done'], 0)
+
+            # Local uncompressed files are seeked in rather than parsed
+            # up to the checkpoint
+            seekable = loc.endswith('.json') and state['items_done'] > 0
+            self.assertEqual(state['offset'] is not None, seekable)
+
+            skip = MRFObjectBuilder.skip_items
+            with mock.patch.object(MRFObjectBuilder, 'skip_items', autospec = True, side_effect = skip) as skip_items:
+                run(loc, None, None, out_dir, resume = True, **kwargs)
+                self.assertEqual(skip_items.called, bool(state['items_done']) and not seekable)
+
+            self.assertEqual(read_outputs(out_dir), read_outputs(expected_dir))
+
+            # Finished files aren't run again
+            run(loc, None, None, out_dir, resume = True, **kwargs)
+            self.assertEqual(read_outputs(out_dir), read_outputs(expected_dir))
+
+    def test_resume(self):
+        for n in (0, 4):
+            self.crash_then_resume(n)
+
+    def test_resume_defer_references(self):
+        self.crash_then_resume(3, defer_references = True)
+
+    def test_resume_stream_rates(self):
+        self.crash_then_resume(20, stream_rates = True)
+
+    def test_resume_references_last(self):
+        with open(TEST_FILE) as f:
+            data = json.load(f)
+        data['provider_references'] = data.pop('provider_references')
+
+        with tempfile.TemporaryDirectory() as d:
+            loc = os.path.join(d, 'references_last.json')
+            with open(loc, 'w') as f:
+                json.dump(data, f, indent = 1)
+
+            self.crash_then_resume(4, loc)
+
+    def test_resume_gzip(self):
+        with tempfile.TemporaryDirectory() as d:
+            loc = os.path.join(d, 'test_file_1.json.gz')
+            with open(TEST_FILE, 'rb') as f, gzip.open(loc, 'wb') as gz:
+                shutil.copyfileobj(f, gz)
+
+            self.crash_then_resume(4, loc)
+
+
+if __name__ == '__main__':
+    unittest.main()
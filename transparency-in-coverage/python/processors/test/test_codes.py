@@ -0,0 +1,68 @@
+import os
+import tempfile
+import unittest
+
+from codes import CodeSet, import_code_spec
+
+
+class TestCodeSet(unittest.TestCase):
+    def test_exact_codes(self):
+        codes = CodeSet([('CPT', '27447'), ('MS-DRG', 945)])
+        self.assertIn(('CPT', '27447'), codes)
+        self.assertIn(('MS-DRG', '945'), codes)
+        self.assertNotIn(('HCPCS', '27447'), codes)
+
+    def test_numeric_range_ignores_leading_zeros(self):
+        codes = CodeSet()
+        codes.add_range('CPT', '90935', '90940')
+        codes.add_range('MS-DRG', '940', '950')
+        self.assertIn(('CPT', '90937'), codes)
+        self.assertNotIn(('CPT', '90941'), codes)
+        self.assertIn(('MS-DRG', '0945'), codes)
+
+    def test_prefix_and_overlapping_ranges(self):
+        codes = CodeSet()
+        codes.add_prefix('HCPCS', 'J')
+        codes.add_range('HCPCS', 'A0021', 'A0100')
+        codes.add_range('HCPCS', 'A0050', 'A0200')
+        self.assertIn(('HCPCS', 'J1100'), codes)
+        self.assertIn(('HCPCS', 'A0150'), codes)
+        self.assertNotIn(('HCPCS', 'A0201'), codes)
+        self.assertNotIn(('HCPCS', 'K0001'), codes)
+
+    def test_has_type(self):
+        codes = CodeSet([('CPT', '27447')])
+        self.assertTrue(codes.has_type('CPT'))
+        self.assertFalse(codes.has_type('MS-DRG'))
+        self.assertFalse(CodeSet())
+
+    def test_from_spec(self):
+        codes = CodeSet.from_spec(['CPT:90935-90940', 'MS-DRG:45*', ('HCPCS', '*'), 'CPT:27447'])
+        self.assertIn(('CPT', '90940'), codes)
+        self.assertIn(('CPT', '27447'), codes)
+        self.assertIn(('MS-DRG', '455'), codes)
+        self.assertIn(('HCPCS', 'U0005'), codes)
+        self.assertNotIn(('MS-DRG', '546'), codes)
+
+    def test_hyphenated_exact_codes(self):
+        codes = CodeSet.from_spec(['NDC:12345-6789-01', 'NDC:12345-678', 'CPT:90935 - 90940'])
+        self.assertIn(('NDC', '12345-6789-01'), codes)
+        self.assertIn(('NDC', '12345-678'), codes)
+        self.assertNotIn(('NDC', '12345-6789-02'), codes)
+        self.assertNotIn(('NDC', '12345-7000-00'), codes)
+        self.assertNotIn(('NDC', '2'), codes)
+        self.assertIn(('CPT', '90937'), codes)
+
+    def test_import_code_spec_ndc(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'codes.csv')
+            with open(path, 'w') as f:
+                f.write('billing_code_type,billing_code\n')
+                f.write('NDC,00002-1433-80\n')
+                f.write('CPT,90935-90940\n')
+
+            codes = import_code_spec(path)
+
+        self.assertIn(('NDC', '00002-1433-80'), codes)
+        self.assertNotIn(('NDC', '00002-1500-01'), codes)
+        self.assertIn(('CPT', '90937'), codes)
@@ -0,0 +1,78 @@
+import os
+import csv
+import json
+import tempfile
+import unittest
+
+from core import run
+from compact import compact
+
+from test.test_shards import TEST_FILES
+from test.test_pipeline import BUNDLED_ITEM
+
+
+def read_rows(path):
+    with open(path, newline = '') as f:
+        return list(csv.reader(f))
+
+
+class TestCompact(unittest.TestCase):
+
+    def test_compact(self):
+        with tempfile.TemporaryDirectory() as work_dir:
+            single_dir = os.path.join(work_dir, 'single')
+            shard_dir = os.path.join(work_dir, 'shards')
+            twice_dir = os.path.join(work_dir, 'twice')
+
+            for loc in TEST_FILES:
+                run(loc, None, None, single_dir)
+                run(loc, None, None, shard_dir, shard = True)
+            # Same rows again, as if a file had been run twice
+            run(TEST_FILES[0], None, None, twice_dir)
+
+            for jobs, run_rows, fan_in in ((1, 1_000_000, 64), (2, 50, 3)):
+                dest_dir = os.path.join(work_dir, f'compacted_{jobs}')
+                stats = compact([shard_dir, twice_dir], dest_dir, jobs = jobs, run_rows = run_rows, fan_in = fan_in)
+
+                for table, counts in stats.items():
+                    expected = read_rows(os.path.join(single_dir, f'{table}.csv'))
+                    header, *rows = read_rows(os.path.join(dest_dir, f'{table}.csv'))
+
+                    self.assertEqual(header, expected[0])
+                    self.assertEqual(rows, sorted(rows))
+                    self.assertEqual(set(map(tuple, rows)), set(map(tuple, expected[1:])))
+                    self.assertEqual(len(rows), len(set(map(tuple, rows))))
+                    self.assertEqual(counts['rows_out'], len(rows))
+                    self.assertGreater(counts['rows_in'], counts['rows_out'])
+
+                self.assertFalse([p for p in os.listdir(dest_dir) if not p.endswith('.csv')])
+
+    def test_bundled_codes(self):
+        with tempfile.TemporaryDirectory() as work_dir:
+            loc = os.path.join(work_dir, 'bundled.json')
+            with open(loc, 'w') as f:
+                json.dump({
+                    'reporting_entity_name': 'Bundles',
+                    'provider_references': [{
+                        'provider_group_id': 7,
+                        'provider_groups': [{'npi': [3], 'tin': {'type': 'ein', 'value': '12'}}],
+                    }],
+                    'in_network': [BUNDLED_ITEM],
+                }, f)
+
+            out_dirs = [os.path.join(work_dir, name) for name in ('a', 'b')]
+            for out_dir in out_dirs:
+                run(loc, None, None, out_dir)
+
+            dest_dir = os.path.join(work_dir, 'compacted')
+            stats = compact(out_dirs, dest_dir)
+
+            self.assertEqual(stats['bundled_codes'], {'rows_in': 2, 'rows_out': 1})
+            self.assertEqual(
+                read_rows(os.path.join(dest_dir, 'bundled_codes.csv')),
+                read_rows(os.path.join(out_dirs[0], 'bundled_codes.csv')),
+            )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+import os
+import csv
+import tempfile
+import unittest
+import multiprocessing
+from pathlib import Path
+
+from core import run
+from dedup import KeyStore
+
+TEST_FILE = str(Path(__file__).parent / 'test_file_1.json')
+
+
+def hold_claims(path, claimed, release):
+    store = KeyStore(path, 'a')
+    store.claim('k', ['a', 1])
+    claimed.set()
+
+    release.wait(60)
+    store.finish()
+    store.close()
+
+
+def read_table(out_dir, table):
+    path = os.path.join(out_dir, f'{table}.csv')
+    if not os.path.exists(path):
+        return []
+    with open(path, newline = '') as f:
+        return list(csv.DictReader(f))
+
+
+class TestDedup(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+        self.store = os.path.join(self.dir, 'keys.sqlite')
+
+        with open(TEST_FILE) as f:
+            data = f.read().replace('"2022-11-01"', '"2022-12-01"', 1)
+
+        # Same items as TEST_FILE under another root
+        self.other_file = os.path.join(self.dir, 'other.json')
+        with open(self.other_file, 'w') as f:
+            f.write(data)
+
+        # Same provider references, different items
+        self.repriced_file = os.path.join(self.dir, 'repriced.json')
+        with open(self.repriced_file, 'w') as f:
+            f.write(data.replace('"9999-12-31"', '"2023-12-31"'))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def check(self, **kwargs):
+        plain_dir, first_dir, second_dir = (os.path.join(self.dir, name) for name in ('plain', 'first', 'second'))
+
+        run(TEST_FILE, None, None, plain_dir, **kwargs)
+        run(TEST_FILE, None, None, first_dir, dedup_path = self.store, **kwargs)
+        run(self.other_file, None, None, second_dir, dedup_path = self.store, **kwargs)
+
+        first_root = read_table(first_dir, 'root')[0]['root_hash_key']
+        second_root = read_table(second_dir, 'root')[0]['root_hash_key']
+        self.assertNotEqual(first_root, second_root)
+
+        # Every item is linked to its root, and written once
+        first_links = read_table(first_dir, 'in_network_links')
+        self.assertEqual(len(first_links), len(read_table(plain_dir, 'in_network')))
+        self.assertEqual(
+            {r['in_network_hash_key'] for r in first_links},
+            {r['in_network_hash_key'] for r in read_table(first_dir, 'in_network')},
+        )
+        self.assertEqual(len(read_table(first_dir, 'negotiated_prices')), len(read_table(plain_dir, 'negotiated_prices')))
+
+        second_links = read_table(second_dir, 'in_network_links')
+        self.assertEqual({r['root_hash_key'] for r in second_links}, {second_root})
+        self.assertEqual(
+            [r['in_network_hash_key'] for r in second_links],
+            [r['in_network_hash_key'] for r in first_links],
+        )
+
+        for table in ('in_network', 'negotiated_prices', 'provider_groups', 'provider_references'):
+            self.assertEqual(read_table(second_dir, table), [])
+
+        return first_dir, second_dir, first_root, second_root
+
+    def test_dedup_items(self):
+        self.check()
+
+    def test_dedup_referenced_groups(self):
+        first_dir, second_dir, first_root, second_root = self.check(defer_references = True)
+
+        first_links = read_table(first_dir, 'provider_group_links')
+        self.assertTrue(first_links)
+        self.assertEqual({r['source_root_hash_key'] for r in first_links}, {first_root})
+
+        # Only skipped items referred to groups
+        self.assertEqual(read_table(second_dir, 'provider_group_links'), [])
+
+        third_dir = os.path.join(self.dir, 'third')
+        run(self.repriced_file, None, None, third_dir, dedup_path = self.store, defer_references = True)
+
+        self.assertEqual(
+            len(read_table(third_dir, 'in_network')),
+            len(read_table(first_dir, 'in_network')),
+        )
+        self.assertEqual(read_table(third_dir, 'provider_groups'), [])
+        self.assertEqual(
+            [(r['provider_group_id'], r['source_root_hash_key'], r['source_provider_group_id']) for r in read_table(third_dir, 'provider_group_links')],
+            [(r['provider_group_id'], first_root, r['provider_group_id']) for r in first_links],
+        )
+
+    def test_unfinished_keys(self):
+        a = KeyStore(self.store, 'a')
+        b = KeyStore(self.store, 'b')
+
+        self.assertIsNone(a.claim('k', ['a', 1]))
+        self.assertEqual(a.claim('k'), ['a', 1])
+
+        # Not finished, so b writes its own copy
+        self.assertIsNone(b.claim('k'))
+
+        a.finish()
+        self.assertEqual(b.claim('k'), ['a', 1])
+
+        a.close()
+        b.close()
+
+    def test_claims_across_processes(self):
+        claimed, release = multiprocessing.Event(), multiprocessing.Event()
+        holder = multiprocessing.Process(target = hold_claims, args = (self.store, claimed, release))
+        holder.start()
+
+        try:
+            self.assertTrue(claimed.wait(30))
+
+            # A run with claims outstanding doesn't keep others waiting
+            b = KeyStore(self.store, 'b')
+            b.conn.execute('PRAGMA busy_timeout = 1000')
+            self.assertIsNone(b.claim('k'))
+            self.assertIsNone(b.claim('j', ['b', 2]))
+        finally:
+            release.set()
+            holder.join(30)
+
+        self.assertEqual(holder.exitcode, 0)
+        self.assertEqual(b.claim('k'), ['a', 1])
+        b.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
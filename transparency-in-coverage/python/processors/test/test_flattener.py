@@ -0,0 +1,190 @@
+import io
+import os
+import csv
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+from codes import CodeSet
+from dedup import KeyStore
+from filters import PriceFilter
+from mrfutils import (
+    MRFOpen,
+    MRFObjectBuilder,
+    MRFWriter,
+    filter_in_network_item,
+    filter_provider_reference,
+    in_network_item_to_rows,
+)
+
+
+TEST_FILE = str(Path(__file__).parent / 'test_file_1.json')
+
+
+def event_items(npi_set, code_set, price_filter = None, defer_references = False):
+    with MRFOpen(TEST_FILE) as f:
+        m = MRFObjectBuilder(f)
+        m.ffwd(('', 'map_key', 'provider_references'))
+        p_ref_map = m.build_provider_references(npi_set)
+        m.ffwd(('', 'map_key', 'in_network'))
+        return list(m.in_network_items(npi_set, code_set, p_ref_map, price_filter, defer_references))
+
+
+def deferred_items(npi_set):
+    with MRFOpen(TEST_FILE) as f:
+        m = MRFObjectBuilder(f)
+        m.ffwd(('', 'map_key', 'provider_references'))
+        p_ref_map = m.build_provider_references(npi_set)
+        m.ffwd(('', 'map_key', 'in_network'))
+        return p_ref_map, list(m.in_network_items(npi_set, None, p_ref_map, defer_references = True))
+
+
+def read_table(out_dir, table):
+    path = os.path.join(out_dir, f'{table}.csv')
+    if not os.path.exists(path):
+        return []
+    with open(path, newline = '') as f:
+        return list(csv.DictReader(f))
+
+
+def dict_items(npi_set, code_set, price_filter = None, defer_references = False):
+    with open(TEST_FILE) as f:
+        data = json.load(f)
+
+    p_ref_map = {}
+    for pref in data['provider_references']:
+        if (pref := filter_provider_reference(pref, npi_set)):
+            p_ref_map[pref['provider_group_id']] = pref['provider_groups']
+
+    items = []
+    for item in data['in_network']:
+        if (item := filter_in_network_item(item, npi_set, code_set, p_ref_map, price_filter, defer_references)):
+            items.append(item)
+    return items
+
+
+class TestFilterInNetworkItem(unittest.TestCase):
+    def test_matches_event_path_unfiltered(self):
+        self.assertEqual(dict_items(None, None), event_items(None, None))
+
+    def test_matches_event_path_filtered(self):
+        npi_set = {1508935891, 1174577670, 1205105087}
+        code_set = {('MS-DRG', '0001'), ('MS-DRG', '0025'), ('MS-DRG', '0027')}
+        items = event_items(npi_set, code_set)
+        self.assertEqual(len(items), 2)
+        self.assertEqual(dict_items(npi_set, code_set), items)
+
+    def test_price_filter(self):
+        price_filter = PriceFilter(billing_class = {'professional'}, min_rate = 100)
+        items = event_items(None, None, price_filter)
+        prices = [p for i in items for r in i['negotiated_rates'] for p in r['negotiated_prices']]
+
+        self.assertTrue(prices)
+        self.assertTrue(all(price_filter(p) for p in prices))
+        self.assertEqual(dict_items(None, None, price_filter), items)
+
+    def test_defer_references(self):
+        npi_set = {1508935891, 1205105087}
+        items = event_items(npi_set, None, defer_references = True)
+        rates = [r for i in items for r in i['negotiated_rates']]
+
+        self.assertTrue(rates)
+        self.assertTrue(all(r['provider_references'] and not r.get('provider_groups') for r in rates))
+        self.assertEqual(dict_items(npi_set, None, defer_references = True), items)
+
+
+class TestInNetworkRowBatches(unittest.TestCase):
+    def test_same_rows_as_whole_items(self):
+        npi_set = {1508935891, 1174577670, 1205105087}
+
+        expected = []
+        for item in event_items(npi_set, None):
+            expected.extend(in_network_item_to_rows(item, 'root'))
+
+        with MRFOpen(TEST_FILE) as f:
+            m = MRFObjectBuilder(f)
+            m.ffwd(('', 'map_key', 'provider_references'))
+            p_ref_map = m.build_provider_references(npi_set)
+            m.ffwd(('', 'map_key', 'in_network'))
+            rows = [row for batch in m.in_network_row_batches('root', npi_set, None, p_ref_map) for row in batch]
+
+        self.assertTrue(rows)
+        self.assertEqual(rows, expected)
+
+
+class TestMRFWriter(unittest.TestCase):
+
+    def write(self, out_dir, root_data, key_store = None):
+        p_ref_map, items = deferred_items(None)
+        writer = MRFWriter(p_ref_map, key_store)
+        for item in items:
+            writer.write_in_network_item(item, root_data, out_dir)
+        return writer
+
+    def test_references_written_once(self):
+        with tempfile.TemporaryDirectory() as d:
+            writer = self.write(d, {'reporting_entity_name': 'a'})
+            p_ref_map, _ = deferred_items(None)
+
+            referenced = {int(r['provider_group_id']) for r in read_table(d, 'provider_references')}
+            self.assertTrue(referenced)
+            self.assertEqual(writer.written_references, referenced)
+
+            groups = read_table(d, 'provider_groups')
+            self.assertEqual(len(groups), sum(len(p_ref_map[i]) for i in referenced))
+            self.assertEqual({int(g['provider_group_id']) for g in groups}, referenced)
+            self.assertTrue(all(not g['in_network_hash_key'] for g in groups))
+            self.assertEqual(read_table(d, 'provider_group_links'), [])
+
+    def test_links_to_groups_written_before(self):
+        with tempfile.TemporaryDirectory() as d:
+            first_dir, second_dir = os.path.join(d, 'first'), os.path.join(d, 'second')
+
+            store = KeyStore(os.path.join(d, 'keys.sqlite'), 'first')
+            first = self.write(first_dir, {'reporting_entity_name': 'a'}, store)
+            store.finish()
+            store.close()
+
+            store = KeyStore(os.path.join(d, 'keys.sqlite'), 'second')
+            second = self.write(second_dir, {'reporting_entity_name': 'b'}, store)
+            store.close()
+
+            self.assertEqual(first.written_references, second.written_references)
+            self.assertEqual(read_table(second_dir, 'provider_groups'), [])
+
+            for writer, out_dir in ((first, first_dir), (second, second_dir)):
+                links = read_table(out_dir, 'provider_group_links')
+                self.assertEqual({int(r['provider_group_id']) for r in links}, writer.written_references)
+                self.assertTrue(all(r['root_hash_key'] == writer.root_hash_key for r in links))
+                self.assertTrue(all(r['source_root_hash_key'] == first.root_hash_key for r in links))
+                self.assertTrue(all(r['source_provider_group_id'] == r['provider_group_id'] for r in links))
+
+
+class TestCodePrefilter(unittest.TestCase):
+    RATE = {
+        'negotiated_prices': [{'negotiated_rate': 1.5}],
+        'provider_groups': [{'npi': [1], 'tin': {'type': 'ein', 'value': '1'}}],
+    }
+
+    def item(self, billing_code, rates_first):
+        item = {'billing_code_type': 'CPT', 'billing_code': billing_code}
+        if rates_first:
+            return {'negotiated_rates': [self.RATE], **item}
+        return {**item, 'negotiated_rates': [self.RATE]}
+
+    def test_keys_in_any_order(self):
+        doc = {'in_network': [
+            self.item('90935', rates_first = True),
+            self.item('12345', rates_first = True),
+            self.item('90940', rates_first = False),
+            self.item('90941', rates_first = False),
+        ]}
+        codes = CodeSet()
+        codes.add_range('CPT', '90935', '90940')
+
+        m = MRFObjectBuilder(io.BytesIO(json.dumps(doc).encode()))
+        m.ffwd(('', 'map_key', 'in_network'))
+        items = list(m.in_network_items(None, codes, {}))
+
+        self.assertEqual([i['billing_code'] for i in items], ['90935', '90940'])
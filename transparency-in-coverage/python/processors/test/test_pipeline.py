@@ -0,0 +1,232 @@
+import os
+import csv
+import json
+import tempfile
+import unittest
+from unittest import mock
+from pathlib import Path
+
+from core import run
+from mrfutils import MRFWriter, in_network_item_to_rows
+from pipeline import MRFSource, ListSink, batched, run_pipeline
+from rowbatch import COLUMNS, RowBatch, layout
+from schema import SCHEMA
+from metrics import METRICS
+from memory import MemoryBudget, MemoryBudgetExceeded, SpillDict
+
+
+TEST_FILE = str(Path(__file__).parent / 'test_file_1.json')
+NPI_SET = {1508935891, 1174577670, 1205105087}
+
+BUNDLED_ITEM = {
+    'negotiation_arrangement': 'ffs',
+    'name': 'Knee',
+    'billing_code_type': 'CPT',
+    'billing_code_type_version': '2022',
+    'billing_code': '27447',
+    'description': 'Knee replacement',
+    'negotiated_rates': [{
+        'provider_groups': [{'npi': [1, 2], 'tin': {'type': 'ein', 'value': '11'}}],
+        'provider_references': [7],
+        'negotiated_prices': [{
+            'billing_class': 'professional',
+            'negotiated_type': 'negotiated',
+            'expiration_date': '2023-01-01',
+            'negotiated_rate': 1234.5,
+            'service_code': [],
+        }],
+    }],
+    'bundled_codes': [{
+        'billing_code_type': 'CPT',
+        'billing_code_type_version': '2022',
+        'billing_code': '20000',
+        'description': 'Bundle',
+    }],
+}
+
+
+class TestPipeline(unittest.TestCase):
+    def test_batched(self):
+        self.assertEqual(list(batched(range(5), 2)), [[0, 1], [2, 3], [4]])
+
+    def test_stream_rates_matches_items(self):
+        source = MRFSource(TEST_FILE, npi_set = NPI_SET)
+        expected = RowBatch()
+        for item in source:
+            expected.extend_rows(in_network_item_to_rows(item, source.root_hash_key))
+
+        source = MRFSource(TEST_FILE, npi_set = NPI_SET, stream_rates = True)
+        sink = ListSink()
+        run_pipeline(source, sink, item_batch_size = 3, row_batch_size = 50)
+
+        self.assertTrue(expected)
+        self.assertEqual(sink.batch.tables, expected.tables)
+
+    def test_stages(self):
+        def only_prices(batches):
+            for batch in batches:
+                batch.tables = {'negotiated_prices': batch.tables['negotiated_prices']}
+                yield batch
+
+        source = MRFSource(TEST_FILE, npi_set = NPI_SET)
+        sink = ListSink()
+        run_pipeline(source, sink, stages = [only_prices])
+
+        self.assertTrue(sink.batch.tables['negotiated_prices'])
+        self.assertEqual({row.filename for row in sink.batch.rows()}, {'negotiated_prices'})
+
+    def test_metrics(self):
+        METRICS.reset()
+        source = MRFSource(TEST_FILE, npi_set = NPI_SET)
+        sink = ListSink()
+
+        with tempfile.TemporaryDirectory() as d:
+            path = f'{d}/metrics.jsonl'
+            run_pipeline(source, sink, metrics_path = path)
+
+            with open(path) as f:
+                snapshot = json.loads(f.readlines()[-1])
+
+        counters = snapshot['counters']
+        self.assertEqual(counters['rows.negotiated_prices'], len(sink.batch.tables['negotiated_prices']))
+        self.assertGreater(counters['ijson_events'], 0)
+        self.assertGreater(counters['bytes_decompressed'], 0)
+        self.assertIn('stage.flatten', snapshot['timers'])
+        self.assertFalse(METRICS.tracked)
+
+
+class SoftAfter(MemoryBudget):
+    """
+    Budget that reports being over its soft limit after `n` looks
+    """
+
+    def __init__(self, n, limit = 10**12):
+        super().__init__(limit)
+        self.n = n
+
+    @property
+    def soft(self):
+        self.n -= 1
+        return self.n < 0
+
+
+class TestMemoryBudget(unittest.TestCase):
+    def rows(self, budget = None, **kwargs):
+        source = MRFSource(TEST_FILE, npi_set = NPI_SET, budget = budget, **kwargs)
+        sink = ListSink()
+        run_pipeline(source, sink)
+        return source, sink.batch.tables
+
+    def test_spill_and_stream(self):
+        _, expected = self.rows()
+
+        for n in (0, 3, 50):
+            source, tables = self.rows(SoftAfter(n))
+            self.assertEqual(tables, expected)
+            self.assertTrue(source.stream_rates)
+            self.assertTrue(source.memory_report['streamed_rates'])
+
+        source, _ = self.rows(SoftAfter(0))
+        self.assertIsInstance(source.provider_references_map, SpillDict)
+
+    def test_spill_with_defer_references(self):
+        _, expected = self.rows(defer_references = True)
+        _, tables = self.rows(SoftAfter(0), defer_references = True)
+        self.assertEqual(tables, expected)
+
+    def test_abort(self):
+        with self.assertRaises(MemoryBudgetExceeded) as cm:
+            self.rows(MemoryBudget(limit = 1))
+
+        self.assertEqual(cm.exception.report['stage'], 'provider_references')
+
+
+class TestRowBatch(unittest.TestCase):
+    def test_add_item_matches_rows(self):
+        item = BUNDLED_ITEM
+
+        batch = RowBatch()
+        batch.add_item(item, 'root')
+
+        expected = RowBatch()
+        expected.extend_rows(in_network_item_to_rows(item, 'root'))
+
+        self.assertEqual(len(batch), 5)
+        self.assertEqual(batch.tables, expected.tables)
+        self.assertEqual(batch.column('provider_references', 'provider_group_id'), [7])
+
+    def test_write_batch_matches_row_dicts(self):
+        root_data = {'reporting_entity_name': 'Bundles'}
+
+        with tempfile.TemporaryDirectory() as d:
+            batch_dir, rows_dir = os.path.join(d, 'batch'), os.path.join(d, 'rows')
+
+            writer = MRFWriter()
+            batch = RowBatch()
+            batch.add_item(BUNDLED_ITEM, writer.root_hash(dict(root_data)))
+            writer.write_batch(batch, dict(root_data), batch_dir)
+
+            writer = MRFWriter()
+            rows = in_network_item_to_rows(BUNDLED_ITEM, writer.root_hash(dict(root_data)))
+            writer.write_rows(rows, dict(root_data), rows_dir)
+
+            self.assertEqual(sorted(os.listdir(batch_dir)), sorted(os.listdir(rows_dir)))
+
+            for name in os.listdir(rows_dir):
+                table = name[:-len('.csv')]
+                with open(os.path.join(batch_dir, name), newline = '') as f:
+                    batch_rows = list(csv.reader(f))
+                with open(os.path.join(rows_dir, name), newline = '') as f:
+                    dict_rows = list(csv.reader(f))
+
+                self.assertEqual(batch_rows[0], SCHEMA[table], table)
+                self.assertEqual(batch_rows, dict_rows, table)
+
+    def test_layout_follows_column_order(self):
+        columns = ('npi_numbers', 'provider_group_id', 'root_hash_key', 'tin_value')
+
+        with mock.patch.dict(COLUMNS, {'provider_groups': columns}):
+            to_row = layout('provider_groups', ('root_hash_key', 'tin_value', 'npi_numbers'))
+            self.assertEqual(to_row(('r', '11', [1, 2])), ([1, 2], None, 'r', '11'))
+
+            self.assertEqual(layout('provider_groups', columns[:2])(([1], 7)), ([1], 7, None, None))
+
+            with self.assertRaises(KeyError):
+                layout('provider_groups', ('root_hash_key', 'tin_type'))
+
+
+class TestRun(unittest.TestCase):
+    def test_bundled_codes(self):
+        doc = {
+            'reporting_entity_name': 'Bundles',
+            'provider_references': [{
+                'provider_group_id': 7,
+                'provider_groups': [{'npi': [3], 'tin': {'type': 'ein', 'value': '12'}}],
+            }],
+            'in_network': [BUNDLED_ITEM],
+        }
+
+        with tempfile.TemporaryDirectory() as d:
+            loc = os.path.join(d, 'bundled.json')
+            with open(loc, 'w') as f:
+                json.dump(doc, f)
+
+            for name, kwargs in (
+                ('plain', {}),
+                ('streamed', {'stream_rates': True}),
+                ('deduped', {'dedup_path': os.path.join(d, 'keys.sqlite')}),
+            ):
+                out_dir = os.path.join(d, name)
+                run(loc, None, None, out_dir, **kwargs)
+
+                with open(os.path.join(out_dir, 'in_network.csv'), newline = '') as f:
+                    (in_network,) = csv.DictReader(f)
+                with open(os.path.join(out_dir, 'bundled_codes.csv'), newline = '') as f:
+                    (bundle,) = csv.DictReader(f)
+
+                self.assertEqual(bundle['billing_code'], '20000', name)
+                self.assertEqual(bundle['in_network_hash_key'], in_network['in_network_hash_key'], name)
+
+
+if __name__ == '__main__':
+    unittest.main()
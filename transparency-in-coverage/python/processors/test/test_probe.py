@@ -0,0 +1,139 @@
+import os
+import gzip
+import json
+import sqlite3
+import tempfile
+import unittest
+
+from probe import probe, probe_catalog, ranked_urls, estimated_items
+from synthetic import generate_mrf, serve_directory, synthetic_npi, synthetic_code
+
+
+def file_npis(path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt') as f:
+        mrf = json.load(f)
+
+    npis = set()
+    for pref in mrf['provider_references']:
+        for group in pref.get('provider_groups', []):
+            npis.update(group['npi'])
+    for item in mrf['in_network']:
+        for rate in item['negotiated_rates']:
+            for group in rate.get('provider_groups', []):
+                npis.update(group['npi'])
+    return npis
+
+
+class TestProbe(unittest.TestCase):
+
+    def test_whole_file(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'in_network.json.gz')
+            info = generate_mrf(path, n_items = 30, npi_pool = 500, compression = 'gzip')
+            npi_set = {synthetic_npi(i) for i in range(100)}
+
+            result = probe(path, npi_set, [synthetic_code(0), ('CPT', 'nope')])
+
+            self.assertTrue(result['complete'])
+            self.assertTrue(result['references_complete'])
+            self.assertEqual(result['items'], info['n_items'])
+            self.assertEqual(result['rates'], info['n_rates'])
+            self.assertEqual(result['provider_references'], 100)
+            self.assertEqual(result['code_matches'], 1)
+            self.assertEqual(sum(json.loads(result['code_types']).values()), info['n_items'])
+            self.assertEqual(result['npis_seen'], len(file_npis(path)))
+            self.assertEqual(result['npi_matches'], len(file_npis(path) & npi_set))
+
+    def test_sample(self):
+        with tempfile.TemporaryDirectory() as d:
+            for references_first in (True, False):
+                path = os.path.join(d, f'{references_first}.json')
+                info = generate_mrf(
+                    path, n_items = 1_000, n_provider_references = 3_000, npi_pool = 50_000,
+                    references_first = references_first,
+                )
+
+                result = probe(path, max_bytes = 1_000_000)
+
+                self.assertFalse(result['complete'])
+                self.assertEqual(result['references_complete'], references_first)
+                self.assertLess(result['items'], info['n_items'])
+                self.assertGreater(result['items'], 0)
+
+                # A quarter of the file is provider_references, which
+                # mustn't dilute the items per MB. Unread references at
+                # the end can only be taken for more items.
+                estimate = estimated_items(result, info['size'])
+                if references_first:
+                    self.assertLess(abs(estimate - info['n_items']), 0.1 * info['n_items'])
+                else:
+                    self.assertGreater(estimate, 0.9 * info['n_items'])
+
+    def test_items_per_mb(self):
+        with tempfile.TemporaryDirectory() as d, serve_directory(d) as url:
+            path = os.path.join(d, 'in_network.json')
+            info = generate_mrf(path, n_items = 40, references_first = True)
+
+            # in_network runs from its '[' to the end of the file, but
+            # for the closing brace
+            with open(path, 'rb') as f:
+                data = f.read()
+            in_network_bytes = len(data) - data.index(b'[', data.index(b'"in_network"')) - 1
+            expected = info['n_items'] / in_network_bytes * 1_000_000
+
+            with open(path, 'rb') as f, gzip.open(f'{path}.gz', 'wb') as out:
+                out.write(f.read())
+            ratio = os.path.getsize(f'{path}.gz') / len(data)
+
+            # The whole file fits in the readers' buffers, which mustn't
+            # count towards in_network
+            for loc, scale in (
+                (path, 1),
+                (f'{path}.gz', ratio),
+                (f'{url}/in_network.json', 1),
+                (f'{url}/in_network.json.gz', ratio),
+            ):
+                with self.subTest(loc = loc):
+                    result = probe(loc)
+                    self.assertTrue(result['complete'])
+                    self.assertAlmostEqual(result['items_per_mb'] * scale / expected, 1, delta = 0.05)
+
+    def test_catalog(self):
+        with tempfile.TemporaryDirectory() as d, serve_directory(d) as url:
+            db_path = os.path.join(d, 'catalog.db')
+            con = sqlite3.connect(db_path)
+            con.execute('CREATE TABLE in_network_files(url PRIMARY KEY UNIQUE, size)')
+
+            npi_set = {synthetic_npi(i) for i in range(10_000, 10_100)}
+            urls = {}
+            for i, npi_pool in enumerate((500, 20_000)):
+                name = f'{i}.json'
+                info = generate_mrf(os.path.join(d, name), n_items = 20, npi_pool = npi_pool, seed = i)
+                urls[name] = f'{url}/{name}'
+                con.execute('INSERT INTO in_network_files VALUES (?, ?)', (urls[name], info['size']))
+
+            urls['missing'] = f'{url}/missing.json'
+            con.execute('INSERT INTO in_network_files VALUES (?, ?)', (urls['missing'], 1))
+            con.commit()
+
+            self.assertEqual(probe_catalog(db_path, npi_set, jobs = 2), 3)
+            # Only the failed file is tried again
+            self.assertEqual(probe_catalog(db_path, npi_set, jobs = 2), 1)
+
+            rows = {
+                r[0]: r[1:] for r in con.execute(
+                    'SELECT url, npi_matches, items, estimated_items, error FROM in_network_probes'
+                )
+            }
+            self.assertEqual(rows[urls['0.json']][:3], (0, 20, 20))
+            self.assertGreater(rows[urls['1.json']][0], 0)
+            self.assertIsNotNone(rows[urls['missing']][3])
+            con.close()
+
+            # The file without our NPIs was read whole, so it's skipped
+            self.assertEqual(ranked_urls(db_path), [urls['1.json']])
+
+
+if __name__ == '__main__':
+    unittest.main()
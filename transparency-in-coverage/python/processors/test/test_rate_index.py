@@ -0,0 +1,194 @@
+import os
+import csv
+import json
+import random
+import tempfile
+import unittest
+
+from core import run
+from rate_index import build_index, RateIndex
+
+from test.test_shards import TEST_FILES
+from test.test_dedup import TEST_FILE
+
+
+def read_table(out_dir, table):
+    path = os.path.join(out_dir, f'{table}.csv')
+    if not os.path.exists(path):
+        return []
+    with open(path, newline = '') as f:
+        return list(csv.DictReader(f))
+
+
+def scan_rates(out_dirs, billing_code_type, billing_code, npi):
+    """
+    The same lookup as RateIndex.rates, by scanning every table
+    """
+    in_network_keys, rate_keys, group_ids = set(), set(), set()
+
+    for d in out_dirs:
+        in_network_keys |= {
+            r['in_network_hash_key'] for r in read_table(d, 'in_network')
+            if (r['billing_code_type'], r['billing_code']) == (billing_code_type, billing_code)
+        }
+
+        for r in read_table(d, 'provider_groups'):
+            if str(npi) in r['npi_numbers'].strip('[]').replace(' ', '').split(','):
+                if r['negotiated_rates_hash_key']:
+                    rate_keys.add(r['negotiated_rates_hash_key'])
+                else:
+                    group_ids.add((r['root_hash_key'], r['provider_group_id']))
+
+        rate_keys |= {
+            r['negotiated_rates_hash_key'] for r in read_table(d, 'provider_references')
+            if (r['root_hash_key'], r['provider_group_id']) in group_ids
+        }
+
+    return [
+        r for d in out_dirs for r in read_table(d, 'negotiated_prices')
+        if r['in_network_hash_key'] in in_network_keys and r['negotiated_rates_hash_key'] in rate_keys
+    ]
+
+
+def row_set(rows, ignore = ()):
+    return sorted(tuple(sorted((k, v) for k, v in r.items() if k not in ignore)) for r in rows)
+
+
+class TestRateIndex(unittest.TestCase):
+
+    def check(self, **kwargs):
+        with tempfile.TemporaryDirectory() as work_dir:
+            out_dirs = []
+            for i, loc in enumerate(TEST_FILES):
+                out_dirs.append(os.path.join(work_dir, str(i)))
+                run(loc, None, None, out_dirs[-1], **kwargs)
+
+            index_dir = os.path.join(work_dir, 'index')
+            counts = build_index(out_dirs, index_dir, run_records = 1_000)
+            self.assertTrue(counts['npi'] and counts['code'] and counts['price'])
+
+            codes = sorted({(r['billing_code_type'], r['billing_code']) for d in out_dirs for r in read_table(d, 'in_network')})
+            npis = sorted({
+                npi for d in out_dirs for r in read_table(d, 'provider_groups')
+                for npi in r['npi_numbers'].strip('[]').replace(' ', '').split(',')
+            })
+
+            rng = random.Random(0)
+            pairs = [(rng.choice(codes), int(rng.choice(npis))) for _ in range(20)]
+
+            found = 0
+            with RateIndex(index_dir) as index:
+                for code, npi in pairs + [(('CPT', 'no such code'), 1), (codes[0], 1)]:
+                    rows = index.rates(*code, npi)
+                    self.assertEqual(row_set(rows), row_set(scan_rates(out_dirs, *code, npi)))
+                    found += bool(rows)
+
+            self.assertTrue(found)
+
+    def test_inline_groups(self):
+        self.check()
+
+    def test_referenced_groups(self):
+        self.check(defer_references = True)
+
+    def test_deduplicated_items(self):
+        self.check_deduplicated()
+
+    def test_deduplicated_referenced_groups(self):
+        # Same provider references under another root, different items,
+        # so the second file's references go through provider_group_links
+        self.check_deduplicated(('"9999-12-31"', '"2023-12-31"'), defer_references = True)
+
+    def check_deduplicated(self, *replacements, **kwargs):
+        with tempfile.TemporaryDirectory() as work_dir:
+            # Same items under another root
+            other_file = os.path.join(work_dir, 'other.json')
+            with open(TEST_FILE) as f, open(other_file, 'w') as out:
+                data = f.read().replace('"2022-11-01"', '"2022-12-01"', 1)
+                for old, new in replacements:
+                    data = data.replace(old, new)
+                out.write(data)
+
+            store = os.path.join(work_dir, 'keys.sqlite')
+            plain_dirs, dedup_dirs = [], []
+            for i, loc in enumerate((TEST_FILE, other_file)):
+                plain_dirs.append(os.path.join(work_dir, f'plain_{i}'))
+                dedup_dirs.append(os.path.join(work_dir, f'dedup_{i}'))
+                run(loc, None, None, plain_dirs[-1], **kwargs)
+                run(loc, None, None, dedup_dirs[-1], dedup_path = store, **kwargs)
+
+            build_index(plain_dirs, os.path.join(work_dir, 'plain_index'))
+            build_index(dedup_dirs, os.path.join(work_dir, 'dedup_index'), run_records = 10)
+            if replacements:
+                self.assertTrue(read_table(dedup_dirs[1], 'provider_group_links'))
+
+            codes = sorted({(r['billing_code_type'], r['billing_code']) for r in read_table(plain_dirs[0], 'in_network')})
+            npis = sorted({
+                npi for r in read_table(plain_dirs[0], 'provider_groups')
+                for npi in r['npi_numbers'].strip('[]').replace(' ', '').split(',')
+            })
+            rng = random.Random(0)
+            pairs = [(rng.choice(codes), int(rng.choice(npis))) for _ in range(20)]
+
+            with RateIndex(os.path.join(work_dir, 'plain_index')) as plain, \
+                    RateIndex(os.path.join(work_dir, 'dedup_index')) as dedup:
+
+                rows = dedup.rates('MS-DRG', '0001', 1013096510)
+                self.assertEqual(len(rows), 2)
+                self.assertEqual(len({r['root_hash_key'] for r in rows}), 2)
+
+                # Only in_network_hash_key, a content key with dedup,
+                # tells the two apart
+                for code, npi in pairs + [(('MS-DRG', '0001'), 1013096510)]:
+                    self.assertEqual(
+                        row_set(dedup.rates(*code, npi), ignore = {'in_network_hash_key'}),
+                        row_set(plain.rates(*code, npi), ignore = {'in_network_hash_key'}),
+                    )
+
+    def test_code_types_kept_apart(self):
+        def item(code_type, rate):
+            return {
+                'negotiation_arrangement': 'ffs',
+                'name': code_type,
+                'billing_code_type': code_type,
+                'billing_code_type_version': '2022',
+                'billing_code': '27447',
+                'description': code_type,
+                'negotiated_rates': [{
+                    'provider_references': [1],
+                    'negotiated_prices': [{
+                        'billing_class': 'professional',
+                        'negotiated_type': 'negotiated',
+                        'expiration_date': '9999-12-31',
+                        'negotiated_rate': rate,
+                    }],
+                }],
+            }
+
+        doc = {
+            'reporting_entity_name': 'Types',
+            'provider_references': [{
+                'provider_group_id': 1,
+                'provider_groups': [{'npi': [1508935891], 'tin': {'type': 'ein', 'value': '11'}}],
+            }],
+            'in_network': [item('CPT', 100.0), item('HCPCS', 200.0)],
+        }
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            loc = os.path.join(work_dir, 'types.json')
+            with open(loc, 'w') as f:
+                json.dump(doc, f)
+
+            out_dir = os.path.join(work_dir, 'out')
+            run(loc, None, None, out_dir)
+            build_index([out_dir], os.path.join(work_dir, 'index'))
+
+            with RateIndex(os.path.join(work_dir, 'index')) as index:
+                for code_type, rate in (('CPT', '100.0'), ('HCPCS', '200.0')):
+                    rows = index.rates(code_type, '27447', 1508935891)
+                    self.assertEqual([r['negotiated_rate'] for r in rows], [rate])
+                self.assertEqual(index.rates('MS-DRG', '27447', 1508935891), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+import io
+import bz2
+import lzma
+import gzip
+import zipfile
+import tempfile
+import unittest
+from unittest import mock
+from pathlib import Path
+
+from urllib3 import HTTPResponse
+
+from mrfutils import MRFOpen, InvalidMRF
+from readers import (
+    MmapReader, PipelinedReader, ThrottledReader, sniff_compression, open_decompressed, open_zip_member,
+)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+TEST_DIR = Path(__file__).parent
+
+
+class TestPipelinedReader(unittest.TestCase):
+    def setUp(self):
+        self.data = (TEST_DIR / 'test_file_1.json').read_bytes()
+
+    def test_reads_same_bytes_as_gzip(self):
+        blob = gzip.compress(self.data)
+        with PipelinedReader(fileobj = io.BytesIO(blob), buffer_size = 4096, n_buffers = 2) as r:
+            self.assertEqual(r.read(), self.data)
+
+    def test_reads_concatenated_members(self):
+        blob = gzip.compress(self.data[:1000]) + gzip.compress(self.data[1000:])
+        with PipelinedReader(fileobj = io.BytesIO(blob)) as r:
+            self.assertEqual(r.read(), self.data)
+
+    def test_skips_trailing_padding(self):
+        member = gzip.compress(self.data)
+        for blob in (member + b'\0' * 100, member + b'\0' * 100 + member):
+            with self.subTest(size = len(blob)):
+                with PipelinedReader(fileobj = io.BytesIO(blob), read_size = 512) as r:
+                    self.assertEqual(r.read(), gzip.decompress(blob))
+
+    def test_peek_does_not_consume(self):
+        with PipelinedReader(fileobj = io.BytesIO(gzip.compress(self.data))) as r:
+            self.assertEqual(r.peek(1), self.data[:1])
+            self.assertEqual(r.read(10), self.data[:10])
+
+    def test_truncated_stream_raises(self):
+        blob = gzip.compress(self.data)[:-20]
+        with PipelinedReader(fileobj = io.BytesIO(blob)) as r:
+            with self.assertRaises(Exception):
+                r.read()
+
+
+class TestDecompression(unittest.TestCase):
+    def setUp(self):
+        self.data = (TEST_DIR / 'test_file_2.json').read_bytes()
+
+    def test_sniff_uncompressed_json(self):
+        self.assertIsNone(sniff_compression(self.data[:6]))
+
+    def test_sniff_and_open_each_format(self):
+        zipped = io.BytesIO()
+        with zipfile.ZipFile(zipped, 'w') as zf:
+            zf.writestr('in_network.json', self.data)
+
+        blobs = {
+            'gzip': gzip.compress(self.data),
+            'xz':   lzma.compress(self.data),
+            'bz2':  bz2.compress(self.data),
+            'zip':  zipped.getvalue(),
+        }
+        if zstandard is not None:
+            blobs['zstd'] = zstandard.ZstdCompressor().compress(self.data)
+
+        for compression, blob in blobs.items():
+            with self.subTest(compression = compression):
+                self.assertEqual(sniff_compression(blob[:6]), compression)
+                f, extra = open_decompressed(io.BytesIO(blob), compression)
+                self.assertEqual(f.read(), self.data)
+
+    def test_zip_spool_is_closed(self):
+        zipped = io.BytesIO()
+        with zipfile.ZipFile(zipped, 'w') as zf:
+            zf.writestr('in_network.json', self.data)
+
+        class Unseekable(io.BytesIO):
+            def seekable(self):
+                return False
+
+        spools = []
+        make_spool = tempfile.TemporaryFile
+
+        def spool():
+            spools.append(make_spool())
+            return spools[-1]
+
+        with mock.patch('tempfile.TemporaryFile', spool):
+            member, extra = open_zip_member(Unseekable(zipped.getvalue()))
+
+        self.assertEqual(member.read(), self.data)
+        extra.close()
+        self.assertEqual(len(spools), 1)
+        self.assertTrue(spools[0].closed)
+
+
+class TestMRFOpen(unittest.TestCase):
+    def setUp(self):
+        self.data = (TEST_DIR / 'test_file_2.json').read_bytes()
+
+    @unittest.skipUnless(zstandard, 'zstandard is not installed')
+    def test_content_not_name(self):
+        with tempfile.TemporaryDirectory() as d:
+            zst = Path(d) / 'plan.zst'
+            zst.write_bytes(zstandard.ZstdCompressor().compress(self.data))
+            bare = Path(d) / 'plan'
+            bare.write_bytes(self.data)
+
+            for path in (zst, bare):
+                with self.subTest(path = path.name), MRFOpen(str(path)) as f:
+                    self.assertEqual(f.read(), self.data)
+
+    def test_not_json_inside(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = Path(d) / 'plan.json.gz'
+            path.write_bytes(gzip.compress(b'<html></html>'))
+
+            with self.assertRaises(InvalidMRF):
+                with MRFOpen(str(path)):
+                    pass
+
+
+class TestMmapReader(unittest.TestCase):
+    def setUp(self):
+        self.path = TEST_DIR / 'test_file_2.json'
+        self.data = self.path.read_bytes()
+
+    def test_read_returns_bytes(self):
+        with MmapReader(self.path) as r:
+            self.assertEqual(r.read(0), b'')
+            self.assertEqual(r.read(), self.data)
+
+    def test_offsets(self):
+        with MmapReader(self.path) as r:
+            r.read(100)
+            self.assertEqual(r.tell(), 100)
+            r.seek(10)
+            buf = bytearray(5)
+            self.assertEqual(r.readinto(buf), 5)
+            self.assertEqual(bytes(buf), self.data[10:15])
+            self.assertEqual(bytes(r.view(10, 15)), self.data[10:15])
+
+
+class TestThrottledReader(unittest.TestCase):
+    def test_consumes_bytes_on_the_wire(self):
+        data = (TEST_DIR / 'test_file_1.json').read_bytes()
+        body = gzip.compress(data)
+        raw = HTTPResponse(
+            io.BytesIO(body),
+            headers = {'Content-Encoding': 'gzip'},
+            preload_content = False,
+        )
+        raw.decode_content = True
+        limiter = mock.Mock()
+
+        self.assertEqual(io.BufferedReader(ThrottledReader(raw, limiter)).read(), data)
+        self.assertEqual(sum(c.args[0] for c in limiter.consume.call_args_list), len(body))
@@ -0,0 +1,145 @@
+import os
+import time
+import sqlite3
+import tempfile
+import unittest
+
+from core import run
+from readers import RateLimiter
+from schedule import crawl, crawl_file, staged_path, lpt_plan, CrawlQueue, STAGED, STREAMED
+from shards import ShardSet, ShardLocked
+from synthetic import generate_mrf, serve_directory
+
+
+def sorted_outputs(out_dir):
+    outputs = {}
+    for name in sorted(os.listdir(out_dir)):
+        if name.endswith('.csv'):
+            with open(os.path.join(out_dir, name)) as f:
+                header, *rows = f.read().splitlines()
+                outputs[name] = [header] + sorted(rows)
+    return outputs
+
+
+class TestSchedule(unittest.TestCase):
+
+    def test_lpt_plan(self):
+        plan, loads = lpt_plan([4, 10, 2, 7, 5, 6], 2)
+        self.assertEqual(loads, [17, 17])
+        self.assertEqual(plan[0][0], 1)
+        self.assertEqual(sorted(plan[0] + plan[1]), list(range(6)))
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(1_000_000, burst = 100_000)
+        start = time.monotonic()
+        for _ in range(5):
+            limiter.consume(100_000)
+        self.assertGreater(time.monotonic() - start, 0.35)
+
+    def test_crawl(self):
+        with tempfile.TemporaryDirectory() as d, serve_directory(d) as url:
+            catalog = os.path.join(d, 'catalog.db')
+            con = sqlite3.connect(catalog)
+            con.execute('CREATE TABLE in_network_files(url PRIMARY KEY UNIQUE, size)')
+
+            urls = []
+            for i, n_items in enumerate((40, 20, 10)):
+                name = f'{i}.json.gz'
+                info = generate_mrf(os.path.join(d, name), n_items = n_items, compression = 'gzip', seed = i)
+                urls.append(f'{url}/{name}')
+                con.execute('INSERT INTO in_network_files VALUES (?, ?)', (urls[-1], info['size']))
+
+            missing = f'{url}/missing.json'
+            con.execute('INSERT INTO in_network_files VALUES (?, ?)', (missing, -1))
+            con.commit()
+            con.close()
+
+            expected_dir = os.path.join(d, 'expected')
+            for u in urls:
+                run(u, None, None, expected_dir)
+
+            # Room to stage all but the largest file
+            largest = os.path.getsize(os.path.join(d, '0.json.gz'))
+            disk = int(largest * 1.05)
+
+            out_dir = os.path.join(d, 'crawl')
+            counts = crawl([catalog], out_dir, workers = 2, disk = disk, bandwidth = 50_000_000, max_attempts = 2)
+            self.assertEqual(counts, {'done': 3, 'failed': 1})
+
+            queue = CrawlQueue(os.path.join(out_dir, 'queue.db'))
+            strategies = dict(queue.conn.execute('SELECT url, strategy FROM jobs'))
+            self.assertEqual([strategies[u] for u in urls], [STREAMED, STAGED, STAGED])
+            self.assertEqual(queue.conn.execute('SELECT attempts FROM jobs WHERE url = ?', (missing,)).fetchone(), (2,))
+
+            # A crawl killed while a file was running picks it up again
+            queue.conn.execute("UPDATE jobs SET state = 'running' WHERE url = ?", (urls[1],))
+            queue.conn.commit()
+            queue.close()
+
+            counts = crawl([catalog], out_dir, workers = 2, disk = disk)
+            self.assertEqual(counts, {'done': 3, 'failed': 1})
+            self.assertEqual(os.listdir(os.path.join(out_dir, '.staged')), [])
+
+            merged_dir = os.path.join(d, 'merged')
+            ShardSet(out_dir).merge(merged_dir)
+            self.assertEqual(sorted_outputs(merged_dir), sorted_outputs(expected_dir))
+
+    def test_crawl_file_locked(self):
+        with tempfile.TemporaryDirectory() as d, serve_directory(d) as url:
+            generate_mrf(os.path.join(d, 'locked.json.gz'), n_items = 10, compression = 'gzip')
+            url = f'{url}/locked.json.gz'
+
+            out_dir = os.path.join(d, 'crawl')
+            staged = staged_path(out_dir, url)
+            shards = ShardSet(out_dir)
+
+            # Another process writing the same file fails the job, and
+            # keeps what was staged for when it's tried again
+            with shards.open(url):
+                with self.assertRaises(ShardLocked):
+                    crawl_file(url, STAGED, out_dir)
+            self.assertTrue(os.path.exists(staged))
+
+            crawl_file(url, STAGED, out_dir)
+            self.assertTrue(shards.is_published(url))
+            self.assertFalse(os.path.exists(staged))
+
+    def test_staged_files_keyed_by_url(self):
+        with tempfile.TemporaryDirectory() as d, serve_directory(d) as url:
+            catalog = os.path.join(d, 'catalog.db')
+            info = generate_mrf(os.path.join(d, 'staged.json.gz'), n_items = 10, compression = 'gzip')
+            url = f'{url}/staged.json.gz'
+
+            con = sqlite3.connect(catalog)
+            con.execute('CREATE TABLE in_network_files(url PRIMARY KEY UNIQUE, size)')
+            con.execute('INSERT INTO in_network_files VALUES (?, ?)', (url, info['size']))
+            con.commit()
+
+            out_dir = os.path.join(d, 'crawl')
+            keys = os.path.join(d, 'keys.sqlite')
+            crawl([catalog], out_dir, workers = 1, disk = 10 * info['size'], catalog_path = catalog, dedup_path = keys)
+
+            queue = CrawlQueue(os.path.join(out_dir, 'queue.db'))
+            self.assertEqual(queue.conn.execute('SELECT strategy FROM jobs').fetchall(), [(STAGED,)])
+
+            # The shard, catalog entry and keys are the URL's, not the
+            # staged copy's
+            shards = ShardSet(out_dir)
+            self.assertEqual([e['loc'] for e in shards.manifest()], [url])
+            self.assertEqual(con.execute('SELECT url FROM in_network_blooms').fetchall(), [(url,)])
+            store = sqlite3.connect(keys)
+            self.assertEqual(store.execute('SELECT DISTINCT owner FROM keys').fetchall(), [(url,)])
+            store.close()
+
+            # Crawled again, streamed this time, it's already published
+            queue.conn.execute("UPDATE jobs SET state = 'pending'")
+            queue.conn.commit()
+            queue.close()
+
+            self.assertEqual(crawl([catalog], out_dir, workers = 1), {'done': 1})
+            self.assertEqual([e['loc'] for e in shards.manifest()], [url])
+            con.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
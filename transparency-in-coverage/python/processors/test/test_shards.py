@@ -0,0 +1,62 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from core import run
+from shards import ShardSet, ShardLocked
+
+from test.test_checkpoint import read_outputs
+
+
+TEST_DIR = Path(__file__).parent
+TEST_FILES = [str(TEST_DIR / 'test_file_1.json'), str(TEST_DIR / 'test_file_3.json.gz')]
+
+
+class TestShards(unittest.TestCase):
+
+    def test_merge_matches_unsharded(self):
+        with tempfile.TemporaryDirectory() as expected_dir, tempfile.TemporaryDirectory() as out_dir:
+            for loc in TEST_FILES:
+                run(loc, None, None, expected_dir)
+                run(loc, None, None, out_dir, shard = True)
+
+            # Published files aren't written again
+            run(TEST_FILES[0], None, None, out_dir, shard = True)
+
+            shards = ShardSet(out_dir)
+            self.assertEqual([e['loc'] for e in shards.manifest()], TEST_FILES)
+            self.assertEqual(sorted(os.listdir(shards.tmp_dir)), sorted(f"{e['key']}.lock" for e in shards.manifest()))
+
+            merged_dir = os.path.join(out_dir, 'merged')
+            shards.merge(merged_dir)
+            self.assertEqual(read_outputs(merged_dir), read_outputs(expected_dir))
+
+    def test_failed_run_is_not_published(self):
+        with tempfile.TemporaryDirectory() as out_dir:
+            missing = os.path.join(out_dir, 'missing.json')
+
+            with self.assertRaises(Exception):
+                run(missing, None, None, out_dir, shard = True)
+
+            shards = ShardSet(out_dir)
+            self.assertEqual(shards.manifest(), [])
+            self.assertFalse(os.path.exists(shards.open(missing).dir))
+
+    def test_one_writer_per_file(self):
+        with tempfile.TemporaryDirectory() as out_dir:
+            shards = ShardSet(out_dir)
+
+            with shards.open(TEST_FILES[0]):
+                with self.assertRaises(ShardLocked):
+                    with shards.open(TEST_FILES[0]):
+                        pass
+
+                # Skipped, not raised
+                run(TEST_FILES[0], None, None, out_dir, shard = True)
+
+            self.assertEqual(shards.manifest(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
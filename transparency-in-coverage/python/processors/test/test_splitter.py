@@ -0,0 +1,120 @@
+import os
+import sys
+import gzip
+import json
+import tempfile
+import unittest
+import subprocess
+import importlib.util
+from pathlib import Path
+
+from splitter import split_mrf, iter_jsonl, shard_paths
+
+
+TEST_DIR = Path(__file__).parent
+PROCESSORS_DIR = TEST_DIR.parent
+DOWNLOADERS_DIR = PROCESSORS_DIR.parent / 'downloaders'
+
+
+def load_parse_anthem():
+    spec = importlib.util.spec_from_file_location('parse_anthem', DOWNLOADERS_DIR / 'parse_anthem.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_index(n):
+    return {
+        'reporting_entity_name': 'Plan',
+        'reporting_entity_type': 'health insurance issuer',
+        'reporting_structure': [
+            {
+                'reporting_plans': [{'plan_name': f'Plan {i}', 'plan_id': str(i)}],
+                'in_network_files': [{'description': 'in network', 'location': f'https://example.com/{i}.json.gz'}],
+            }
+            for i in range(n)
+        ],
+    }
+
+
+def read_split(out_dir, key):
+    return [obj for path in shard_paths(out_dir, key) for obj in iter_jsonl(path)]
+
+
+class TestSplitter(unittest.TestCase):
+
+    def test_in_network(self):
+        with gzip.open(TEST_DIR / 'test_file_3.json.gz', 'rt') as f:
+            mrf = json.load(f)
+
+        for compress in (False, True):
+            with self.subTest(compress = compress), tempfile.TemporaryDirectory() as out_dir:
+                # Small shards, so that every key rolls over more than once
+                counts = split_mrf(
+                    str(TEST_DIR / 'test_file_3.json.gz'), out_dir,
+                    shard_size = 500, workers = 2, compress = compress,
+                )
+
+                for key in ('in_network', 'provider_references'):
+                    self.assertEqual(counts[key], len(mrf[key]))
+                    self.assertEqual(read_split(out_dir, key), mrf[key])
+
+                    paths = shard_paths(out_dir, key)
+                    self.assertGreater(len(paths), 1)
+                    self.assertTrue(all(p.endswith('.jsonl.gz' if compress else '.jsonl') for p in paths))
+
+                with open(os.path.join(out_dir, 'root.json')) as f:
+                    root = json.load(f)
+                self.assertEqual(root, {k: v for k, v in mrf.items() if k not in ('in_network', 'provider_references')})
+
+    def test_reporting_structure(self):
+        index = make_index(50)
+
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'index.json.gz')
+            with gzip.open(path, 'wt') as f:
+                json.dump(index, f)
+
+            out_dir = os.path.join(d, 'split')
+            counts = split_mrf(path, out_dir, keys = ['reporting_structure'], shard_size = 1_000)
+
+            self.assertEqual(counts, {'reporting_structure': 50})
+            self.assertGreater(len(shard_paths(out_dir, 'reporting_structure')), 1)
+            self.assertEqual(read_split(out_dir, 'reporting_structure'), index['reporting_structure'])
+
+            with open(os.path.join(out_dir, 'root.json')) as f:
+                self.assertEqual(json.load(f), {
+                    'reporting_entity_name': 'Plan',
+                    'reporting_entity_type': 'health insurance issuer',
+                })
+
+    def test_anthem_workflow(self):
+        # The downloaders README flow: split the index with the CLI, then
+        # collect the in-network URLs with parse_anthem
+        parse_anthem = load_parse_anthem()
+        index = make_index(50)
+        expected = {f['location'] for s in index['reporting_structure'] for f in s['in_network_files']}
+
+        for flags in ([], ['--gzip']):
+            with self.subTest(flags = flags), tempfile.TemporaryDirectory() as d:
+                with gzip.open(os.path.join(d, 'anthem_index.json.gz'), 'wt') as f:
+                    json.dump(index, f)
+
+                subprocess.run(
+                    [
+                        sys.executable, str(PROCESSORS_DIR / 'splitter.py'),
+                        '-u', 'anthem_index.json.gz',
+                        '-o', '2022-09-01_anthem_index_json',
+                        '-k', 'reporting_structure',
+                        *flags,
+                    ],
+                    cwd = d, check = True,
+                )
+
+                split_dir = os.path.join(d, '2022-09-01_anthem_index_json')
+                self.assertIn('root.json', os.listdir(split_dir))
+                self.assertEqual(parse_anthem.load_in_network_urls(split_dir), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
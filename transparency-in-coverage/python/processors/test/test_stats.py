@@ -0,0 +1,185 @@
+import os
+import csv
+import math
+import random
+import tempfile
+import unittest
+from collections import defaultdict
+
+from core import run
+from stats import QuantileSketch, RateStats, Aggregator, aggregate_outputs, STREAM_GROUP_BY
+
+from test.test_shards import TEST_FILES
+from test.test_dedup import TEST_FILE
+
+
+def read_csv(path):
+    with open(path, newline = '') as f:
+        return list(csv.DictReader(f))
+
+
+def scan_stats(out_dirs):
+    """
+    Rates per (billing_code, npi, root_hash_key), by joining whole tables
+    """
+    rates = defaultdict(list)
+
+    for d in out_dirs:
+        tables = {t: read_csv(os.path.join(d, f'{t}.csv')) for t in ('in_network', 'provider_groups', 'negotiated_prices')}
+        codes = {r['in_network_hash_key']: r['billing_code'] for r in tables['in_network']}
+        npis = defaultdict(set)
+        for r in tables['provider_groups']:
+            key = r['root_hash_key'], r['in_network_hash_key'], r['negotiated_rates_hash_key']
+            npis[key].update(r['npi_numbers'].strip('[]').replace(' ', '').split(','))
+
+        for r in tables['negotiated_prices']:
+            key = r['root_hash_key'], r['in_network_hash_key'], r['negotiated_rates_hash_key']
+            for npi in npis[key]:
+                rates[codes[r['in_network_hash_key']], npi, r['root_hash_key']].append(float(r['negotiated_rate']))
+
+    return rates
+
+
+class TestSketch(unittest.TestCase):
+
+    def test_quantiles(self):
+        rng = random.Random(0)
+        values = [rng.lognormvariate(5, 2) for _ in range(10_000)] + [0.0] * 10
+
+        stats = RateStats()
+        for x in values:
+            stats.add(x)
+
+        # Merged from pieces in another order, the result is the same
+        merged = RateStats()
+        for i in range(0, len(values), 999):
+            part = RateStats()
+            for x in reversed(values[i:i + 999]):
+                part.add(x)
+            merged.merge(part)
+
+        self.assertEqual(stats.summary(), merged.summary())
+
+        values.sort()
+        summary = stats.summary()
+        self.assertEqual(summary['count'], len(values))
+        self.assertEqual(summary['min'], values[0])
+        self.assertEqual(summary['max'], values[-1])
+        self.assertEqual(summary['mean'], math.fsum(values) / len(values))
+
+        for q, name in ((0.1, 'p10'), (0.5, 'p50'), (0.9, 'p90')):
+            exact = values[int(q * (len(values) - 1))]
+            self.assertLessEqual(abs(summary[name] - exact), QuantileSketch.alpha * exact)
+
+    def test_spill(self):
+        aggregator = Aggregator(max_keys = 3)
+        for i in range(100):
+            aggregator.add((str(i % 7),), float(i))
+
+        items = list(aggregator.items())
+        self.assertEqual([k for k, _ in items], sorted((str(i),) for i in range(7)))
+        self.assertEqual(sum(s.count for _, s in items), 100)
+
+
+class TestAggregateOutputs(unittest.TestCase):
+
+    def test_aggregate(self):
+        with tempfile.TemporaryDirectory() as work_dir:
+            inline_dirs, defer_dirs = [], []
+            for i, loc in enumerate(TEST_FILES):
+                inline_dirs.append(os.path.join(work_dir, f'inline_{i}'))
+                defer_dirs.append(os.path.join(work_dir, f'defer_{i}'))
+                run(loc, None, None, inline_dirs[-1])
+                run(loc, None, None, defer_dirs[-1], defer_references = True)
+
+            path = os.path.join(work_dir, 'summary.csv')
+            self.assertTrue(aggregate_outputs(inline_dirs, path))
+            expected = read_csv(path)
+
+            rates = scan_stats(inline_dirs)
+            self.assertEqual(len(expected), len(rates))
+            for row in expected:
+                values = rates[row['billing_code'], row['npi'], row['root_hash_key']]
+                self.assertEqual(int(row['count']), len(values))
+                self.assertEqual(float(row['min']), min(values))
+                self.assertEqual(float(row['max']), max(values))
+
+            # Referenced groups, partitioned joins, spilled groups and
+            # several processes all give the same summaries
+            for dirs, kwargs in (
+                (defer_dirs, {}),
+                (inline_dirs, {'partition_bytes': 10_000, 'max_keys': 50}),
+                (defer_dirs, {'partition_bytes': 10_000, 'jobs': 2}),
+            ):
+                other = os.path.join(work_dir, 'other.csv')
+                aggregate_outputs(dirs, other, **kwargs)
+                self.assertEqual(read_csv(other), expected)
+
+    def test_deduplicated_across_dirs(self):
+        with tempfile.TemporaryDirectory() as work_dir:
+            with open(TEST_FILE) as f:
+                data = f.read().replace('"2022-11-01"', '"2022-12-01"', 1)
+
+            # Same items under another root, and the same provider
+            # references with other items, as in test_dedup
+            other_file = os.path.join(work_dir, 'other.json')
+            repriced_file = os.path.join(work_dir, 'repriced.json')
+            with open(other_file, 'w') as f:
+                f.write(data)
+            with open(repriced_file, 'w') as f:
+                f.write(data.replace('"9999-12-31"', '"2023-12-31"'))
+
+            for i, kwargs in enumerate(({}, {'defer_references': True})):
+                store = os.path.join(work_dir, f'keys_{i}.sqlite')
+                plain_dirs, dedup_dirs = [], []
+
+                def run_both(name, loc):
+                    plain_dirs.append(os.path.join(work_dir, f'plain_{name}_{i}'))
+                    dedup_dirs.append(os.path.join(work_dir, f'dedup_{name}_{i}'))
+                    run(loc, None, None, plain_dirs[-1], **kwargs)
+                    run(loc, None, None, dedup_dirs[-1], dedup_path = store, **kwargs)
+
+                run_both('a', TEST_FILE)
+                run_both('b', other_file)
+
+                path = os.path.join(work_dir, 'summary.csv')
+                aggregate_outputs(dedup_dirs, path, group_by = ['root_hash_key'])
+                self.assertEqual(len(read_csv(path)), 2)
+
+                # With references deferred, the repriced file's items
+                # refer to groups written in the first directory
+                run_both('c', repriced_file)
+
+                expected = os.path.join(work_dir, 'expected.csv')
+                aggregate_outputs(plain_dirs, expected)
+                for jobs in (1, 2):
+                    aggregate_outputs(dedup_dirs, path, jobs = jobs)
+                    self.assertEqual(read_csv(path), read_csv(expected))
+
+
+class TestStatsSink(unittest.TestCase):
+
+    def test_same_as_output(self):
+        with tempfile.TemporaryDirectory() as work_dir:
+            for loc in TEST_FILES:
+                for kwargs in ({}, {'defer_references': True}, {'stream_rates': True}):
+                    out_dir = os.path.join(work_dir, 'out')
+                    expected = os.path.join(work_dir, 'expected.csv')
+                    run(loc, None, None, out_dir, **kwargs)
+                    aggregate_outputs([out_dir], expected, group_by = STREAM_GROUP_BY)
+
+                    stats_dir = os.path.join(work_dir, 'stats')
+                    path = os.path.join(work_dir, 'summary.csv')
+                    run(loc, None, None, stats_dir, stats_path = path, **kwargs)
+
+                    self.assertFalse(os.path.exists(stats_dir))
+                    self.assertTrue(read_csv(expected))
+                    self.assertEqual(read_csv(path), read_csv(expected))
+
+                    os.remove(path)
+                    for name in os.listdir(out_dir):
+                        os.remove(os.path.join(out_dir, name))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import os
+import tempfile
+import unittest
+
+from pipeline import MRFSource, ListSink, run_pipeline
+from synthetic import generate_mrf, serve_directory
+
+
+class TestSynthetic(unittest.TestCase):
+    def test_deterministic(self):
+        with tempfile.TemporaryDirectory() as d:
+            a, b = os.path.join(d, 'a.json.gz'), os.path.join(d, 'b.json.gz')
+            generate_mrf(a, n_items = 20, compression = 'gzip', seed = 1)
+            generate_mrf(b, n_items = 20, compression = 'gzip', seed = 1)
+
+            with open(a, 'rb') as fa, open(b, 'rb') as fb:
+                self.assertEqual(fa.read(), fb.read())
+
+    def test_shapes_flatten(self):
+        with tempfile.TemporaryDirectory() as d, serve_directory(d) as url:
+            for i, params in enumerate((
+                {},
+                {'references_first': False, 'rates_first': True},
+                {'reference_ratio': 1, 'n_remote_references': 3, 'remote_base_url': url},
+            )):
+                path = os.path.join(d, f'{i}.json')
+                info = generate_mrf(path, n_items = 10, rates_per_item = 3, prices_per_rate = 2, **params)
+
+                source = MRFSource(path)
+                sink = ListSink()
+                run_pipeline(source, sink)
+
+                self.assertEqual(len(sink.batch.tables['in_network']), 10)
+                self.assertEqual(len(sink.batch.tables['negotiated_prices']), 2 * info['n_rates'])
+
+
+if __name__ == '__main__':
+    unittest.main()